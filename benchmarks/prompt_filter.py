@@ -0,0 +1,179 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Micro-benchmark of the prompt filter engine against the previous per-filter loop.
+
+Runs over a corpus of synthetic prompts and synthetic filters, so it doesn't need a DB, redis or the real filters.
+Usage: python benchmarks/prompt_filter.py [--prompts 5000] [--filter-size 300] [--seed 42]
+"""
+
+import argparse
+import importlib.util
+import pathlib
+import random
+import string
+import time
+
+import emoji
+import regex as re
+from unidecode import unidecode
+
+# We load the engine directly from its file, so that we don't initialize the whole horde app
+engine_path = pathlib.Path(__file__).parent.parent / "horde" / "prompt_filter.py"
+spec = importlib.util.spec_from_file_location("prompt_filter", engine_path)
+prompt_filter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(prompt_filter)
+
+FILTER_GROUPS = [["filter_10", "filter_11"], ["filter_20"]]
+VOCABULARY = [
+    "portrait",
+    "landscape",
+    "masterpiece",
+    "best quality",
+    "highly detailed",
+    "castle",
+    "dragon",
+    "forest",
+    "sunset",
+    "cyberpunk",
+    "city",
+    "knight",
+    "armor",
+    "oil painting",
+    "watercolor",
+    "trending on artstation",
+    "8k",
+    "octane render",
+    "cinematic lighting",
+    "woman",
+    "man",
+    "robot",
+    "spaceship",
+    "mountain",
+    "river",
+    "café",
+    "naïve",
+]
+
+
+class LegacyPromptChecker:
+    """The filter loop as it was before the compiled engine, kept here for comparison"""
+
+    def __init__(self, filter_regex):
+        self.compiled = {filter_id: re.compile(regex_string, re.IGNORECASE) for filter_id, regex_string in filter_regex.items()}
+        self.weight_remover = re.compile(r"\((.*?):\d+\.\d+\)")
+        self.whitespace_remover = re.compile(r"(\s(\w)){3,}\b")
+        self.whitespace_converter = re.compile(r"([^\w\s]|_)")
+
+    def normalize_prompt(self, prompt):
+        prompt = self.weight_remover.sub(r"\1", prompt)
+        prompt = self.whitespace_converter.sub(" ", prompt)
+        for match in re.finditer(self.whitespace_remover, prompt):
+            trim_match = match.group(0).strip()
+            replacement = re.sub(r"\s+", "", trim_match)
+            prompt = prompt.replace(trim_match, replacement)
+        prompt = re.sub(r"\s+", " ", prompt)
+        return unidecode(prompt)
+
+    def __call__(self, prompt):
+        prompt_suspicion = 0
+        norm_prompt = self.normalize_prompt(prompt)
+        for filters in FILTER_GROUPS:
+            for filter_id in filters:
+                existing_emojis = emoji.emoji_list(prompt)
+                if filter_id == "filter_10" and len(existing_emojis):
+                    emj_list = [emj["emoji"] for emj in existing_emojis]
+                    if any(emj in emj_list for emj in prompt_filter.SUSPICIOUS_EMOJIS):
+                        prompt_suspicion += 1
+                        break
+                if self.compiled[filter_id].search(norm_prompt):
+                    prompt_suspicion += 1
+                    break
+        return prompt_suspicion
+
+
+def random_word(rng, min_len=5, max_len=10):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(min_len, max_len)))
+
+
+def build_filters(rng, filter_size):
+    filter_regex = {}
+    trigger_words = {}
+    for filters in FILTER_GROUPS:
+        for filter_id in filters:
+            words = [random_word(rng) for _ in range(filter_size)]
+            trigger_words[filter_id] = words
+            alternatives = []
+            for index, word in enumerate(words):
+                # Most real filter entries are plain words, but a few start with a group or a class
+                if index % 20 == 0:
+                    alternatives.append(rf"\b(?:very|tiny) {word}")
+                    trigger_words[filter_id][index] = f"tiny {word}"
+                elif index % 20 == 1:
+                    alternatives.append(rf"[{word[0]}{word[0].upper()}]{word[1:]}")
+                else:
+                    alternatives.append(rf"\b{word}s?\b")
+            filter_regex[filter_id] = "|".join(alternatives)
+    return filter_regex, trigger_words
+
+
+def build_corpus(rng, prompt_count, trigger_words):
+    corpus = []
+    for _ in range(prompt_count):
+        words = rng.sample(VOCABULARY, rng.randint(5, 15))
+        roll = rng.random()
+        if roll < 0.05:
+            filter_id = rng.choice(list(trigger_words))
+            words.insert(rng.randrange(len(words)), rng.choice(trigger_words[filter_id]))
+        elif roll < 0.08:
+            words.append(rng.choice(["👧", "🐱", "🍼", "🌅"]))
+        elif roll < 0.10:
+            words.append(" ".join(rng.choice(list(trigger_words.values()))[0]))
+        if rng.random() < 0.3:
+            words[0] = f"({words[0]}:1.2)"
+        corpus.append(", ".join(words))
+    return corpus
+
+
+def time_checker(checker, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for prompt in corpus:
+            checker(prompt)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--prompts", type=int, default=5000)
+    arg_parser.add_argument("--filter-size", type=int, default=300, help="How many alternatives each filter regex has")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--seed", type=int, default=42)
+    bench_args = arg_parser.parse_args()
+    rng = random.Random(bench_args.seed)
+    filter_regex, trigger_words = build_filters(rng, bench_args.filter_size)
+    corpus = build_corpus(rng, bench_args.prompts, trigger_words)
+
+    legacy_checker = LegacyPromptChecker(filter_regex)
+    engine = prompt_filter.CompiledPromptFilter(filter_regex, FILTER_GROUPS)
+
+    def compiled_checker(prompt):
+        return engine.scan(prompt)[0]
+
+    mismatches = sum(1 for prompt in corpus if legacy_checker(prompt) != compiled_checker(prompt))
+    legacy_time = time_checker(legacy_checker, corpus, bench_args.repeat)
+    compiled_time = time_checker(compiled_checker, corpus, bench_args.repeat)
+    suspicious = sum(1 for prompt in corpus if compiled_checker(prompt) > 0)
+    print(f"{len(corpus)} prompts ({suspicious} suspicious), {bench_args.filter_size} alternatives per filter")
+    print(f"legacy:   {legacy_time * 1e6 / len(corpus):8.1f} us/prompt")
+    print(f"compiled: {compiled_time * 1e6 / len(corpus):8.1f} us/prompt")
+    print(f"speedup:  {legacy_time / compiled_time:8.2f}x")
+    print(f"suspicion mismatches: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
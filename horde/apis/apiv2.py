@@ -5,6 +5,7 @@
 from flask import Blueprint
 from flask_restx import Api
 
+from horde.apis.serializers import output_json
 from horde.apis.v2 import api as v2
 from horde.consts import HORDE_API_VERSION
 from horde.vars import horde_contact_email, horde_title
@@ -21,4 +22,5 @@ api = Api(
     ordered=True,
 )
 
+api.representation("application/json")(output_json)
 api.add_namespace(v2)
@@ -2,26 +2,59 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import time
 from datetime import datetime, timedelta
 
 from flask import request
 
 from horde.consts import WHITELISTED_SERVICE_IPS
+from horde.horde_redis import horde_redis as hr
 from horde.utils import hash_api_key
 
 
 class DynamicIPWhitelist:
     # Marks IPs to dynamically whitelist for 1 day
     # Those IPs will have lower limits during API calls
-    whitelisted_ips = {}
+    # The whitelist is kept in redis, so that all horde nodes agree on it
+    whitelist_duration = timedelta(days=1)
+    # How long each node trusts its own knowledge of an IP before asking redis again
+    local_ttl = 60
+
+    def __init__(self):
+        self.whitelisted_ips = {}
+        self.local_cache = {}
+
+    def get_cache_name(self, ipaddr):
+        return f"ip_whitelist_{ipaddr}"
+
+    def cache_locally(self, ipaddr, is_whitelisted):
+        if len(self.local_cache) > 50000:
+            now = time.monotonic()
+            self.local_cache = {k: v for k, v in self.local_cache.items() if v[1] > now}
+        self.local_cache[ipaddr] = (is_whitelisted, time.monotonic() + self.local_ttl)
 
     def whitelist_ip(self, ipaddr):
-        self.whitelisted_ips[ipaddr] = datetime.now() + timedelta(days=1)
+        if not hr.horde_r:
+            self.whitelisted_ips[ipaddr] = datetime.now() + self.whitelist_duration
+            return
+        # Whitelisted users generate a lot, so we avoid refreshing the redis key on every request
+        entry = self.local_cache.get(ipaddr)
+        if entry is not None and entry[0] and time.monotonic() < entry[1]:
+            return
+        hr.horde_r_setex(self.get_cache_name(ipaddr), self.whitelist_duration, 1)
+        self.cache_locally(ipaddr, True)
 
     def is_ip_whitelisted(self, ipaddr):
-        if ipaddr not in self.whitelisted_ips:
-            return False
-        return self.whitelisted_ips[ipaddr] > datetime.now()
+        if not hr.horde_r:
+            if ipaddr not in self.whitelisted_ips:
+                return False
+            return self.whitelisted_ips[ipaddr] > datetime.now()
+        entry = self.local_cache.get(ipaddr)
+        if entry is not None and time.monotonic() < entry[1]:
+            return entry[0]
+        is_whitelisted = hr.horde_r_get(self.get_cache_name(ipaddr)) is not None
+        self.cache_locally(ipaddr, is_whitelisted)
+        return is_whitelisted
 
 
 dynamic_ip_whitelist = DynamicIPWhitelist()
@@ -61,3 +94,54 @@ def get_request_limit_per_apikey():
     if apikey == "0000000000":
         return "60/second"
     return "2/second"
+
+
+LIMIT_PERIODS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 60 * 60,
+    "day": 60 * 60 * 24,
+}
+
+
+class RateLimit:
+    """A token bucket limit for the token_limiter.
+    limit is a string like "90/minute", or a function which returns one for the current request.
+    The bucket holds that many tokens and refills at that rate, so unlike fixed windows,
+    it never allows double the amount around the edge of a window.
+    """
+
+    def __init__(self, name, limit, key_func):
+        self.name = name
+        self.limit = limit
+        self.key_func = key_func
+        self.parsed_limits = {}
+
+    def parse_limit(self, limit):
+        parsed_limit = self.parsed_limits.get(limit)
+        if parsed_limit is None:
+            amount, period = limit.split("/")
+            amount = int(amount)
+            parsed_limit = (int(LIMIT_PERIODS[period] * 1000000 / amount), amount)
+            self.parsed_limits[limit] = parsed_limit
+        return parsed_limit
+
+    def get_bucket(self):
+        """Returns the (key, interval, capacity) of the bucket this request has to pass"""
+        limit = self.limit() if callable(self.limit) else self.limit
+        interval, capacity = self.parse_limit(limit)
+        return (f"tb_{self.name}_{self.key_func()}", interval, capacity)
+
+
+# The token bucket limits of each endpoint
+GENERATE_LIMITS = (
+    RateLimit("generate_ip_minute", get_request_90min_limit_per_ip, get_request_path),
+    RateLimit("generate_ip_second", get_request_2sec_limit_per_ip, get_request_path),
+    RateLimit("generate_apikey", get_request_limit_per_apikey, get_request_api_key),
+)
+JOB_POP_LIMITS = (RateLimit("job_pop", "60/second", get_request_path),)
+JOB_SUBMIT_LIMITS = (RateLimit("job_submit", "60/second", get_request_path),)
+KUDOS_TRANSFER_LIMITS = (
+    RateLimit("kudos_transfer_second", "1/second", get_request_api_key),
+    RateLimit("kudos_transfer_hour", get_request_90hour_limit_per_ip, get_request_api_key),
+)
@@ -813,6 +813,19 @@ class Models:
             },
         )
 
+        self.response_model_message_details = api.inherit(
+            "ResponseModelMessageDetails",
+            self.response_model_message_full,
+            {
+                "deliveries": fields.Integer(
+                    description="How many workers this message has been delivered to.",
+                ),
+                "acknowledgements": fields.Integer(
+                    description="How many workers have acknowledged this message.",
+                ),
+            },
+        )
+
         self.response_model_worker_details = api.inherit(
             "WorkerDetails",
             self.response_model_worker_details_lite,
@@ -1900,6 +1913,18 @@ class Models:
                 ),
             },
         )
+        self.input_model_message_acknowledge = api.model(
+            "MessageAcknowledge",
+            {
+                "worker_id": fields.String(
+                    description="The ID of the worker which has seen this message.",
+                    example="00000000-0000-0000-0000-000000000000",
+                    required=True,
+                    min_length=36,
+                    max_length=36,
+                ),
+            },
+        )
 
         # Styles
         self.response_model_styles_post = api.model(
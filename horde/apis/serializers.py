@@ -0,0 +1,279 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import threading
+from functools import wraps
+from http import HTTPStatus
+
+import orjson
+from flask import current_app, has_app_context, make_response, request
+from flask_restx import Namespace, fields, marshal
+from flask_restx.utils import unpack
+
+from horde.logger import logger
+
+# The field types we can output without going through their output() method
+# mapped to the python type their value already has when no formatting is needed.
+# We compare exact types throughout, as flask-restx might format subclasses differently.
+FAST_FIELD_TYPES = {
+    fields.String: str,
+    fields.Integer: int,
+    fields.Float: float,
+    fields.Boolean: bool,
+}
+
+
+def _get_field_key(key, field):
+    """Returns the dict key this field reads from,
+    or None if flask-restx would do something we don't replicate for it
+    """
+    field_key = key if field.attribute is None else field.attribute
+    if not isinstance(field_key, str) or "." in field_key:
+        return None
+    # flask-restx falls back to getattr() for missing keys, which would find the dict's own methods
+    if hasattr({}, field_key):
+        return None
+    return field_key
+
+
+_NO_CONSTANT = object()
+
+
+def _get_none_value(field, none_value):
+    """Returns what the field outputs for a missing value, or _NO_CONSTANT if that can change between calls"""
+    if callable(field.default):
+        return _NO_CONSTANT
+    try:
+        return none_value(field)
+    except Exception:
+        return _NO_CONSTANT
+
+
+class CompiledModel:
+    """Serializes dicts with the same output as flask_restx.marshal(), without walking the fields for every object.
+    Each field is compiled once into a getter specialized for its type.
+    Any value the getters don't expect is passed to the field's own output(), so the result never differs.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.model_fields = getattr(model, "resolved", model)
+        self.getters = None
+        # Masked or wildcard models are rare, so we let flask-restx handle them entirely
+        if getattr(model, "__mask__", None) or any(isinstance(f, fields.Wildcard) for f in self.model_fields.values()):
+            return
+        self.getters = [(key, self.compile_field(key, field)) for key, field in self.model_fields.items()]
+
+    def compile_field(self, key, field):
+        if isinstance(field, dict):
+            # An inline model reads from the same object as its parent
+            def get_inline(data):
+                return compiled_models.get(field).serialize(data)
+
+            return get_inline
+        if isinstance(field, type):
+            field = field()
+        field_key = _get_field_key(key, field)
+        if field_key is None or field.mask:
+            return self.compile_fallback(key, field)
+        field_type = type(field)
+        if field_type in FAST_FIELD_TYPES:
+            return self.compile_typed(key, field, field_key, FAST_FIELD_TYPES[field_type])
+        if field_type is fields.Raw:
+            return self.compile_raw(key, field, field_key)
+        if field_type is fields.Nested and not field.as_list:
+            return self.compile_nested(key, field, field_key)
+        if field_type is fields.List:
+            return self.compile_list(key, field, field_key)
+        return self.compile_fallback(key, field)
+
+    def compile_fallback(self, key, field):
+        def get(data):
+            return field.output(key, data)
+
+        return get
+
+    def compile_typed(self, key, field, field_key, value_type):
+        none_value = _get_none_value(field, lambda f: f.format(f.default) if f.default else f.default)
+
+        def get(data):
+            value = data.get(field_key)
+            if type(value) is value_type:
+                return value
+            if value is None and none_value is not _NO_CONSTANT:
+                return none_value
+            return field.output(key, data)
+
+        return get
+
+    def compile_raw(self, key, field, field_key):
+        none_value = _get_none_value(field, lambda f: f.format(f.default) if f.default else f.default)
+
+        def get(data):
+            value = data.get(field_key)
+            if value is not None:
+                return value
+            if none_value is not _NO_CONSTANT:
+                return none_value
+            return field.output(key, data)
+
+        return get
+
+    def compile_nested(self, key, field, field_key):
+        # Nested models are compiled on first use, as models can refer to themselves
+        nested_model = field.nested
+        skip_none = field.skip_none
+
+        def get(data):
+            value = data.get(field_key)
+            if type(value) is dict:  # noqa: E721
+                return compiled_models.get(nested_model).serialize(value, skip_none)
+            return field.output(key, data)
+
+        return get
+
+    def compile_list(self, key, field, field_key):
+        container = field.container
+        container_type = type(container)
+        if container.mask or container.attribute is not None:
+            return self.compile_fallback(key, field)
+        none_value = _get_none_value(field, lambda f: f.default)
+        if container_type is fields.Nested and not container.as_list:
+            nested_model = container.nested
+            skip_none = container.skip_none
+
+            def get(data):
+                value = data.get(field_key)
+                if type(value) is list and all(type(item) is dict for item in value):  # noqa: E721
+                    nested = compiled_models.get(nested_model)
+                    return [nested.serialize(item, skip_none) for item in value]
+                if value is None and none_value is not _NO_CONSTANT:
+                    return none_value
+                return field.output(key, data)
+
+            return get
+        if container_type in FAST_FIELD_TYPES or container_type is fields.Raw:
+            item_type = FAST_FIELD_TYPES.get(container_type)
+
+            def get(data):
+                value = data.get(field_key)
+                if type(value) is list:  # noqa: E721
+                    if item_type is None:
+                        if all(item is not None for item in value):
+                            return list(value)
+                    elif all(type(item) is item_type for item in value):
+                        return list(value)
+                elif value is None and none_value is not _NO_CONSTANT:
+                    return none_value
+                return field.output(key, data)
+
+            return get
+        return self.compile_fallback(key, field)
+
+    def serialize(self, data, skip_none=False):
+        if self.getters is None:
+            return marshal(data, self.model, skip_none=skip_none)
+        if type(data) is not dict:  # noqa: E721
+            if isinstance(data, (list, tuple)):
+                return [self.serialize(item, skip_none) for item in data]
+            return marshal(data, self.model, skip_none=skip_none)
+        if skip_none:
+            ret_dict = {}
+            for key, get in self.getters:
+                value = get(data)
+                if value is not None and value != {}:
+                    ret_dict[key] = value
+            return ret_dict
+        return {key: get(data) for key, get in self.getters}
+
+
+class CompiledModels:
+    """Keeps one CompiledModel per model definition"""
+
+    def __init__(self):
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    def get(self, model):
+        compiled_model = self.compiled.get(id(model))
+        if compiled_model is not None:
+            return compiled_model
+        with self.lock:
+            compiled_model = self.compiled.get(id(model))
+            if compiled_model is None:
+                compiled_model = CompiledModel(model)
+                # We keep a reference to the model, so that its id can't be reused
+                self.compiled[id(model)] = compiled_model
+        return compiled_model
+
+
+compiled_models = CompiledModels()
+
+
+class compiled_marshal_with:  # noqa: N801
+    """A drop-in replacement for flask_restx.marshal_with, which serializes through the compiled models
+    Requests asking for a field mask are still marshalled by flask-restx.
+    """
+
+    def __init__(self, fields, envelope=None, skip_none=False, mask=None, ordered=False):
+        self.fields = fields
+        self.envelope = envelope
+        self.skip_none = skip_none
+        self.mask = mask
+        self.ordered = ordered
+
+    def marshal(self, data):
+        mask = self.mask
+        if has_app_context():
+            mask = request.headers.get(current_app.config["RESTX_MASK_HEADER"]) or mask
+        if mask or self.envelope or self.ordered:
+            return marshal(data, self.fields, self.envelope, self.skip_none, mask, self.ordered)
+        return compiled_models.get(self.fields).serialize(data, self.skip_none)
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            resp = f(*args, **kwargs)
+            if isinstance(resp, tuple):
+                data, code, headers = unpack(resp)
+                return (self.marshal(data), code, headers)
+            return self.marshal(resp)
+
+        return wrapper
+
+
+class CompiledNamespace(Namespace):
+    """A Namespace which marshals responses through the compiled models.
+    The documentation of each endpoint is generated exactly as before.
+    """
+
+    def marshal_with(self, fields, as_list=False, code=HTTPStatus.OK, description=None, **kwargs):
+        document = super().marshal_with(fields, as_list=as_list, code=code, description=description, **kwargs)
+
+        def wrapper(func):
+            # We only use the flask-restx decorator to register the documentation on the function
+            document(func)
+            return compiled_marshal_with(fields, ordered=self.ordered, **kwargs)(func)
+
+        return wrapper
+
+
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body, using orjson when it can encode the data"""
+    settings = current_app.config.get("RESTX_JSON", {})
+    dumped = None
+    if not settings and not current_app.debug:
+        try:
+            dumped = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError as err:
+            logger.debug(f"orjson could not encode response. Falling back to json: {err}")
+    if dumped is None:
+        settings = dict(settings)
+        if current_app.debug:
+            settings.setdefault("indent", 4)
+        dumped = json.dumps(data, **settings) + "\n"
+    resp = make_response(dumped, code)
+    resp.headers.extend(headers or {})
+    return resp
@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import brotli
+import orjson
+from flask import Response, current_app, request
+from flask_restx.utils import unpack
+
+# How many distinct snapshot bodies each node keeps encoded and compressed
+SNAPSHOT_CACHE_SIZE = int(os.getenv("HORDE_SNAPSHOT_CACHE_SIZE", 32))
+# Bodies smaller than this are not worth compressing
+SNAPSHOT_COMPRESS_MIN_BYTES = 1024
+
+
+class SnapshotBody:
+    """A JSON response body, along with its ETag and its compressed variants.
+    Each compressed variant is built the first time a client asks for it, and then reused.
+    """
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.variants = {"identity": body}
+        self.lock = threading.Lock()
+
+    def get_variant(self, encoding):
+        variant = self.variants.get(encoding)
+        if variant is not None:
+            return variant
+        with self.lock:
+            variant = self.variants.get(encoding)
+            if variant is None:
+                if encoding == "br":
+                    variant = brotli.compress(self.body, quality=5)
+                else:
+                    variant = gzip.compress(self.body, compresslevel=6)
+                self.variants[encoding] = variant
+        return variant
+
+
+class SnapshotBodies:
+    """Keeps the most recent snapshot bodies of this node, by ETag and by snapshot version.
+    The versions only point to the ETag of their body, so they never keep alive a body which was evicted.
+    """
+
+    def __init__(self, max_entries=SNAPSHOT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.bodies = OrderedDict()
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_body(self, data):
+        try:
+            body = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            body = (json.dumps(data) + "\n").encode()
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        with self.lock:
+            snapshot_body = self.bodies.get(etag)
+            if snapshot_body is not None:
+                self.bodies.move_to_end(etag)
+                return snapshot_body
+            snapshot_body = SnapshotBody(body, etag)
+            self.bodies[etag] = snapshot_body
+            if len(self.bodies) > self.max_entries:
+                self.bodies.popitem(last=False)
+        return snapshot_body
+
+    def get_versioned_body(self, version_key):
+        with self.lock:
+            etag = self.versions.get(version_key)
+            if etag is None:
+                return None
+            snapshot_body = self.bodies.get(etag)
+            if snapshot_body is None:
+                del self.versions[version_key]
+            else:
+                self.bodies.move_to_end(etag)
+            return snapshot_body
+
+    def set_versioned_body(self, version_key, snapshot_body):
+        with self.lock:
+            self.versions[version_key] = snapshot_body.etag
+            # Each version has a few variants, depending on the query and the requesting key
+            if len(self.versions) > self.max_entries * 8:
+                self.versions.popitem(last=False)
+
+
+snapshot_bodies = SnapshotBodies()
+
+
+def get_accepted_encoding(snapshot_body):
+    if len(snapshot_body.body) < SNAPSHOT_COMPRESS_MIN_BYTES:
+        return "identity"
+    accept_encoding = request.accept_encodings
+    if accept_encoding["br"]:
+        return "br"
+    if accept_encoding["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def make_snapshot_response(snapshot_body, headers=None):
+    if request.if_none_match.contains_weak(snapshot_body.etag):
+        response = Response(status=304)
+    else:
+        encoding = get_accepted_encoding(snapshot_body)
+        response = Response(snapshot_body.get_variant(encoding), status=200, mimetype="application/json")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.headers.extend(headers or {})
+    response.set_etag(snapshot_body.etag, weak=True)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def snapshot_response(get_version=None):
+    """Decorator for GET endpoints which serve periodically rebuilt snapshots.
+    It encodes the marshalled response once per distinct content and serves it with an ETag,
+    so that polling clients get a 304 when nothing changed, and compressed bodies are built only once.
+    If get_version is provided, it should return a token which changes whenever the snapshot is rebuilt.
+    As long as it does not change, the endpoint is not called again for the same request, field mask and API key.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            version_key = None
+            if get_version is not None:
+                version = get_version()
+                if version is not None:
+                    apikey = request.headers.get("apikey")
+                    apikey_hash = hashlib.sha256(apikey.encode()).hexdigest() if apikey else None
+                    # The field mask changes what gets marshalled, so each mask gets its own body
+                    fields_mask = request.headers.get(current_app.config.get("RESTX_MASK_HEADER", "X-Fields"))
+                    version_key = (request.path, request.query_string, fields_mask, apikey_hash, version)
+                    snapshot_body = snapshot_bodies.get_versioned_body(version_key)
+                    if snapshot_body is not None:
+                        return make_snapshot_response(snapshot_body)
+            resp = f(*args, **kwargs)
+            if isinstance(resp, Response):
+                return resp
+            data, code, headers = unpack(resp)
+            if code != 200:
+                return resp
+            snapshot_body = snapshot_bodies.get_body(data)
+            if version_key is not None:
+                snapshot_bodies.set_versioned_body(version_key, snapshot_body)
+            return make_snapshot_response(snapshot_body, headers)
+
+        return wrapper
+
+    return decorator
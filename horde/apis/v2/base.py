@@ -9,7 +9,7 @@ from datetime import datetime, timedelta
 
 import regex as re
 from flask import render_template, request
-from flask_restx import Namespace, Resource, reqparse
+from flask_restx import Resource, reqparse
 from flask_restx.reqparse import ParseResult
 from markdownify import markdownify
 from sqlalchemy import or_, text
@@ -19,7 +19,10 @@ import horde.apis.limiter_api as lim
 import horde.classes.base.stats as stats
 from horde import exceptions as e
 from horde.apis.models.v2 import Models, Parsers
+from horde.apis.serializers import CompiledNamespace
+from horde.apis.snapshots import snapshot_response
 from horde.argparser import args
+from horde.cached_query import get_cached_query_stats
 from horde.classes.base import settings
 from horde.classes.base.detection import Filter
 from horde.classes.base.news import News
@@ -28,25 +31,28 @@ from horde.classes.base.user import User, UserSharedKey
 from horde.classes.base.waiting_prompt import WaitingPrompt
 from horde.classes.base.worker import Worker, WorkerMessage
 from horde.consts import HORDE_VERSION
-from horde.countermeasures import CounterMeasures
+from horde.countermeasures import CounterMeasures, ip_reputation
 from horde.database import functions as database
 from horde.detection import prompt_checker
+from horde.evidence import evidence_queue
 from horde.flask import HORDE, cache, db
 from horde.horde_redis import horde_redis as hr
 from horde.image import ensure_source_image_uploaded
-from horde.limiter import limiter
+from horde.ip_reputation import IPReputationPending
+from horde.limiter import limiter, token_limiter
 from horde.logger import logger
 from horde.metrics import waitress_metrics
 from horde.patreon import patrons
-from horde.r2 import upload_prompt
 from horde.suspicions import Suspicions
 from horde.utils import hash_api_key, hash_dictionary, is_profane, sanitize_string
 from horde.vars import horde_contact_email, horde_title, horde_url
+from horde.worker_messages import worker_messages
 
 # Not used yet
 authorizations = {"apikey": {"type": "apiKey", "in": "header", "name": "apikey"}}
 
-api = Namespace("v2", "API Version 2")
+# Responses are serialized through precompiled models, instead of walking the fields for every object
+api = CompiledNamespace("v2", "API Version 2")
 
 models = Models(api)
 parsers = Parsers()
@@ -98,6 +104,7 @@ handle_no_valid_workers = api.errorhandler(e.NoValidWorkers)(e.handle_bad_reques
 handle_no_valid_actions = api.errorhandler(e.NoValidActions)(e.handle_bad_requests)
 handle_maintenance_mode = api.errorhandler(e.MaintenanceMode)(e.handle_bad_requests)
 locked = api.errorhandler(e.Locked)(e.handle_bad_requests)
+handle_rate_limit_exceeded = api.errorhandler(e.RateLimitExceeded)(e.handle_rate_limit_exceeded)
 
 
 def check_for_mod(api_key, operation, whitelisted_users=None):
@@ -207,6 +214,9 @@ class GenerateTemplate(Resource):
             # logger.warning(datetime.utcnow())
             if not self.user:
                 raise e.InvalidAPIKey("generation")
+            # The IP is only checked during raids, after the rest of the validation, so we start the lookup early
+            if self.gentype == "image" and settings.mode_raid() and not self.user.trusted and not patrons.is_patron(self.user.id):
+                CounterMeasures.prefetch_ip_safety(self.user_ip)
             if not self.user.service and self.args["proxied_account"]:
                 raise e.BadRequest(message="Only service accounts can provide a proxied_account value.", rc="OnlyServiceAccountProxy")
             if self.args.extra_source_images is not None and len(self.args.extra_source_images) > 0:
@@ -237,8 +247,9 @@ class GenerateTemplate(Resource):
                 )
                 # logger.warning(datetime.utcnow())
             if len(self.workers):
+                worker_entries = database.get_worker_directory_entries(self.workers)
                 for worker_id in self.workers:
-                    if not database.worker_exists(worker_id):
+                    if worker_entries[worker_id] is None:
                         raise e.WorkerNotFound(worker_id)
             # logger.warning(datetime.utcnow())
             n = 1
@@ -287,7 +298,7 @@ class GenerateTemplate(Resource):
                             "user": self.username,
                             "type": "regex",
                         }
-                        upload_prompt(prompt_dict)
+                        evidence_queue.submit(prompt_dict)
                         self.user.report_suspicion(1, Suspicions.CORRUPT_PROMPT)
                         CounterMeasures.report_suspicion(self.user_ip)
                     raise e.CorruptPrompt(self.username, self.user_ip, self.prompt)
@@ -490,7 +501,7 @@ class JobPopTemplate(Resource):
                 if not wp.needs_gen():  # this says if < 1
                     continue
                 worker_ret = self.start_worker(wp)
-                worker_ret["messages"] = database.get_all_active_worker_messages(self.worker.id)
+                worker_ret["messages"] = worker_messages.get_messages(self.worker.id)
                 # logger.debug(worker_ret)
                 if worker_ret is None:
                     continue
@@ -504,7 +515,7 @@ class JobPopTemplate(Resource):
         if self.worker.maintenance:
             raise e.WorkerMaintenance(self.worker.maintenance_msg)
         # logger.debug(self.skipped)
-        return {"id": None, "ids": [], "skipped": self.skipped, "messages": database.get_all_active_worker_messages(self.worker.id)}, 200
+        return {"id": None, "ids": [], "skipped": self.skipped, "messages": worker_messages.get_messages(self.worker.id)}, 200
 
     def get_sorted_wp(self, priority_user_ids=None):
         """Extendable class to retrieve the sorted WP list for this worker"""
@@ -539,7 +550,8 @@ class JobPopTemplate(Resource):
     # We split this into its own function, so that it may be overriden and extended
     def validate(self):
         self.skipped = {}
-        self.user = database.find_user_by_api_key(self.args["apikey"])
+        # Most pops are from existing workers, so we only load the user from the DB when creating one
+        self.user = database.find_principal_by_api_key(self.args["apikey"])
         if not self.user:
             raise e.InvalidAPIKey("prompt pop")
         if self.user.flagged:
@@ -559,31 +571,34 @@ class JobPopTemplate(Resource):
                 raise e.Profanity(self.user.get_unique_alias(), self.worker_name, "worker name", rc="ProfaneWorkerName")
             if is_profane(self.args.bridge_agent):
                 raise e.Profanity(self.user.get_unique_alias(), self.args.bridge_agent, "bridge agent", rc="ProfaneBridgeAgent")
+            user = database.get_principal_user(self.user)
+            if not user:
+                raise e.InvalidAPIKey("prompt pop")
             colab_search = re.compile(r"colab|tpu|google", re.IGNORECASE)
             cs = colab_search.search(self.worker_name)
             if cs:
                 raise e.BadRequest(
                     f"To avoid unwanted attention, please do not use '{cs.group()}' in your worker names.",
                 )
-            worker_count = self.user.count_workers()
-            if settings.mode_invite_only() and worker_count >= self.user.worker_invited:
+            worker_count = user.count_workers()
+            if settings.mode_invite_only() and worker_count >= user.worker_invited:
                 raise e.WorkerInviteOnly(worker_count)
             # Untrusted users can only have 3 workers
             if not self.user.trusted and worker_count > 3:
                 raise e.Forbidden("To avoid abuse, untrusted users can only have up to 3 distinct workers.")
             # Trusted users can have up to 20 workers by default unless overriden
-            if worker_count > 20 and worker_count > self.user.worker_invited:
+            if worker_count > 20 and worker_count > user.worker_invited:
                 raise e.Forbidden(
                     "To avoid abuse, tou cannot onboard more than 20 workers as a trusted user. Please contact us on Discord to adjust.",
                 )
-            if self.user.exceeding_ipaddr_restrictions(self.worker_ip):
-                raise e.TooManySameIPs(self.user.username)
+            if user.exceeding_ipaddr_restrictions(self.worker_ip):
+                raise e.TooManySameIPs(user.username)
             self.worker = self.worker_class(
                 user_id=self.user.id,
                 name=self.worker_name,
             )
             self.worker.create()
-        if self.user != self.worker.user:
+        if self.user.id != self.worker.user_id:
             raise e.WrongCredentials(self.user.get_unique_alias(), self.worker_name)
 
     def check_ip(self):
@@ -592,7 +607,10 @@ class JobPopTemplate(Resource):
             raise e.TimeoutIP(self.worker_ip, ip_timeout, connect_type="Worker")
         self.safe_ip = True
         if not self.user.trusted and not self.user.vpn and not patrons.is_patron(self.user.id):
-            self.safe_ip = CounterMeasures.is_ip_safe(self.worker_ip)
+            try:
+                self.safe_ip = CounterMeasures.is_ip_safe(self.worker_ip)
+            except IPReputationPending as err:
+                raise e.TooManyNewIPs(self.worker_ip) from err
             if self.safe_ip is None:
                 raise e.TooManyNewIPs(self.worker_ip)
             if self.safe_ip is False:
@@ -630,10 +648,10 @@ class JobSubmitTemplate(Resource):
         self.procgen = self.get_progen()
         if not self.procgen:
             raise e.InvalidJobID(self.args["id"])
-        self.user = database.find_user_by_api_key(self.args["apikey"])
+        self.user = database.find_principal_by_api_key(self.args["apikey"])
         if not self.user:
             raise e.InvalidAPIKey("worker submit:" + self.args["name"])
-        if self.user != self.procgen.worker.user:
+        if self.user.id != self.procgen.worker.user_id:
             raise e.WrongCredentials(self.user.get_unique_alias(), self.procgen.worker.name)
         self.set_generation()
         if self.kudos == 0 and not self.procgen.worker.maintenance:
@@ -681,13 +699,7 @@ class TransferKudos(Resource):
         location="json",
     )
 
-    decorators = [
-        limiter.limit("1/second", key_func=lim.get_request_api_key),
-        limiter.limit(
-            limit_value=lim.get_request_90hour_limit_per_ip,
-            key_func=lim.get_request_api_key,
-        ),
-    ]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.KUDOS_TRANSFER_LIMITS)]
 
     @api.expect(parser)
     @api.marshal_with(models.response_model_kudos_transfer, code=200, description="Kudos Transferred")
@@ -807,6 +819,7 @@ class Workers(Resource):
     @api.expect(get_parser)
     @logger.catch(reraise=True)
     # @cache.cached(timeout=10, query_string=True)
+    @snapshot_response(get_version=lambda: hr.horde_r_get("worker_cache_version"))
     @api.marshal_with(
         models.response_model_worker_details,
         code=200,
@@ -823,7 +836,7 @@ class Workers(Resource):
     def retrieve_workers_details(self):
         details_privilege = 0
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args["apikey"])
+            admin = database.find_principal_by_api_key(self.args["apikey"])
             if admin and admin.moderator:
                 details_privilege = 2
         if not hr.horde_r:
@@ -843,10 +856,10 @@ class Workers(Resource):
         return self.parse_worker_by_query(json.loads(cached_workers))
 
     def get_worker_info_list(self, details_privilege):
-        workers_ret = []
-        for worker in database.get_active_workers():
-            workers_ret.append(worker.get_details(details_privilege))
-        return workers_ret
+        serialized_workers, serialized_workers_privileged = database.get_active_worker_snapshots()
+        if details_privilege >= 2:
+            return serialized_workers_privileged
+        return serialized_workers
 
     def parse_worker_by_query(self, workers_list):
         if self.args.name:
@@ -862,7 +875,7 @@ class WorkerSingleBase(Resource):
         cache_exists = True
         details_privilege = 0
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args["apikey"])
+            admin = database.find_principal_by_api_key(self.args["apikey"])
             if admin and admin.moderator:
                 details_privilege = 2
         if not hr.horde_r:
@@ -1267,7 +1280,7 @@ class UserSingle(Resource):
         self.args = self.get_parser.parse_args()
         details_privilege = 0
         if self.args.apikey:
-            resolved_user = database.find_user_by_api_key(self.args["apikey"])
+            resolved_user = database.find_principal_by_api_key(self.args["apikey"])
             if not resolved_user:
                 raise e.InvalidAPIKey("User action: " + "GET UserSingle")
             if resolved_user.moderator:
@@ -1675,6 +1688,7 @@ class Models(Resource):
         location="args",
     )
 
+    @snapshot_response()
     @cache.cached(timeout=2, query_string=True)
     @api.expect(get_parser)
     @api.response(400, "Validation Error", models.response_model_error)
@@ -1814,14 +1828,14 @@ class HordeModes(Resource):
         """Horde Maintenance Mode Status
         Use this endpoint to quicky determine if this horde is in maintenance, invite_only or raid mode.
         """
-        cfg = settings.get_settings()
+        cfg = settings.settings_cache.get_snapshot()
         ret_dict = {
             "maintenance_mode": cfg.maintenance,
             "invite_only_mode": cfg.invite_only,
         }
         self.args = self.get_parser.parse_args()
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args["apikey"])
+            admin = database.find_principal_by_api_key(self.args["apikey"])
             if not admin:
                 raise e.InvalidAPIKey("admin worker details")
             if not admin.moderator:
@@ -1906,6 +1920,7 @@ class HordeModes(Resource):
             raise e.NoValidActions("No mod change selected!", rc="NoHordeModSelected")
         else:
             db.session.commit()
+            settings.notify_settings_change()
         return (ret_dict, 200)
 
 
@@ -1922,6 +1937,7 @@ class Teams(Resource):
 
     # decorators = [limiter.limit("20/minute")]
     @logger.catch(reraise=True)
+    @snapshot_response()
     @cache.cached(timeout=10)
     @api.expect(get_parser)
     @api.marshal_with(
@@ -2039,7 +2055,7 @@ class TeamSingle(Resource):
         details_privilege = 0
         self.args = self.get_parser.parse_args()
         if self.args.apikey:
-            admin = database.find_user_by_api_key(self.args["apikey"])
+            admin = database.find_principal_by_api_key(self.args["apikey"])
             if not admin:
                 raise e.InvalidAPIKey("admin team details")
             if not admin.moderator:
@@ -2753,6 +2769,11 @@ class Heartbeat(Resource):
             "threads": waitress_metrics.threads,
             "active_count": waitress_metrics.active_count,
             "db_connection": db_conn,
+            "prompt_verdict_cache": prompt_checker.verdict_cache.get_stats(),
+            "ip_reputation": ip_reputation.get_stats(),
+            "cached_queries": get_cached_query_stats(),
+            "evidence_queue": evidence_queue.get_stats(),
+            "worker_messages": worker_messages.get_stats(),
         }, 200
 
 
@@ -3317,6 +3338,7 @@ class WorkerMessages(Resource):
         )
         db.session.add(new_message)
         db.session.commit()
+        worker_messages.notify_change()
         return new_message, 200
 
 
@@ -3334,7 +3356,7 @@ class SingleWorkerMessage(Resource):
     @cache.cached(timeout=60)
     @api.expect(get_parser)
     @api.marshal_with(
-        models.response_model_message_full,
+        models.response_model_message_details,
         code=200,
         description="Worker Message Details",
         skip_none=True,
@@ -3345,7 +3367,60 @@ class SingleWorkerMessage(Resource):
         wmessage = db.session.query(WorkerMessage).filter_by(id=message_id).first()
         if not wmessage:
             raise e.ThingNotFound("WorkerMessage", message_id)
-        return wmessage, 200
+        return {
+            "id": wmessage.id,
+            "worker_id": wmessage.worker_id,
+            "user_id": wmessage.user_id,
+            "message": wmessage.message,
+            "origin": wmessage.origin,
+            "expiry": wmessage.expiry,
+            "created": wmessage.created,
+            **worker_messages.get_tracking(wmessage.id),
+        }, 200
+
+    put_parser = reqparse.RequestParser()
+    put_parser.add_argument("apikey", type=str, required=True, help="User API key.", location="headers")
+    put_parser.add_argument(
+        "Client-Agent",
+        default="unknown:0:unknown",
+        type=str,
+        required=False,
+        help="The client name and version.",
+        location="headers",
+    )
+    put_parser.add_argument(
+        "worker_id",
+        required=True,
+        type=str,
+        help="The ID of the worker which has seen this message.",
+        location="json",
+    )
+
+    @api.expect(put_parser, models.input_model_message_acknowledge, validate=True)
+    @api.marshal_with(
+        models.response_model_simple_response,
+        code=200,
+        description="Acknowledge Worker Message",
+    )
+    @api.response(401, "Invalid API Key", models.response_model_error)
+    @api.response(403, "Forbidden", models.response_model_error)
+    @api.response(404, "Message Not Found", models.response_model_error)
+    def put(self, message_id=""):
+        """Acknowledge a Worker Message
+        Lets the horde know that the worker has seen this message.
+        """
+        self.args = self.put_parser.parse_args()
+        user = database.find_user_by_api_key(self.args["apikey"])
+        if not user:
+            raise e.InvalidAPIKey("WorkerMessages PUT")
+        worker = database.find_worker_by_id(self.args.worker_id)
+        if not worker:
+            raise e.WorkerNotFound(self.args.worker_id)
+        if worker.user_id != user.id:
+            raise e.Forbidden("You can only acknowledge messages for your own workers.", rc="MessagesOnlyOwnWorkers")
+        if not worker_messages.acknowledge(message_id, worker.id):
+            raise e.ThingNotFound("WorkerMessage", message_id)
+        return {"message": "OK"}, 200
 
     delete_parser = reqparse.RequestParser()
     delete_parser.add_argument("apikey", type=str, required=True, help="User API key.", location="headers")
@@ -3377,4 +3452,5 @@ class SingleWorkerMessage(Resource):
             raise e.Forbidden("You can only delete your own messages.")
         db.session.delete(wmessage)
         db.session.commit()
+        worker_messages.notify_change()
         return {"message": "OK"}, 200
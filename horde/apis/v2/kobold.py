@@ -12,6 +12,7 @@ from flask_restx import Resource, reqparse
 import horde.apis.limiter_api as lim
 from horde import exceptions as e
 from horde.apis.models.kobold_v2 import TextModels, TextParsers
+from horde.apis.snapshots import snapshot_response
 from horde.apis.v2.base import (
     GenerateTemplate,
     JobPopTemplate,
@@ -29,7 +30,7 @@ from horde.classes.kobold.worker import TextWorker
 from horde.database import functions as database
 from horde.database import text_functions as text_database
 from horde.flask import cache, db
-from horde.limiter import limiter
+from horde.limiter import limiter, token_limiter
 from horde.logger import logger
 from horde.model_reference import model_reference
 from horde.utils import hash_dictionary
@@ -42,17 +43,7 @@ parsers = TextParsers()
 
 class TextAsyncGenerate(GenerateTemplate):
     gentype = "text"
-    decorators = [
-        limiter.limit(
-            limit_value=lim.get_request_90min_limit_per_ip,
-            key_func=lim.get_request_path,
-        ),
-        limiter.limit(limit_value=lim.get_request_2sec_limit_per_ip, key_func=lim.get_request_path),
-        limiter.limit(
-            limit_value=lim.get_request_limit_per_apikey,
-            key_func=lim.get_request_api_key,
-        ),
-    ]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.GENERATE_LIMITS)]
 
     @api.expect(parsers.generate_parser, models.input_model_request_generation, validate=True)
     @api.marshal_with(
@@ -302,7 +293,7 @@ class TextAsyncStatus(Resource):
 
 class TextJobPop(JobPopTemplate):
     worker_class = TextWorker
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_POP_LIMITS)]
 
     @api.expect(parsers.job_pop_parser, models.input_model_job_pop, validate=True)
     @api.marshal_with(models.response_model_job_pop, code=200, description="Generation Popped")
@@ -347,7 +338,7 @@ class TextJobPop(JobPopTemplate):
 
 
 class TextJobSubmit(JobSubmitTemplate):
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_SUBMIT_LIMITS)]
 
     @api.expect(parsers.job_submit_parser, models.input_model_job_submit, validate=True)
     @api.marshal_with(models.response_model_job_submit, code=200, description="Generation Submitted")
@@ -380,6 +371,7 @@ class TextHordeStatsTotals(Resource):
     )
 
     @logger.catch(reraise=True)
+    @snapshot_response()
     @cache.cached(timeout=50)
     @api.expect(get_parser)
     @api.marshal_with(
@@ -406,6 +398,7 @@ class TextHordeStatsModels(Resource):
     )
 
     @logger.catch(reraise=True)
+    @snapshot_response()
     @cache.cached(timeout=50)
     @api.expect(get_parser)
     @api.marshal_with(
@@ -7,6 +7,7 @@ from flask_restx import reqparse
 
 import horde.apis.limiter_api as lim
 from horde import exceptions as e
+from horde.apis.snapshots import snapshot_response
 from horde.apis.v2.kobold import models, parsers
 from horde.apis.v2.styles import (
     SingleStyleTemplate,
@@ -68,6 +69,7 @@ class TextStyle(StyleTemplate):
     )
 
     @logger.catch(reraise=True)
+    @snapshot_response()
     @cache.cached(timeout=1, query_string=True)
     @api.expect(get_parser)
     @api.marshal_with(
@@ -16,6 +16,7 @@ import horde.apis.limiter_api as lim
 import horde.classes.base.stats as stats
 from horde import exceptions as e
 from horde.apis.models.stable_v2 import ImageModels, ImageParsers
+from horde.apis.snapshots import snapshot_response
 from horde.apis.v2.base import (
     GenerateTemplate,
     JobPopTemplate,
@@ -33,14 +34,17 @@ from horde.classes.stable.interrogation import Interrogation
 from horde.classes.stable.interrogation_worker import InterrogationWorker
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.stable.worker import ImageWorker
+from horde.consts import KNOWN_POST_PROCESSORS
 from horde.countermeasures import CounterMeasures
 from horde.database import functions as database
 from horde.enums import WarningMessage
 from horde.flask import HORDE, cache, db
 from horde.image import calculate_image_tiles, ensure_source_image_uploaded
-from horde.limiter import limiter
+from horde.ip_reputation import IPReputationPending
+from horde.limiter import limiter, token_limiter
 from horde.model_reference import model_reference
 from horde.patreon import patrons
+from horde.r2 import generate_procgen_upload_urls
 from horde.utils import does_extra_text_reference_exist, hash_dictionary
 from horde.validation import ParamValidator
 from horde.vars import horde_title
@@ -52,17 +56,7 @@ parsers = ImageParsers()
 class ImageAsyncGenerate(GenerateTemplate):
     gentype = "image"
 
-    decorators = [
-        limiter.limit(
-            limit_value=lim.get_request_90min_limit_per_ip,
-            key_func=lim.get_request_path,
-        ),
-        limiter.limit(limit_value=lim.get_request_2sec_limit_per_ip, key_func=lim.get_request_path),
-        limiter.limit(
-            limit_value=lim.get_request_limit_per_apikey,
-            key_func=lim.get_request_api_key,
-        ),
-    ]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.GENERATE_LIMITS)]
 
     @api.expect(parsers.generate_parser, models.input_model_request_generation, validate=True)
     @api.marshal_with(
@@ -122,8 +116,12 @@ class ImageAsyncGenerate(GenerateTemplate):
         param_validator.check_for_special()
         # During raids, we prevent VPNs
         if settings.mode_raid() and not self.user.trusted and not patrons.is_patron(self.user.id):
-            self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
-            # We allow unsafe IPs when being rate limited as they're only temporary
+            try:
+                self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
+            except IPReputationPending as err:
+                # We don't let unchecked IPs through, so they have to come back once the check finished
+                raise e.IPCheckPending(self.user_ip) from err
+            # We allow unsafe IPs when the IP checker fails or rate limits us as they're only temporary
             if self.safe_ip is None:
                 self.safe_ip = True
             # We actually block unsafe IPs for now to combat CP
@@ -340,9 +338,7 @@ class ImageAsyncGenerate(GenerateTemplate):
                     self.source_mask_r2stored,
                 ) = ensure_source_image_uploaded(self.args.source_mask, f"{self.wp.id}_msk", force_r2=True)
             elif self.args.source_processing == "inpainting":
-                try:
-                    _red, _green, _blue, _alpha = img.split()
-                except ValueError:
+                if len(img.getbands()) != 4:
                     raise e.ImageValidationFailed(
                         "Inpainting requests must either include a mask, or an alpha channel.",
                         rc="InpaintingMissingMask",
@@ -557,7 +553,7 @@ class ImageAsyncCheck(Resource):
 class ImageJobPop(JobPopTemplate):
     worker_class = ImageWorker
 
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_POP_LIMITS)]
 
     @api.expect(parsers.job_pop_parser, models.input_model_job_pop, validate=True)
     @api.marshal_with(models.response_model_job_pop, code=200, description="Generation Popped")
@@ -631,7 +627,7 @@ class ImageJobPop(JobPopTemplate):
 
 
 class ImageJobSubmit(JobSubmitTemplate):
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_SUBMIT_LIMITS)]
 
     @api.expect(parsers.job_submit_parser, models.input_model_job_submit, validate=True)
     @api.marshal_with(models.response_model_job_submit, code=200, description="Generation Submitted")
@@ -905,6 +901,7 @@ class Interrogate(Resource):
             self.source_image, img, self.r2stored = ensure_source_image_uploaded(
                 self.args.source_image,
                 str(self.interrogation.id),
+                hash_pixels=True,
             )
             self.image_tiles = calculate_image_tiles(img)
             if self.image_tiles > 255:
@@ -917,7 +914,7 @@ class Interrogate(Resource):
             db.session.delete(self.interrogation)
             db.session.commit()
             raise err
-        self.interrogation.set_source_image(self.source_image, self.r2stored, self.image_tiles)
+        self.interrogation.set_source_image(self.source_image, self.r2stored, self.image_tiles, img.get_pixel_hash())
         self.interrogation.set_forms(self.forms)
         ret_dict = {"id": self.interrogation.id}
         return (ret_dict, 202)
@@ -940,8 +937,12 @@ class Interrogate(Resource):
             if i_count + len(self.forms) > user_limit:
                 raise e.TooManyPrompts(self.username, i_count + len(self.forms), user_limit)
         if settings.mode_raid() and not self.user.trusted and not patrons.is_patron(self.user.id):
-            self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
-            # We allow unsafe IPs when being rate limited as they're only temporary
+            try:
+                self.safe_ip = CounterMeasures.is_ip_safe(self.user_ip)
+            except IPReputationPending as err:
+                # We don't let unchecked IPs through, so they have to come back once the check finished
+                raise e.IPCheckPending(self.user_ip) from err
+            # We allow unsafe IPs when the IP checker fails or rate limits us as they're only temporary
             if self.safe_ip is None:
                 self.safe_ip = True
             # We actually block unsafe IPs for now to combat CP
@@ -1087,7 +1088,7 @@ class InterrogatePop(JobPopTemplate):
         location="json",
     )
 
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_POP_LIMITS)]
 
     @api.expect(post_parser, models.input_model_interrogation_pop, validate=True)
     @api.marshal_with(
@@ -1148,6 +1149,7 @@ class InterrogatePop(JobPopTemplate):
                 self.prioritized_forms.append(form)
         # logger.warning(datetime.utcnow())
         worker_ret = {"forms": []}
+        claimable_forms = []
         for form in self.prioritized_forms:
             try:
                 can_interrogate, skipped_reason = self.worker.can_interrogate(form)
@@ -1161,23 +1163,17 @@ class InterrogatePop(JobPopTemplate):
                     self.skipped[skipped_reason] = self.skipped.get(skipped_reason, 0) + 1
                 # logger.warning(datetime.utcnow())
                 continue
-            # There is a chance that by the time we finished all the checks, another worker picked up the WP.
-            # So we do another final check here before picking it up to avoid sending the same WP to two workers by mistake.
-            # time.sleep(random.uniform(0, 1))
-            if not form.is_waiting():
-                continue
-            try:
-                form_ret = form.pop(self.worker)
-            except Exception as err:
-                logger.error(f"Error when popping interrogation. Skipping: {err}.")
-                continue
-            # logger.debug(worker_ret)
-            if form_ret is None:
-                continue
-            worker_ret["forms"].append(form_ret)
-            if len(worker_ret["forms"]) >= self.args.amount:
-                # logger.debug(worker_ret)
-                return (worker_ret, 200)
+            claimable_forms.append(form)
+            # We claim all the forms we need in one go. If another worker picked some of them up in the meantime
+            # we keep looking for more.
+            if len(claimable_forms) >= self.args.amount - len(worker_ret["forms"]):
+                self.claim_forms(claimable_forms, worker_ret)
+                claimable_forms = []
+                if len(worker_ret["forms"]) >= self.args.amount:
+                    # logger.debug(worker_ret)
+                    return (worker_ret, 200)
+        if len(claimable_forms) > 0:
+            self.claim_forms(claimable_forms, worker_ret)
         if len(worker_ret["forms"]) >= 1:
             # logger.debug(worker_ret)
             return (worker_ret, 200)
@@ -1187,6 +1183,23 @@ class InterrogatePop(JobPopTemplate):
         # logger.warning(datetime.utcnow())
         return ({"skipped": self.skipped}, 200)
 
+    def claim_forms(self, claimable_forms, worker_ret):
+        try:
+            claimed_forms = database.claim_interrogation_forms(
+                self.worker,
+                claimable_forms,
+                self.args.amount - len(worker_ret["forms"]),
+            )
+        except Exception as err:
+            logger.error(f"Error when popping interrogations. Skipping: {err}.")
+            db.session.rollback()
+            return
+        pp_form_ids = [str(form.id) for form in claimed_forms if form.name in KNOWN_POST_PROCESSORS]
+        r2_uploads = dict(zip(pp_form_ids, generate_procgen_upload_urls(pp_form_ids, False)))
+        for form in claimed_forms:
+            worker_ret["forms"].append(form.get_pop_payload(r2_uploads.get(str(form.id))))
+        db.session.commit()
+
     def check_in(self):
         self.worker.check_in(
             max_tiles=self.args.max_tiles,
@@ -1200,7 +1213,7 @@ class InterrogatePop(JobPopTemplate):
 
 
 class InterrogateSubmit(Resource):
-    decorators = [limiter.limit("60/second")]
+    decorators = [limiter.exempt, token_limiter.limit(*lim.JOB_SUBMIT_LIMITS)]
 
     post_parser = reqparse.RequestParser()
     post_parser.add_argument(
@@ -1264,10 +1277,10 @@ class InterrogateSubmit(Resource):
         self.form = database.get_form_by_id(self.args["id"])
         if not self.form:
             raise e.InvalidJobID(self.args["id"])
-        self.user = database.find_user_by_api_key(self.args["apikey"])
+        self.user = database.find_principal_by_api_key(self.args["apikey"])
         if not self.user:
             raise e.InvalidAPIKey("worker submit:" + self.args["name"])
-        if self.user != self.form.worker.user:
+        if self.user.id != self.form.worker.user_id:
             raise e.WrongCredentials(self.user.get_unique_alias(), self.form.worker.name)
 
 
@@ -1283,6 +1296,7 @@ class ImageHordeStatsTotals(Resource):
     )
 
     @logger.catch(reraise=True)
+    @snapshot_response()
     @cache.cached(timeout=50)
     @api.expect(get_parser)
     @api.marshal_with(
@@ -1321,6 +1335,7 @@ class ImageHordeStatsModels(Resource):
     )
 
     @logger.catch(reraise=True)
+    @snapshot_response()
     # @cache.cached(timeout=50, query_string=True)
     @api.expect(get_parser)
     @api.response(400, "Validation Error", models.response_model_error)
@@ -6,6 +6,7 @@ from flask_restx import Resource, reqparse
 
 import horde.apis.limiter_api as lim
 from horde import exceptions as e
+from horde.apis.snapshots import snapshot_response
 from horde.apis.v2.stable import models, parsers
 from horde.apis.v2.styles import (
     SingleStyleTemplate,
@@ -66,6 +67,7 @@ class ImageStyle(StyleTemplate):
         location="args",
     )
 
+    @snapshot_response()
     @cache.cached(timeout=30, query_string=True)
     @api.expect(get_parser)
     @api.marshal_with(
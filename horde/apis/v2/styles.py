@@ -146,6 +146,7 @@ class SingleStyleTemplate(SingleStyleTemplateGet):
         db.session.commit()
         self.existing_style.set_models(self.models)
         self.existing_style.set_tags(self.tags)
+        self.user.refresh_cache()
         return {
             "id": self.existing_style.id,
             "message": "OK",
@@ -78,6 +78,11 @@ arg_parser.add_argument(
     action="store_true",
     help="If set, will reload the patreon db and run the monthly awards",
 )
+arg_parser.add_argument(
+    "--recompute_lifetime_totals",
+    action="store_true",
+    help="If set, will verify the lifetime contribution totals against the existing workers, correct them and exit",
+)
 arg_parser.add_argument("--disable_filters", action="store_true", help="Testing filter work")
 arg_parser.add_argument(
     "--force_patreon",
@@ -0,0 +1,151 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+
+from horde.enums import UserRoleTypes
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+# How long each horde node trusts its own copy of a principal before asking redis again.
+# Explicit invalidations only reach the other nodes' local copies after this long.
+PRINCIPAL_LOCAL_TTL = int(os.getenv("HORDE_PRINCIPAL_LOCAL_TTL", 10))
+PRINCIPAL_REDIS_TTL = int(os.getenv("HORDE_PRINCIPAL_REDIS_TTL", 300))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("HORDE_PRINCIPAL_CACHE_SIZE", 50000))
+
+
+class ApiKeyPrincipal:
+    """The lightweight and immutable identity an API key resolves to.
+    It carries what most endpoints need to authorize a request without loading the User.
+    The kudos are only a snapshot from when the principal was cached, so they should never be used for accounting.
+    """
+
+    __slots__ = ("api_key", "user_id", "username", "oauth_id", "roles", "kudos")
+
+    def __init__(self, api_key, user_id, username, oauth_id, roles, kudos):
+        object.__setattr__(self, "api_key", api_key)
+        object.__setattr__(self, "user_id", user_id)
+        object.__setattr__(self, "username", username)
+        object.__setattr__(self, "oauth_id", oauth_id)
+        object.__setattr__(self, "roles", frozenset(roles))
+        object.__setattr__(self, "kudos", kudos)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("API key principals are immutable")
+
+    @classmethod
+    def from_user(cls, user, roles):
+        """roles is an iterable of the UserRoleTypes names the user currently has"""
+        return cls(user.api_key, user.id, user.username, user.oauth_id, roles, user.kudos)
+
+    @classmethod
+    def from_dict(cls, principal_dict):
+        return cls(**principal_dict)
+
+    def to_dict(self):
+        return {
+            "api_key": self.api_key,
+            "user_id": self.user_id,
+            "username": self.username,
+            "oauth_id": self.oauth_id,
+            "roles": sorted(self.roles),
+            "kudos": self.kudos,
+        }
+
+    def has_role(self, role):
+        return role.name in self.roles
+
+    @property
+    def id(self):
+        return self.user_id
+
+    @property
+    def moderator(self):
+        return self.has_role(UserRoleTypes.MODERATOR)
+
+    @property
+    def trusted(self):
+        return self.has_role(UserRoleTypes.TRUSTED)
+
+    @property
+    def flagged(self):
+        return self.has_role(UserRoleTypes.FLAGGED)
+
+    @property
+    def customizer(self):
+        return self.has_role(UserRoleTypes.CUSTOMIZER)
+
+    @property
+    def vpn(self):
+        return self.has_role(UserRoleTypes.VPN)
+
+    def is_anon(self):
+        return self.oauth_id == "anon"
+
+    def get_unique_alias(self):
+        return f"{self.username}#{self.user_id}"
+
+
+class PrincipalCache:
+    """Caches the principal of each hashed API key in this process and in redis.
+    Anything which changes what a principal contains has to call invalidate()
+    """
+
+    def __init__(self, local_ttl=PRINCIPAL_LOCAL_TTL, redis_ttl=PRINCIPAL_REDIS_TTL, max_entries=PRINCIPAL_CACHE_SIZE):
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.max_entries = max_entries
+        self.principals = {}
+        self.lock = threading.Lock()
+
+    def get_cache_name(self, hashed_api_key):
+        return f"apikey_principal_{hashed_api_key}"
+
+    def get(self, hashed_api_key):
+        """Returns the cached principal for this hashed API key, or None if we need to look it up in the DB"""
+        entry = self.principals.get(hashed_api_key)
+        if entry is not None:
+            principal, valid_until = entry
+            if time.monotonic() < valid_until:
+                return principal
+        if not hr.horde_r:
+            return None
+        cached_principal = hr.horde_r_get(self.get_cache_name(hashed_api_key))
+        if not cached_principal:
+            return None
+        try:
+            principal = ApiKeyPrincipal.from_dict(json.loads(cached_principal))
+        except (TypeError, ValueError) as err:
+            logger.warning(f"Could not load cached principal: {err}")
+            return None
+        self.store_local(principal)
+        return principal
+
+    def store_local(self, principal):
+        with self.lock:
+            if len(self.principals) >= self.max_entries:
+                now = time.monotonic()
+                self.principals = {k: v for k, v in self.principals.items() if v[1] > now}
+                if len(self.principals) >= self.max_entries:
+                    self.principals = dict(list(self.principals.items())[self.max_entries // 2 :])
+            self.principals[principal.api_key] = (principal, time.monotonic() + self.local_ttl)
+
+    def store(self, principal):
+        self.store_local(principal)
+        if hr.horde_r:
+            hr.horde_r_setex_json(self.get_cache_name(principal.api_key), timedelta(seconds=self.redis_ttl), principal.to_dict())
+        return principal
+
+    def invalidate(self, hashed_api_key):
+        with self.lock:
+            self.principals.pop(hashed_api_key, None)
+        if hr.horde_r:
+            hr.horde_r_delete(self.get_cache_name(hashed_api_key))
+
+
+principal_cache = PrincipalCache()
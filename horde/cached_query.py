@@ -0,0 +1,242 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+from functools import wraps
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+# How long a cache miss waits for another node which is already computing the same value, before computing it itself
+CACHED_QUERY_WAIT = float(os.getenv("HORDE_CACHED_QUERY_WAIT", 2))
+CACHED_QUERY_POLL_INTERVAL = 0.05
+# How many locks the keys of each cached query share, to compute each of them once per node
+CACHED_QUERY_LOCK_STRIPES = 64
+# How many values each cached query keeps in this process when redis is not available
+CACHED_QUERY_LOCAL_SIZE = 10000
+
+cached_queries = {}
+
+
+class CachedQueryStats:
+    def __init__(self):
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.computes = 0
+        self.errors = 0
+        self.compute_time = 0
+        self.max_compute_time = 0
+        self.lock = threading.Lock()
+
+    def record(self, stat):
+        with self.lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    def record_compute(self, compute_time):
+        with self.lock:
+            self.computes += 1
+            self.compute_time += compute_time
+            self.max_compute_time = max(self.max_compute_time, compute_time)
+
+    def to_dict(self):
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "computes": self.computes,
+            "errors": self.errors,
+            "avg_compute_time": round(self.compute_time / self.computes, 3) if self.computes else 0,
+            "max_compute_time": round(self.max_compute_time, 3),
+        }
+
+
+class CachedQuery:
+    """Caches the results of an expensive function in redis, and makes sure each one is computed only once at a time.
+
+    Each value is fresh for about ttl seconds, with some jitter so that keys stored together don't expire together.
+    After that it's still served for stale_ttl seconds while a single caller across the horde refreshes it.
+    When there's no value at all, a single caller computes it and the others wait for its result.
+    Values need to be JSON serializable.
+    """
+
+    def __init__(self, name, compute, ttl, stale_ttl=0, jitter=0.1, key_func=None, cache_if=None, lock_timeout=30):
+        self.name = name
+        self.compute = compute
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.jitter = jitter
+        self.key_func = key_func
+        self.cache_if = cache_if
+        self.lock_timeout = lock_timeout
+        self.local_entries = {}
+        self.key_locks = [threading.Lock() for _ in range(CACHED_QUERY_LOCK_STRIPES)]
+        self.stats = CachedQueryStats()
+        cached_queries[name] = self
+
+    def get_cache_key(self, *args, **kwargs):
+        if self.key_func is not None:
+            key_suffix = self.key_func(*args, **kwargs)
+        else:
+            key_suffix = "_".join(str(arg) for arg in [*args, *kwargs.values()])
+        if key_suffix == "":
+            return f"cached_query_{self.name}"
+        return f"cached_query_{self.name}_{key_suffix}"
+
+    def get_key_lock(self, cache_key):
+        return self.key_locks[hash(cache_key) % CACHED_QUERY_LOCK_STRIPES]
+
+    def read_entry(self, cache_key):
+        """Returns the cached value and until when it's fresh, or None if there's no value"""
+        if not hr.horde_r:
+            entry = self.local_entries.get(cache_key)
+            if entry is None or entry[2] < time.time():
+                return None
+            return entry[0], entry[1]
+        try:
+            cached_entry = hr.horde_r_get(cache_key)
+            if cached_entry is None:
+                return None
+            cached_entry = json.loads(cached_entry)
+            return cached_entry["value"], cached_entry["fresh_until"]
+        except Exception as err:
+            logger.warning(f"Could not read cached query {cache_key}: {err}")
+            return None
+
+    def write_entry(self, cache_key, value):
+        ttl = self.ttl * random.uniform(1 - self.jitter, 1 + self.jitter)
+        fresh_until = time.time() + ttl
+        if not hr.horde_r:
+            if len(self.local_entries) >= CACHED_QUERY_LOCAL_SIZE:
+                now = time.time()
+                self.local_entries = {k: v for k, v in self.local_entries.items() if v[2] >= now}
+                if len(self.local_entries) >= CACHED_QUERY_LOCAL_SIZE:
+                    self.local_entries = {}
+            self.local_entries[cache_key] = (value, fresh_until, fresh_until + self.stale_ttl)
+            return
+        try:
+            hr.horde_r_setex(
+                cache_key,
+                timedelta(seconds=ttl + self.stale_ttl),
+                json.dumps({"value": value, "fresh_until": fresh_until}),
+            )
+        except Exception as err:
+            logger.warning(f"Could not store cached query {cache_key}: {err}")
+
+    def acquire_compute_lock(self, cache_key):
+        """Returns a lock token if this caller should compute the value,
+        or None if another node is already computing it
+        """
+        token = uuid.uuid4().hex
+        if not hr.horde_r:
+            return token
+        try:
+            if hr.horde_r.set(f"{cache_key}_lock", token, nx=True, px=int(self.lock_timeout * 1000)):
+                return token
+            return None
+        except Exception as err:
+            logger.warning(f"Could not lock cached query {cache_key}: {err}")
+            return token
+
+    def release_compute_lock(self, cache_key, token):
+        if not hr.horde_r:
+            return
+        try:
+            lock_key = f"{cache_key}_lock"
+            if hr.horde_r.get(lock_key) in (token, token.encode()):
+                hr.horde_r.delete(lock_key)
+        except Exception as err:
+            logger.warning(f"Could not unlock cached query {cache_key}: {err}")
+
+    def wait_for_entry(self, cache_key):
+        wait_until = time.monotonic() + CACHED_QUERY_WAIT
+        while time.monotonic() < wait_until:
+            time.sleep(CACHED_QUERY_POLL_INTERVAL)
+            entry = self.read_entry(cache_key)
+            if entry is not None:
+                return entry
+        return None
+
+    def compute_and_store(self, cache_key, args, kwargs, token=None):
+        start = time.monotonic()
+        try:
+            value = self.compute(*args, **kwargs)
+        except Exception:
+            self.stats.record("errors")
+            raise
+        finally:
+            if token is not None:
+                self.release_compute_lock(cache_key, token)
+        self.stats.record_compute(time.monotonic() - start)
+        if self.cache_if is None or self.cache_if(value):
+            self.write_entry(cache_key, value)
+        return value
+
+    def get(self, *args, **kwargs):
+        cache_key = self.get_cache_key(*args, **kwargs)
+        entry = self.read_entry(cache_key)
+        if entry is not None and entry[1] > time.time():
+            self.stats.record("hits")
+            return entry[0]
+        key_lock = self.get_key_lock(cache_key)
+        if entry is not None:
+            # Whoever is already refreshing the value in this node or another one, we don't wait for them
+            if not key_lock.acquire(blocking=False):
+                self.stats.record("stale_hits")
+                return entry[0]
+            try:
+                token = self.acquire_compute_lock(cache_key)
+                if token is None:
+                    self.stats.record("stale_hits")
+                    return entry[0]
+                return self.compute_and_store(cache_key, args, kwargs, token)
+            finally:
+                key_lock.release()
+        with key_lock:
+            # Another thread of this node might have computed it while we waited for the lock
+            entry = self.read_entry(cache_key)
+            if entry is not None:
+                self.stats.record("hits")
+                return entry[0]
+            self.stats.record("misses")
+            token = self.acquire_compute_lock(cache_key)
+            if token is None:
+                entry = self.wait_for_entry(cache_key)
+                if entry is not None:
+                    return entry[0]
+                # The node computing it is taking too long, so we compute it as well
+            return self.compute_and_store(cache_key, args, kwargs, token)
+
+    def refresh(self, *args, **kwargs):
+        """Computes and stores the value right away. For threads which keep the value fresh."""
+        return self.compute_and_store(self.get_cache_key(*args, **kwargs), args, kwargs)
+
+    def get_stats(self):
+        return self.stats.to_dict()
+
+
+def cached_query(name, ttl, **kwargs):
+    """Decorator which serves the results of the function through a CachedQuery"""
+
+    def decorator(f):
+        query = CachedQuery(name, f, ttl, **kwargs)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            return query.get(*args, **kwargs)
+
+        wrapper.cached_query = query
+        return wrapper
+
+    return decorator
+
+
+def get_cached_query_stats():
+    return {name: query.get_stats() for name, query in cached_queries.items()}
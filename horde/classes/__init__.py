@@ -7,8 +7,10 @@ from pathlib import Path
 from sqlalchemy.sql import text
 
 import horde.classes.base.stats  # noqa 401
+import horde.classes.base.stats_rollups  # noqa 401
 from horde.argparser import args
 from horde.classes.base.detection import Filter  # noqa 401
+from horde.classes.base.lifetime_totals import seed_lifetime_totals
 from horde.classes.base.settings import HordeSettings
 from horde.classes.base.style import Style
 from horde.classes.base.team import Team  # noqa 401
@@ -90,6 +92,7 @@ with HORDE.app_context():
         settings = HordeSettings()
         db.session.add(settings)
         db.session.commit()
+    seed_lifetime_totals()
 
 __all__ = [
     "ImageProcessingGeneration",
@@ -0,0 +1,167 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import random
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from horde import vars as hv
+from horde.flask import db
+from horde.logger import logger
+
+# Each worker type is counted on this many rows, so that concurrent contributions rarely wait on the same row lock
+LIFETIME_TOTALS_SHARDS = 16
+LIFETIME_TOTALS_WORKER_TYPES = ("image", "text", "interrogation")
+
+
+class LifetimeTotal(db.Model):
+    """The contributions and fulfilments of all the workers of a type, since the start of the horde.
+    These only ever grow, so the contributions of deleted workers are kept as well.
+    """
+
+    __tablename__ = "lifetime_totals"
+    wtype = db.Column(db.String(20), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    # We count raw things, as they are integers, to not lose any fraction of a converted contribution
+    raw_things = db.Column(db.BigInteger, default=0, nullable=False)
+    fulfilments = db.Column(db.BigInteger, default=0, nullable=False)
+
+
+def record_lifetime_contribution(wtype, raw_things):
+    """Adds a fulfilment to the lifetime totals of this worker type.
+    It's applied along with the rest of the contribution, when the session is committed.
+    The shard rows have to exist already. The 4.47.0 migration creates them, and new hordes seed them on startup.
+    """
+    db.session.query(LifetimeTotal).filter_by(
+        wtype=wtype,
+        shard=random.randrange(LIFETIME_TOTALS_SHARDS),
+    ).update(
+        {
+            LifetimeTotal.raw_things: LifetimeTotal.raw_things + int(raw_things),
+            LifetimeTotal.fulfilments: LifetimeTotal.fulfilments + 1,
+        },
+        synchronize_session=False,
+    )
+
+
+def get_lifetime_totals():
+    """Returns the raw things and fulfilments of each worker type
+    Returns None if the lifetime totals have not been seeded yet
+    """
+    results = (
+        db.session.query(
+            LifetimeTotal.wtype,
+            func.sum(LifetimeTotal.raw_things),
+            func.sum(LifetimeTotal.fulfilments),
+        )
+        .group_by(LifetimeTotal.wtype)
+        .all()
+    )
+    if not results:
+        return None
+    lifetime_totals = {wtype: (0, 0) for wtype in LIFETIME_TOTALS_WORKER_TYPES}
+    for wtype, raw_things, fulfilments in results:
+        lifetime_totals[wtype] = (int(raw_things or 0), int(fulfilments or 0))
+    return lifetime_totals
+
+
+def compute_worker_totals():
+    """Sums the raw things and fulfilments of each worker type from the existing workers.
+    This reads every worker, so it's only meant for seeding and verifying the lifetime totals.
+    """
+    from horde.classes.kobold.worker import TextWorker
+    from horde.classes.stable.interrogation_worker import InterrogationWorker
+    from horde.classes.stable.worker import ImageWorker
+
+    worker_totals = {}
+    for wtype, worker_class in (("image", ImageWorker), ("text", TextWorker), ("interrogation", InterrogationWorker)):
+        contributions, fulfilments = db.session.query(
+            func.sum(worker_class.contributions),
+            func.sum(worker_class.fulfilments),
+        ).first()
+        worker_totals[wtype] = (
+            int((contributions or 0) * hv.thing_divisors[wtype]),
+            int(fulfilments or 0),
+        )
+    return worker_totals
+
+
+def set_lifetime_totals(lifetime_totals):
+    """Stores the provided raw things and fulfilments of each worker type as the initial lifetime totals"""
+    for wtype in LIFETIME_TOTALS_WORKER_TYPES:
+        raw_things, fulfilments = lifetime_totals.get(wtype, (0, 0))
+        for shard in range(LIFETIME_TOTALS_SHARDS):
+            db.session.add(
+                LifetimeTotal(
+                    wtype=wtype,
+                    shard=shard,
+                    raw_things=raw_things if shard == 0 else 0,
+                    fulfilments=fulfilments if shard == 0 else 0,
+                ),
+            )
+    db.session.commit()
+
+
+def seed_lifetime_totals():
+    """Seeds the lifetime totals from the existing workers, the first time the horde starts with them.
+    Existing hordes get them seeded by the 4.47.0 migration instead, so that they're recorded from the first deployed node.
+    """
+    if db.session.query(LifetimeTotal.wtype).first() is not None:
+        return
+    logger.info("Seeding the lifetime totals from the existing workers")
+    try:
+        set_lifetime_totals(compute_worker_totals())
+    except IntegrityError:
+        # Another node seeded them at the same time
+        db.session.rollback()
+
+
+def verify_lifetime_totals():
+    """Compares the lifetime totals with the sums of the existing workers.
+    The lifetime totals should never be lower, and are higher by the contributions of deleted workers.
+    Returns the difference of the raw things and fulfilments of each worker type
+    """
+    lifetime_totals = get_lifetime_totals() or {}
+    worker_totals = compute_worker_totals()
+    differences = {}
+    for wtype in LIFETIME_TOTALS_WORKER_TYPES:
+        raw_things, fulfilments = lifetime_totals.get(wtype, (0, 0))
+        worker_raw_things, worker_fulfilments = worker_totals[wtype]
+        differences[wtype] = (raw_things - worker_raw_things, fulfilments - worker_fulfilments)
+        logger.info(
+            f"Lifetime {wtype} totals: {raw_things} raw things and {fulfilments} fulfilments. "
+            f"Existing workers: {worker_raw_things} raw things and {worker_fulfilments} fulfilments.",
+        )
+    return differences
+
+
+def recompute_lifetime_totals():
+    """Raises any lifetime total which is lower than the sums of the existing workers to match them.
+    The totals which are higher are kept, as the existing workers don't include the deleted ones.
+    Returns the raw things and fulfilments which were added to each worker type
+    """
+    lifetime_totals = get_lifetime_totals()
+    if lifetime_totals is None:
+        seed_lifetime_totals()
+        return get_lifetime_totals()
+    worker_totals = compute_worker_totals()
+    corrections = {}
+    for wtype in LIFETIME_TOTALS_WORKER_TYPES:
+        raw_things, fulfilments = lifetime_totals[wtype]
+        worker_raw_things, worker_fulfilments = worker_totals[wtype]
+        corrections[wtype] = (max(worker_raw_things - raw_things, 0), max(worker_fulfilments - fulfilments, 0))
+        if corrections[wtype] == (0, 0):
+            continue
+        logger.warning(f"The lifetime {wtype} totals were lower than the sums of the existing workers. Correcting them.")
+        # We add the difference, instead of overwriting them, to not lose any contributions recorded meanwhile
+        db.session.query(LifetimeTotal).filter_by(wtype=wtype, shard=0).update(
+            {
+                LifetimeTotal.raw_things: LifetimeTotal.raw_things + corrections[wtype][0],
+                LifetimeTotal.fulfilments: LifetimeTotal.fulfilments + corrections[wtype][1],
+            },
+            synchronize_session=False,
+        )
+    db.session.commit()
+    return corrections
@@ -2,7 +2,17 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import os
+
 from horde.flask import db
+from horde.versioned_cache import VersionedCache
+
+# How often each horde node asks redis if the settings changed
+SETTINGS_CHECK_INTERVAL = float(os.getenv("HORDE_SETTINGS_CHECK_INTERVAL", 2))
+# How long each horde node can trust its settings without reloading them from the DB
+# Only matters when a change notification was missed, such as when redis is down.
+SETTINGS_MAX_STALENESS = float(os.getenv("HORDE_SETTINGS_MAX_STALENESS", 30))
+SETTINGS_VERSION_KEY = "horde_settings_version"
 
 
 class HordeSettings(db.Model):
@@ -15,20 +25,52 @@ class HordeSettings(db.Model):
     maintenance = db.Column(db.Boolean, default=False, nullable=False)
 
 
+class SettingsSnapshot:
+    """An immutable copy of the horde modes, as they were when loaded from the DB"""
+
+    __slots__ = ("raid", "invite_only", "maintenance")
+
+    def __init__(self, raid, invite_only, maintenance):
+        object.__setattr__(self, "raid", raid)
+        object.__setattr__(self, "invite_only", invite_only)
+        object.__setattr__(self, "maintenance", maintenance)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings snapshots are immutable")
+
+
+class SettingsCache(VersionedCache):
+    """Keeps the horde settings of this node in memory.
+    Whoever changes the settings has to call notify_change() after committing them.
+    """
+
+    def __init__(self, check_interval=SETTINGS_CHECK_INTERVAL, max_staleness=SETTINGS_MAX_STALENESS):
+        super().__init__(SETTINGS_VERSION_KEY, check_interval, max_staleness)
+
+    def load_snapshot(self):
+        query = db.session.query(HordeSettings.raid, HordeSettings.invite_only, HordeSettings.maintenance).first()
+        return SettingsSnapshot(query.raid, query.invite_only, query.maintenance)
+
+
+settings_cache = SettingsCache()
+
+
 def get_settings():
     return db.session.query(HordeSettings).first()
 
 
+def notify_settings_change():
+    """Needs to be called after committing any change to the horde settings"""
+    settings_cache.notify_change()
+
+
 def mode_raid():
-    query = db.session.query(HordeSettings.raid).first()
-    return query.raid
+    return settings_cache.get_snapshot().raid
 
 
 def mode_maintenance():
-    query = db.session.query(HordeSettings.maintenance).first()
-    return query.maintenance
+    return settings_cache.get_snapshot().maintenance
 
 
 def mode_invite_only():
-    query = db.session.query(HordeSettings.invite_only).first()
-    return query.invite_only
+    return settings_cache.get_snapshot().invite_only
@@ -0,0 +1,241 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+from datetime import datetime, timedelta
+from itertools import chain
+
+from sqlalchemy import UniqueConstraint, func
+
+from horde.flask import db
+from horde.logger import logger
+
+# How many new statistics we fold into the rollups per query
+ROLLUP_BATCH_SIZE = int(os.getenv("HORDE_STATS_ROLLUP_BATCH_SIZE", 50000))
+# How many batches a single compilation folds. Anything left is picked up on the next run.
+ROLLUP_MAX_BATCHES = int(os.getenv("HORDE_STATS_ROLLUP_MAX_BATCHES", 20))
+# Statistics are only folded up to an id which has been observed at least this long ago.
+# Ids are assigned before their statistics are committed, so a lower id can become visible after a higher one,
+# and no transaction recording statistics is expected to take this long.
+ROLLUP_SETTLE_DELAY = timedelta(seconds=int(os.getenv("HORDE_STATS_ROLLUP_SETTLE_DELAY", 300)))
+# Minute buckets are merged into hour buckets after this long
+MINUTE_BUCKET_RETENTION = timedelta(hours=25)
+# Hour buckets are merged into the total bucket after this long
+HOUR_BUCKET_RETENTION = timedelta(days=31)
+TOTAL_BUCKET = datetime(1970, 1, 1)
+# How long superseded compiled statistics are kept around
+COMPILED_TOTALS_RETENTION = timedelta(days=1)
+COMPILED_MODELS_RETENTION = timedelta(days=7)
+# The periods the compiled totals report, besides the total
+ROLLUP_PERIODS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "month": timedelta(days=30),
+}
+
+
+class GenerationStatsRollup(db.Model):
+    """The generations and their amount of work, aggregated per minute, per hour, or for everything older"""
+
+    __tablename__ = "gen_stats_rollups"
+    __table_args__ = (UniqueConstraint("stat_type", "granularity", "bucket", name="stat_type_granularity_bucket"),)
+    id = db.Column(db.Integer, primary_key=True)
+    stat_type = db.Column(db.String(10), nullable=False)
+    granularity = db.Column(db.String(10), nullable=False)
+    bucket = db.Column(db.DateTime(timezone=False), nullable=False)
+    count = db.Column(db.BigInteger, default=0, nullable=False)
+    amount = db.Column(db.BigInteger, default=0, nullable=False)
+
+
+class GenerationStatsRollupProgress(db.Model):
+    """The last statistic of each type which has been folded into the rollups"""
+
+    __tablename__ = "gen_stats_rollup_progress"
+    stat_type = db.Column(db.String(10), primary_key=True)
+    last_id = db.Column(db.BigInteger, default=0, nullable=False)
+    # The highest id seen by the last observation, and when it was made.
+    # Once ROLLUP_SETTLE_DELAY has passed, the statistics up to it are folded.
+    observed_id = db.Column(db.BigInteger, nullable=True)
+    observed_at = db.Column(db.DateTime(timezone=False), nullable=True)
+
+
+def floor_minute(dt):
+    return dt.replace(second=0, microsecond=0)
+
+
+def floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def get_bucket_cutoffs(now):
+    """Returns the times before which minute buckets become hour buckets and hour buckets become the total"""
+    return floor_hour(now - MINUTE_BUCKET_RETENTION), floor_hour(now - HOUR_BUCKET_RETENTION)
+
+
+def get_bucket(finished, minute_cutoff, hour_cutoff):
+    if finished is None or finished < hour_cutoff:
+        return "total", TOTAL_BUCKET
+    if finished < minute_cutoff:
+        return "hour", floor_hour(finished)
+    return "minute", floor_minute(finished)
+
+
+def add_to_buckets(stat_type, bucket_sums):
+    """Adds the counts and amounts of bucket_sums into the stored buckets
+    bucket_sums is a dict of (granularity, bucket) to [count, amount]
+    """
+    bucket_sums = dict(bucket_sums)
+    bucket_keys = list(bucket_sums)
+    # We look them up in chunks, to stay below the bound parameter limits of all DB backends
+    for chunk_start in range(0, len(bucket_keys), 400):
+        chunk = bucket_keys[chunk_start : chunk_start + 400]
+        existing_rollups = (
+            db.session.query(GenerationStatsRollup)
+            .filter(
+                GenerationStatsRollup.stat_type == stat_type,
+                GenerationStatsRollup.granularity.in_({granularity for granularity, _ in chunk}),
+                GenerationStatsRollup.bucket.in_({bucket for _, bucket in chunk}),
+            )
+            .all()
+        )
+        for rollup in existing_rollups:
+            sums = bucket_sums.pop((rollup.granularity, rollup.bucket), None)
+            if sums is None:
+                continue
+            rollup.count += sums[0]
+            rollup.amount += sums[1]
+    for (granularity, bucket), (count, amount) in bucket_sums.items():
+        db.session.add(
+            GenerationStatsRollup(
+                stat_type=stat_type,
+                granularity=granularity,
+                bucket=bucket,
+                count=count,
+                amount=amount,
+            ),
+        )
+    db.session.flush()
+
+
+def fold_statistics(stat_type, stat_model, amount_column, progress, fold_limit, now):
+    """Folds the statistics after the last folded one, up to fold_limit, into the rollup buckets
+    Returns True if all of them have been folded, or False if there's still a backlog
+    """
+    minute_cutoff, hour_cutoff = get_bucket_cutoffs(now)
+    for _ in range(ROLLUP_MAX_BATCHES):
+        new_statistics = (
+            db.session.query(stat_model.id, stat_model.finished, amount_column)
+            .filter(stat_model.id > progress.last_id, stat_model.id <= fold_limit)
+            .order_by(stat_model.id)
+            .limit(ROLLUP_BATCH_SIZE)
+            .all()
+        )
+        bucket_sums = {}
+        for _, finished, amount in new_statistics:
+            sums = bucket_sums.setdefault(get_bucket(finished, minute_cutoff, hour_cutoff), [0, 0])
+            sums[0] += 1
+            sums[1] += amount or 0
+        add_to_buckets(stat_type, bucket_sums)
+        if len(new_statistics) < ROLLUP_BATCH_SIZE:
+            progress.last_id = fold_limit
+            return True
+        progress.last_id = new_statistics[-1][0]
+    return False
+
+
+def fold_new_statistics(stat_type, stat_model, amount_column, now):
+    """Folds the statistics whose ids have settled into the rollup buckets, and observes the highest id for the next fold.
+    The statistics after the last folded one are not in the rollups yet, and have to be read with get_unfolded_statistics()
+    Returns True if all the settled statistics have been folded, or False if there's still a backlog
+    """
+    progress = db.session.query(GenerationStatsRollupProgress).filter_by(stat_type=stat_type).first()
+    if progress is None:
+        logger.warning(f"The {stat_type} statistics rollups have not been seeded. They will be folded from the start.")
+        progress = GenerationStatsRollupProgress(stat_type=stat_type, last_id=0)
+        db.session.add(progress)
+    if progress.observed_at is not None and progress.observed_at <= now - ROLLUP_SETTLE_DELAY:
+        if not fold_statistics(stat_type, stat_model, amount_column, progress, progress.observed_id, now):
+            return False
+        progress.observed_id = None
+    if progress.observed_id is None:
+        progress.observed_id = max(db.session.query(func.max(stat_model.id)).scalar() or 0, progress.last_id)
+        progress.observed_at = now
+    return True
+
+
+def get_unfolded_statistics(stat_type, stat_model, amount_column):
+    """Returns the finished time and amount of the statistics which are not in the rollups yet
+    These are the ones recorded since the last settled id, so at most a couple of settle delays worth.
+    Returns None if there are more than a batch of them, as the rollups are still catching up.
+    """
+    last_id = db.session.query(GenerationStatsRollupProgress.last_id).filter_by(stat_type=stat_type).scalar() or 0
+    unfolded_statistics = (
+        db.session.query(stat_model.finished, amount_column).filter(stat_model.id > last_id).limit(ROLLUP_BATCH_SIZE + 1).all()
+    )
+    if len(unfolded_statistics) > ROLLUP_BATCH_SIZE:
+        return None
+    return unfolded_statistics
+
+
+def compact_buckets(stat_type, now):
+    """Merges the minute buckets which are too old into hour buckets, and the hour buckets which are too old into the total"""
+    minute_cutoff, hour_cutoff = get_bucket_cutoffs(now)
+    for granularity, cutoff in (("minute", minute_cutoff), ("hour", hour_cutoff)):
+        old_rollups = (
+            db.session.query(GenerationStatsRollup)
+            .filter(
+                GenerationStatsRollup.stat_type == stat_type,
+                GenerationStatsRollup.granularity == granularity,
+                GenerationStatsRollup.bucket < cutoff,
+            )
+            .all()
+        )
+        bucket_sums = {}
+        for rollup in old_rollups:
+            sums = bucket_sums.setdefault(get_bucket(rollup.bucket, minute_cutoff, hour_cutoff), [0, 0])
+            sums[0] += rollup.count
+            sums[1] += rollup.amount
+            db.session.delete(rollup)
+        add_to_buckets(stat_type, bucket_sums)
+
+
+def sum_rollups(stat_type, unfolded_statistics, now):
+    """Sums the buckets and the unfolded statistics into the count and amount of each period, up to the last full minute
+    The month period is only accurate to the hour, as its older part is kept in hour buckets.
+    """
+    period_end = floor_minute(now)
+    totals = {period: [0, 0] for period in [*ROLLUP_PERIODS, "total"]}
+    rollups = db.session.query(
+        GenerationStatsRollup.bucket,
+        GenerationStatsRollup.count,
+        GenerationStatsRollup.amount,
+    ).filter(GenerationStatsRollup.stat_type == stat_type)
+    unfolded_sums = ((finished, 1, amount or 0) for finished, amount in unfolded_statistics)
+    for bucket, count, amount in chain(rollups.all(), unfolded_sums):
+        totals["total"][0] += count
+        totals["total"][1] += amount
+        if bucket is None or bucket >= period_end:
+            continue
+        for period, period_length in ROLLUP_PERIODS.items():
+            if bucket >= period_end - period_length:
+                totals[period][0] += count
+                totals[period][1] += amount
+    return totals
+
+
+def compile_stats_rollups(stat_type, stat_model, amount_column):
+    """Brings the rollups of this statistics type up to date and returns the count and amount of each period.
+    Each run only reads the statistics recorded since the last settled id, and a bounded number of buckets.
+    Returns None while the rollups are still catching up with the existing statistics.
+    """
+    now = datetime.utcnow()
+    caught_up = fold_new_statistics(stat_type, stat_model, amount_column, now)
+    compact_buckets(stat_type, now)
+    db.session.commit()
+    unfolded_statistics = get_unfolded_statistics(stat_type, stat_model, amount_column) if caught_up else None
+    if unfolded_statistics is None:
+        logger.info(f"The {stat_type} statistics rollups are still catching up")
+        return None
+    return sum_rollups(stat_type, unfolded_statistics, now)
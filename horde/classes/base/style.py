@@ -161,6 +161,8 @@ class Style(db.Model):
     def create(self):
         db.session.add(self)
         db.session.commit()
+        # The owner's details list their styles
+        self.user.refresh_cache()
 
     def set_name(self, new_name):
         if self.name == new_name:
@@ -177,8 +179,10 @@ class Style(db.Model):
         return "OK"
 
     def delete(self):
+        user = self.user
         db.session.delete(self)
         db.session.commit()
+        user.refresh_cache()
 
     def record_usage(self):
         self.uses += 1
@@ -8,11 +8,16 @@ from datetime import datetime, timedelta
 from typing import Optional
 
 import dateutil.relativedelta
-from sqlalchemy import Enum, UniqueConstraint
+from sqlalchemy import Enum, UniqueConstraint, event
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
 
 from horde import vars as hv
+from horde.auth import principal_cache
+from horde.classes.base.style import Style
+from horde.classes.base.waiting_prompt import WaitingPrompt
+from horde.classes.base.worker import Worker
 from horde.countermeasures import CounterMeasures
 from horde.discord import send_problem_user_notification
 from horde.enums import UserRecordTypes, UserRoleTypes
@@ -287,8 +292,7 @@ class User(db.Model):
 
     @hybrid_property
     def trusted(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.TRUSTED).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.TRUSTED)
 
     @trusted.expression
     def trusted(cls):
@@ -306,8 +310,7 @@ class User(db.Model):
 
     @hybrid_property
     def flagged(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.FLAGGED).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.FLAGGED)
 
     @flagged.expression
     def flagged(cls):
@@ -325,8 +328,7 @@ class User(db.Model):
 
     @hybrid_property
     def moderator(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.MODERATOR).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.MODERATOR)
 
     @moderator.expression
     def moderator(cls):
@@ -344,8 +346,7 @@ class User(db.Model):
 
     @hybrid_property
     def customizer(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.CUSTOMIZER).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.CUSTOMIZER)
 
     @customizer.expression
     def customizer(cls):
@@ -363,8 +364,7 @@ class User(db.Model):
 
     @hybrid_property
     def vpn(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.VPN).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.VPN)
 
     @vpn.expression
     def vpn(cls):
@@ -382,8 +382,7 @@ class User(db.Model):
 
     @hybrid_property
     def service(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.SERVICE).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.SERVICE)
 
     @service.expression
     def service(cls):
@@ -401,8 +400,7 @@ class User(db.Model):
 
     @hybrid_property
     def education(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.EDUCATION).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.EDUCATION)
 
     @education.expression
     def education(cls):
@@ -420,8 +418,7 @@ class User(db.Model):
 
     @hybrid_property
     def special(self) -> bool:
-        user_role = UserRole.query.filter_by(user_id=self.id, user_role=UserRoleTypes.SPECIAL).first()
-        return user_role is not None and user_role.value
+        return self.has_role(UserRoleTypes.SPECIAL)
 
     @special.expression
     def special(cls):
@@ -437,6 +434,37 @@ class User(db.Model):
         )
         return cls.id == subquery
 
+    def set_role_snapshot(self, roles):
+        """Allows the role properties to use the roles already loaded in the user's cached principal
+        roles is a collection of UserRoleTypes names
+        """
+        self.role_snapshot = frozenset(roles)
+
+    def load_role_snapshot(self):
+        """Loads all the roles of this user with a single query, so that the role properties don't need one each
+        Returns the names of the roles the user has
+        """
+        roles = {}
+        for user_role, value in db.session.query(UserRole.user_role, UserRole.value).filter(UserRole.user_id == self.id):
+            # Like the role properties, only the first entry for each role counts
+            roles.setdefault(user_role.name, value)
+        self.set_role_snapshot([role_name for role_name, value in roles.items() if value])
+        return self.role_snapshot
+
+    def has_role(self, role):
+        role_snapshot = getattr(self, "role_snapshot", None)
+        if role_snapshot is not None:
+            return role.name in role_snapshot
+        user_role = UserRole.query.filter_by(user_id=self.id, user_role=role).first()
+        return user_role is not None and user_role.value
+
+    def invalidate_principal(self, api_key=None):
+        """Needs to be called whenever something cached in the user's principal changes
+        If the API key is changing, api_key should be the previous one
+        """
+        self.role_snapshot = None
+        principal_cache.invalidate(api_key or self.api_key)
+
     def create(self):
         self.check_for_bad_actor()
         db.session.add(self)
@@ -468,6 +496,7 @@ class User(db.Model):
             return "Too Long"
         self.username = sanitize_string(new_username)
         db.session.commit()
+        self.invalidate_principal()
         return "OK"
 
     def set_contact(self, new_contact):
@@ -494,21 +523,18 @@ class User(db.Model):
             user_role=role,
         ).first()
         if value is False:
-            if user_role is None:
-                return
-            else:
+            if user_role is not None:
                 # No entry means false
                 db.session.delete(user_role)
                 db.session.commit()
-                return
-        if user_role is None:
+        elif user_role is None:
             new_role = UserRole(user_id=self.id, user_role=role, value=value)
             db.session.add(new_role)
             db.session.commit()
-            return
-        if user_role.value is False:
+        elif user_role.value is False:
             user_role.value = True
             db.session.commit()
+        self.invalidate_principal()
 
     def set_trusted(self, is_trusted):
         # Anonymous can never be trusted
@@ -861,6 +887,10 @@ class User(db.Model):
 
     @logger.catch(reraise=True)
     def get_details(self, details_privilege=0):
+        # We avoid loading the user's relationships, as power users can have hundreds of workers and styles
+        if getattr(self, "role_snapshot", None) is None:
+            self.load_role_snapshot()
+        worker_ids = [str(worker_id) for (worker_id,) in db.session.query(Worker.id).filter(Worker.user_id == self.id)]
         ret_dict = {
             "username": self.get_unique_alias(),
             "id": self.id,
@@ -875,7 +905,7 @@ class User(db.Model):
             "trusted": self.trusted,
             "flagged": self.flagged,
             "pseudonymous": self.is_pseudonymous(),
-            "worker_count": self.count_workers(),
+            "worker_count": len(worker_ids),
             "account_age": (datetime.utcnow() - self.created).total_seconds(),
             "service": self.service,
             "education": self.education,
@@ -883,38 +913,37 @@ class User(db.Model):
             # unnecessary information, since the workers themselves wil be visible
             # "public_workers": self.public_workers,
         }
-        styles_array = []
-        for s in self.styles:
-            if s.public or details_privilege >= 1:
-                styles_array.append(
-                    {
-                        "name": s.get_unique_name(),
-                        "id": str(s.id),
-                        "type": str(s.style_type),
-                    },
-                )
-        ret_dict["styles"] = styles_array
+        styles_query = db.session.query(Style.id, Style.name, Style.style_type).filter(Style.user_id == self.id)
+        if details_privilege < 1:
+            styles_query = styles_query.filter(Style.public.is_(True))
+        ret_dict["styles"] = [
+            {
+                "name": f"{self.get_unique_alias()}::style::{style_name}",
+                "id": str(style_id),
+                "type": str(style_type),
+            }
+            for style_id, style_name, style_type in styles_query
+        ]
         if self.public_workers or details_privilege >= 1:
-            workers_array = []
-            for worker in self.workers:
-                workers_array.append(str(worker.id))
-            ret_dict["worker_ids"] = workers_array
+            ret_dict["worker_ids"] = worker_ids
         if details_privilege >= 1:
-            sharedkeys_array = []
-            for sk in self.sharedkeys:
-                sharedkeys_array.append(str(sk.id))
-            ret_dict["sharedkey_ids"] = sharedkeys_array
+            ret_dict["sharedkey_ids"] = [
+                str(sharedkey_id) for (sharedkey_id,) in db.session.query(UserSharedKey.id).filter(UserSharedKey.user_id == self.id)
+            ]
             ret_dict["contact"] = self.contact
             ret_dict["vpn"] = self.vpn
             ret_dict["special"] = self.special
             ret_dict["active_generations"] = {}
-            for wp in self.waiting_prompts:
-                if wp.wp_type not in ret_dict["active_generations"]:
-                    ret_dict["active_generations"][wp.wp_type] = []
-                # We don't return anon list of gens
+            wp_query = db.session.query(WaitingPrompt.id, WaitingPrompt.wp_type).filter(WaitingPrompt.user_id == self.id)
+            # We don't return anon list of gens
+            if self.is_anon():
+                wp_query = wp_query.limit(1)
+            for wp_id, wp_type in wp_query:
+                if wp_type not in ret_dict["active_generations"]:
+                    ret_dict["active_generations"][wp_type] = []
                 if self.is_anon():
                     break
-                ret_dict["active_generations"][wp.wp_type].append(str(wp.id))
+                ret_dict["active_generations"][wp_type].append(str(wp_id))
         if details_privilege >= 2:
             mk_dict = {
                 "amount": self.calculate_monthly_kudos(),
@@ -922,7 +951,7 @@ class User(db.Model):
             }
             ret_dict["evaluating_kudos"] = self.evaluating_kudos
             ret_dict["monthly_kudos"] = mk_dict
-            ret_dict["suspicious"] = len(self.suspicions)
+            ret_dict["suspicious"] = db.session.query(UserSuspicions).filter(UserSuspicions.user_id == self.id).count()
             ret_dict["admin_comment"] = self.admin_comment
         return ret_dict
 
@@ -947,6 +976,7 @@ class User(db.Model):
 
             api_cache_name = f"cached_apikey_user_{self.api_key}"
             hr.horde_r_delete(api_cache_name)
+            self.invalidate_principal()
 
         except Exception:
             return None
@@ -1042,3 +1072,13 @@ class User(db.Model):
             )
             hr.horde_r_setex(f"ip_{ipaddr}_daily_problem_notified", timedelta(days=1), 1)
             return
+
+
+@event.listens_for(User, "after_delete")
+def invalidate_deleted_user_principal(mapper, connection, user):
+    """Deleted users must not keep authenticating through their cached principal.
+    It's invalidated again once the deletion is committed, in case a request cached it again in the meantime.
+    """
+    api_key = user.api_key
+    principal_cache.invalidate(api_key)
+    event.listen(object_session(user), "after_commit", lambda session: principal_cache.invalidate(api_key), once=True)
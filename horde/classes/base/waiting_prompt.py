@@ -6,9 +6,10 @@ import json
 import uuid
 from datetime import datetime, timedelta
 
-from sqlalchemy import JSON, or_
+from sqlalchemy import JSON, event, or_
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.sql import expression
 
 from horde import vars as hv
@@ -18,6 +19,7 @@ from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
+from horde.inflight import inflight_counters
 from horde.logger import logger
 from horde.utils import get_db_uuid, get_expiry_date, get_extra_slow_expiry_date
 
@@ -164,6 +166,22 @@ class WaitingPrompt(db.Model):
         for model in model_names:
             model_entry = WPModels(model=model, wp_id=self.id)
             db.session.add(model_entry)
+        self.capture_inflight_keys(model_names)
+
+    def capture_inflight_keys(self, model_names):
+        """Stores the keys of the in-flight counters this waiting prompt counts towards"""
+        # Only the anonymous user is limited per model
+        if not self.user.is_anon():
+            model_names = []
+        self.inflight_keys = [inflight_counters.get_key(self.wp_type, self.user_id, model) for model in [None, *model_names]]
+
+    def get_inflight_keys(self):
+        """Returns the keys of the in-flight counters of this waiting prompt.
+        Those of the waiting prompts loaded from the DB are captured the first time they're needed, during a flush.
+        """
+        if "inflight_keys" not in self.__dict__:
+            self.capture_inflight_keys(self.get_model_names())
+        return self.inflight_keys
 
     def activate(self, downgrade_wp_priority=False, extra_source_images=None, kudos_adjustment=0):
         """We separate the activation from __init__ as often we want to check if there's a valid worker for it
@@ -523,3 +541,64 @@ class WaitingPrompt(db.Model):
     # To override
     def get_amount_calculation_things(self):
         return self.things
+
+
+def queue_inflight_delta(wp, delta):
+    """Queues a change to the in-flight counters of the owner of this waiting prompt, to apply once it's committed.
+    This is called from attribute events, so it must not read any relationships.
+    """
+    if delta == 0:
+        return
+    session = object_session(wp)
+    if session is None:
+        return
+    inflight_counters.queue_delta(session, wp, delta)
+
+
+def get_inflight_n(n):
+    # The previous value is a symbol when the attribute wasn't set before
+    if not isinstance(n, int):
+        return 0
+    return max(n, 0)
+
+
+# Only the jobs of active waiting prompts which have not faulted are counted as in-flight
+@event.listens_for(WaitingPrompt.n, "set", propagate=True, active_history=True)
+def track_inflight_n(target, value, oldvalue, initiator):
+    if target.active and not target.faulted:
+        queue_inflight_delta(target, get_inflight_n(value) - get_inflight_n(oldvalue))
+
+
+@event.listens_for(WaitingPrompt.active, "set", propagate=True, active_history=True)
+def track_inflight_active(target, value, oldvalue, initiator):
+    if target.faulted or bool(value) == (oldvalue is True):
+        return
+    n = get_inflight_n(target.n)
+    queue_inflight_delta(target, n if value else -n)
+
+
+@event.listens_for(WaitingPrompt.faulted, "set", propagate=True, active_history=True)
+def track_inflight_faulted(target, value, oldvalue, initiator):
+    if not target.active or bool(value) == (oldvalue is True):
+        return
+    n = get_inflight_n(target.n)
+    queue_inflight_delta(target, -n if value else n)
+
+
+@event.listens_for(Session, "before_flush")
+def track_inflight_deletions(session, flush_context, instances):
+    for instance in session.deleted:
+        if isinstance(instance, WaitingPrompt) and instance.active and not instance.faulted:
+            queue_inflight_delta(instance, -get_inflight_n(instance.n))
+    # Loading the relationships needed for the keys doesn't trigger another flush from here
+    inflight_counters.resolve_deltas(session, WaitingPrompt.get_inflight_keys)
+
+
+@event.listens_for(Session, "after_commit")
+def apply_inflight_deltas(session):
+    inflight_counters.apply_deltas(session)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_inflight_deltas(session, previous_transaction):
+    inflight_counters.discard_deltas(session)
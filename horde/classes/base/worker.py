@@ -11,12 +11,15 @@ from sqlalchemy.ext.hybrid import hybrid_property
 
 from horde import vars as hv
 from horde.classes.base import settings
+from horde.classes.base.lifetime_totals import record_lifetime_contribution
 from horde.discord import send_pause_notification
 from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
+from horde.prompt_filter import blacklist_matchers
 from horde.suspicions import SUSPICION_LOGS, Suspicions
 from horde.utils import get_db_uuid, get_message_expiry_date, is_profane, sanitize_string
+from horde.worker_directory import worker_directory
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)  # FIXME # noqa E731
 
@@ -181,6 +184,9 @@ class WorkerTemplate(db.Model):
         self.check_for_bad_actor()
         db.session.add(self)
         db.session.commit()
+        worker_directory.set_worker(self)
+        # The owner's details list their workers
+        self.user.refresh_cache()
         if self.is_suspicious():
             pass
             # TODO: Doesn't work
@@ -312,6 +318,7 @@ class WorkerTemplate(db.Model):
             # So that they have to stay up at least 10 mins to get uptime kudos
             self.last_reward_uptime = self.uptime
         self.last_check_in = datetime.utcnow()
+        worker_directory.set_worker(self)
 
     def get_human_readable_uptime(self):
         if self.uptime < 60:
@@ -344,6 +351,7 @@ class WorkerTemplate(db.Model):
         self.modify_kudos(kudos, "generated")
         converted_amount = self.convert_contribution(raw_things)
         self.fulfilments += 1
+        record_lifetime_contribution(self.wtype, raw_things)
         if self.team and self.wtype == "image":
             self.team.record_contribution(converted_amount, kudos)
         performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
@@ -434,8 +442,12 @@ class WorkerTemplate(db.Model):
             db.session.delete(performance)
         for suspicion in self.suspicions:
             db.session.delete(suspicion)
+        user = self.user
+        worker_id = self.id
         db.session.delete(self)
         db.session.commit()
+        worker_directory.remove_worker(worker_id)
+        user.refresh_cache()
 
     def get_kudos_details(self):
         kudos_details = db.session.query(WorkerStats).filter_by(worker_id=self.id).all()
@@ -558,12 +570,25 @@ class Worker(WorkerTemplate):
 
         existing_blacklist_words = set([b.word for b in existing_blacklist.all()])
         if existing_blacklist_words == blacklist:
+            # Compiling it here on check-in, means the pop loop will find it ready
+            self._blacklist_matcher = blacklist_matchers.get(self.id, existing_blacklist_words)
             return
         existing_blacklist.delete()
         for word in blacklist:
             blacklisted_word = WorkerBlackList(worker_id=self.id, word=word[0:15])
             db.session.add(blacklisted_word)
         db.session.flush()
+        self._blacklist_matcher = blacklist_matchers.get(self.id, {word[0:15] for word in blacklist})
+
+    def get_blacklist_matcher(self):
+        """Returns the compiled matcher for this worker's blacklist
+        so that we don't have to scan each word separately for every waiting prompt
+        """
+        matcher = getattr(self, "_blacklist_matcher", None)
+        if matcher is None:
+            matcher = blacklist_matchers.get(self.id, {b.word for b in self.blacklist})
+            self._blacklist_matcher = matcher
+        return matcher
 
     def refresh_model_cache(self):
         models_list = [m.model for m in self.models]
@@ -636,7 +661,7 @@ class Worker(WorkerTemplate):
         if waiting_prompt.tricked_worker(self):
             return [False, "secret"]
         # logger.warning(datetime.utcnow())
-        if any(b.word.lower() in waiting_prompt.prompt.lower() for b in self.blacklist):
+        if self.get_blacklist_matcher().search(waiting_prompt.prompt):
             return [False, "blacklist"]
         # Skips working prompts which require a specific worker from a list, and our ID is not in that list
         if waiting_prompt.worker_blacklist:
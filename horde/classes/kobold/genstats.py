@@ -6,6 +6,11 @@ from datetime import datetime
 
 from sqlalchemy import Enum
 
+from horde.classes.base.stats_rollups import (
+    COMPILED_MODELS_RETENTION,
+    COMPILED_TOTALS_RETENTION,
+    compile_stats_rollups,
+)
 from horde.enums import ImageGenState
 from horde.flask import db
 
@@ -83,6 +88,22 @@ def get_compiled_textgen_stats_totals() -> dict[str, dict[str, int]]:
     return stats_dict
 
 
+def compile_textgen_stats_totals():
+    """Stores the text generation statistics for the minute, hour, day, month, and total periods.
+
+    They are summed from the incremental rollups, so only the statistics recorded since the previous run are read.
+    """
+    totals = compile_stats_rollups("text", TextGenerationStatistic, TextGenerationStatistic.max_length)
+    if totals is None:
+        return
+    compiled_totals = CompiledTextGensStatsTotals()
+    for period, (requests, tokens) in totals.items():
+        setattr(compiled_totals, f"{period}_requests", requests)
+        setattr(compiled_totals, f"{period}_tokens", tokens)
+    db.session.add(compiled_totals)
+    db.session.commit()
+
+
 class CompiledTextGenStatsModels(db.Model):
     __tablename__ = "compiled_text_gen_stats_models"
     id = db.Column(db.Integer, primary_key=True)
@@ -114,3 +135,19 @@ def get_compiled_textgen_stats_models() -> dict[str, dict[str, int]]:
             stats[period][model.model] = getattr(model, f"{period}_requests")
 
     return stats
+
+
+def prune_compiled_textgen_stats():
+    """Deletes the compiled text generation statistics which have been superseded for longer than their retention"""
+    now = datetime.utcnow()
+    for compiled_stats, retention in (
+        (CompiledTextGensStatsTotals, COMPILED_TOTALS_RETENTION),
+        (CompiledTextGenStatsModels, COMPILED_MODELS_RETENTION),
+    ):
+        latest_date = db.session.query(db.func.max(compiled_stats.created)).scalar()
+        if latest_date is None:
+            continue
+        # We always keep the latest snapshot, even if it's not been compiled for a while
+        cutoff = min(latest_date, now - retention)
+        db.session.query(compiled_stats).filter(compiled_stats.created < cutoff).delete(synchronize_session=False)
+    db.session.commit()
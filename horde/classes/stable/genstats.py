@@ -6,6 +6,11 @@ from datetime import datetime
 
 from sqlalchemy import Enum
 
+from horde.classes.base.stats_rollups import (
+    COMPILED_MODELS_RETENTION,
+    COMPILED_TOTALS_RETENTION,
+    compile_stats_rollups,
+)
 from horde.enums import ImageGenState
 from horde.flask import db
 
@@ -202,6 +207,27 @@ def get_compiled_imagegen_stats_totals() -> dict[str, dict[str, int]]:
     return stats
 
 
+def compile_imagegen_stats_totals():
+    """Stores the image generation statistics for the minute, hour, day, month, and total periods.
+
+    They are summed from the incremental rollups, so only the statistics recorded since the previous run are read.
+    """
+    pixelsteps = db.cast(ImageGenerationStatistic.width, db.BigInteger) * ImageGenerationStatistic.height * ImageGenerationStatistic.steps
+    totals = compile_stats_rollups("image", ImageGenerationStatistic, pixelsteps)
+    if totals is None:
+        return
+    compiled_totals = CompiledImageGenStatsTotals()
+    for period, (images, pixels) in totals.items():
+        setattr(compiled_totals, f"{period}_images", images)
+        setattr(compiled_totals, f"{period}_pixels", pixels)
+    db.session.add(compiled_totals)
+    db.session.commit()
+
+
+# The per-model statistics of the latest snapshot, for each model_state
+compiled_models_stats_cache = {}
+
+
 class CompiledImageGenStatsModels(db.Model):
     """A table to store the compiled image generation statistics for each model."""
 
@@ -218,45 +244,50 @@ class CompiledImageGenStatsModels(db.Model):
 
 
 def get_compiled_imagegen_stats_models(model_state: str = "all") -> dict[str, dict[str, dict[str, int]]]:
-    """Gets the precompiled image generation statistics for the day, month, and total periods for each model."""
+    """Gets the precompiled image generation statistics for the day, month, and total periods for each model.
 
-    latest_date = db.session.query(db.func.max(CompiledImageGenStatsModels.created)).scalar()
+    The statistics of the latest snapshot are retrieved together, and reused until a newer snapshot is compiled.
+    """
+    if model_state not in ["all", "known", "custom"]:
+        raise ValueError("Invalid model_state. Expected 'all', 'known', or 'custom'.")
 
-    models: tuple[CompiledImageGenStatsModels] = ()
+    latest_date = db.session.query(db.func.max(CompiledImageGenStatsModels.created)).scalar()
+    cached_stats = compiled_models_stats_cache.get(model_state)
+    if cached_stats is not None and cached_stats[0] == latest_date:
+        return cached_stats[1]
 
     # If model_state is "all" we get all models, if it's "known" we get only known models, if it's "custom" we get only custom models
-    if model_state == "all":
-        models = db.session.query(CompiledImageGenStatsModels.model_name).distinct().all()
-    elif model_state == "known":
-        models = (
-            db.session.query(CompiledImageGenStatsModels.model_name)
-            .filter(CompiledImageGenStatsModels.model_state == "known")
-            .distinct()
-            .all()
-        )
-    elif model_state == "custom":
-        models = (
-            db.session.query(CompiledImageGenStatsModels.model_name)
-            .filter(CompiledImageGenStatsModels.model_state == "custom")
-            .distinct()
-            .all()
-        )
-    else:
-        raise ValueError("Invalid model_state. Expected 'all', 'known', or 'custom'.")
+    latest_entries = db.session.query(
+        CompiledImageGenStatsModels.model_name,
+        CompiledImageGenStatsModels.day_images,
+        CompiledImageGenStatsModels.month_images,
+        CompiledImageGenStatsModels.total_images,
+    ).filter(CompiledImageGenStatsModels.created == latest_date)
+    if model_state != "all":
+        latest_entries = latest_entries.filter(CompiledImageGenStatsModels.model_state == model_state)
 
     periods = ["day", "month", "total"]
-    stats = {period: {model.model_name: 0 for model in models} for period in periods}
-
-    for model in models:
-        latest_entry = (
-            db.session.query(CompiledImageGenStatsModels)
-            .filter_by(model_name=model.model_name)
-            .filter(CompiledImageGenStatsModels.created == latest_date)
-            .first()
-        )
+    stats = {period: {} for period in periods}
 
-        if latest_entry:
-            for period in periods:
-                stats[period][model.model_name] = getattr(latest_entry, f"{period}_images")
+    for latest_entry in latest_entries.all():
+        for period in periods:
+            stats[period][latest_entry.model_name] = getattr(latest_entry, f"{period}_images")
 
+    compiled_models_stats_cache[model_state] = (latest_date, stats)
     return stats
+
+
+def prune_compiled_imagegen_stats():
+    """Deletes the compiled image generation statistics which have been superseded for longer than their retention"""
+    now = datetime.utcnow()
+    for compiled_stats, retention in (
+        (CompiledImageGenStatsTotals, COMPILED_TOTALS_RETENTION),
+        (CompiledImageGenStatsModels, COMPILED_MODELS_RETENTION),
+    ):
+        latest_date = db.session.query(db.func.max(compiled_stats.created)).scalar()
+        if latest_date is None:
+            continue
+        # We always keep the latest snapshot, even if it's not been compiled for a while
+        cutoff = min(latest_date, now - retention)
+        db.session.query(compiled_stats).filter(compiled_stats.created < cutoff).delete(synchronize_session=False)
+    db.session.commit()
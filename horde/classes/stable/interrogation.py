@@ -6,8 +6,9 @@ import json
 from datetime import datetime, timedelta
 
 import requests
-from sqlalchemy import JSON, Enum
+from sqlalchemy import JSON, Enum, Index, text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.sql import expression
 
 from horde.consts import KNOWN_POST_PROCESSORS
 from horde.enums import State
@@ -15,7 +16,7 @@ from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.r2 import generate_procgen_download_url, generate_procgen_upload_url
-from horde.utils import get_db_uuid, get_expiry_date, get_interrogation_form_expiry_date
+from horde.utils import get_db_uuid, get_expiry_date, get_interrogation_form_expiry_date, hash_dictionary
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)  # FIXME # noqa E731
 json_column_type = JSONB if not SQLITE_MODE else JSON
@@ -25,6 +26,16 @@ class InterrogationForms(db.Model):
     """For storing the details of each image interrogation form"""
 
     __tablename__ = "interrogation_forms"
+    __table_args__ = (
+        # The pop queue is read per form name, in priority order
+        Index(
+            "ix_interrogation_forms_queue",
+            "state",
+            "name",
+            text("extra_priority DESC"),
+            "created",
+        ),
+    )
     id = db.Column(uuid_column_type(), primary_key=True, default=get_db_uuid)
     i_id = db.Column(
         uuid_column_type(),
@@ -40,6 +51,8 @@ class InterrogationForms(db.Model):
     worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), default=None, nullable=True)
     worker = db.relationship("InterrogationWorker", back_populates="processing_forms")
     created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Copied from the interrogation so that the queue can be sorted using only this table
+    extra_priority = db.Column(db.Integer, default=0, nullable=False, server_default=expression.literal(0))
     initiated = db.Column(db.DateTime, default=None)
     expiry = db.Column(db.DateTime, default=None, index=True)
     abort_count = db.Column(db.Integer, default=0, nullable=False)
@@ -63,6 +76,9 @@ class InterrogationForms(db.Model):
         self.worker_id = worker.id
         # This also commits
         self.interrogation.refresh()
+        return self.get_pop_payload()
+
+    def get_pop_payload(self, r2_upload=None):
         ret_dict = {
             "id": self.id,
             "form": self.name,
@@ -70,8 +86,9 @@ class InterrogationForms(db.Model):
             "source_image": self.interrogation.source_image,
         }
         if self.name in KNOWN_POST_PROCESSORS:
-            ret_dict["r2_upload"] = generate_procgen_upload_url(str(self.id), False)
-        logger.debug([self.name in KNOWN_POST_PROCESSORS, self.name, KNOWN_POST_PROCESSORS])
+            if r2_upload is None:
+                r2_upload = generate_procgen_upload_url(str(self.id), False)
+            ret_dict["r2_upload"] = r2_upload
         logger.debug(ret_dict)
         return ret_dict
 
@@ -81,12 +98,17 @@ class InterrogationForms(db.Model):
         if state == "faulted":
             self.abort()
             return -1
+        self.result = self.resolve_cached_result(result, self.id)
+        # We cache the result against the image contents, so the same picture doesn't need to be processed again
+        if self.interrogation.source_hash is not None:
+            hr.horde_r_setex(
+                self.get_content_cache_key(self.interrogation.source_hash),
+                # Post-processed images live in R2 only for 120 minutes
+                timedelta(minutes=90) if self.name in KNOWN_POST_PROCESSORS else timedelta(days=5),
+                json.dumps({"form_id": str(self.id), "result": result}),
+            )
         # If the image was not sent as b64, we cache its origin url and result so we save on compute
-        self.result = result
-        for form_name in self.result:
-            if self.result[form_name] == "R2":
-                self.result[form_name] = generate_procgen_download_url(str(self.id), False)
-        if not self.interrogation.r2stored:
+        elif not self.interrogation.r2stored:
             if self.name in KNOWN_POST_PROCESSORS:
                 # Post-processed images live in R2 only for 120 minutes
                 hr.horde_r_setex(
@@ -106,6 +128,19 @@ class InterrogationForms(db.Model):
         db.session.commit()
         return self.kudos
 
+    def get_content_cache_key(self, source_hash):
+        return f"interrogation_cache_{self.name}_{source_hash}_{hash_dictionary(self.payload or {})}"
+
+    @staticmethod
+    def resolve_cached_result(result, form_id):
+        """Replaces the R2 placeholders in a result with a download url of the form that generated them"""
+        resolved_result = {}
+        for form_name, form_result in result.items():
+            if form_result == "R2":
+                form_result = generate_procgen_download_url(str(form_id), False)
+            resolved_result[form_name] = form_result
+        return resolved_result
+
     def cancel(self):
         if self.state != State.DONE:
             self.result = None
@@ -217,6 +252,8 @@ class Interrogation(db.Model):
     image_tiles = db.Column(db.Integer, default=1, nullable=False, index=True)
     # This is used so I know to delete up the image 30 mins after this request expires
     r2stored = db.Column(db.Boolean, default=False, nullable=False)
+    # sha256 of the decoded source image pixels. Used to cache results by image content
+    source_hash = db.Column(db.String(64), nullable=True)
     expiry = db.Column(db.DateTime, default=get_expiry_date, index=True)
     created = db.Column(db.DateTime(timezone=False), default=datetime.utcnow, index=True)
     extra_priority = db.Column(db.Integer, default=0, nullable=False, index=True)
@@ -233,20 +270,30 @@ class Interrogation(db.Model):
         db.session.commit()
         self.extra_priority = self.user.kudos
 
-    def set_source_image(self, source_image, r2stored, image_tiles):
+    def set_source_image(self, source_image, r2stored, image_tiles, source_hash=None):
         self.source_image = source_image
         self.r2stored = r2stored
         self.image_tiles = image_tiles
-        if not r2stored:
-            for form in self.forms:
-                self.check_cache(form, source_image)
+        self.source_hash = source_hash
+        for form in self.forms:
+            self.check_cache(form)
         db.session.commit()
 
-    def check_cache(self, form, source_image):
+    def check_cache(self, form):
         """Checks if the image is already in the redis cache.
         If it is, it sets the cached forms to DONE and sets the cached value as its result
         """
-        cached_result = hr.horde_r_get(f"{form.name}_{source_image}")
+        if self.source_hash is not None:
+            cached_entry = hr.horde_r_get(form.get_content_cache_key(self.source_hash))
+            if cached_entry is not None:
+                cached_entry = json.loads(cached_entry)
+                form.result = form.resolve_cached_result(cached_entry["result"], cached_entry["form_id"])
+                form.state = State.DONE
+                logger.debug(f"Interrogation form {form.name} for {self.id} retrieved from content cache")
+            return
+        if self.r2stored:
+            return
+        cached_result = hr.horde_r_get(f"{form.name}_{self.source_image}")
         # The entry might be False, so we need to check explicitly against None
         if cached_result is not None:
             form.result = json.loads(cached_result)
@@ -281,8 +328,11 @@ class Interrogation(db.Model):
                 payload=form.get("payload"),
                 i_id=self.id,
                 kudos=kudos,  # TODO: Adjust the kudos cost per interrogation
+                extra_priority=self.extra_priority,
             )
             db.session.add(form_entry)
+            if self.source_image is not None:
+                self.check_cache(form_entry)
         db.session.commit()
 
     def get_form_names(self):
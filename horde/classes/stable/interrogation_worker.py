@@ -4,6 +4,7 @@
 
 from sqlalchemy import func
 
+from horde.classes.base.lifetime_totals import record_lifetime_contribution
 from horde.classes.base.worker import (
     WorkerPerformance,
     WorkerTemplate,
@@ -86,6 +87,7 @@ class InterrogationWorker(WorkerTemplate):
         self.user.record_contributions(raw_things=0, kudos=kudos, contrib_type=self.wtype)
         self.modify_kudos(kudos, "interrogated")
         self.fulfilments += 1
+        record_lifetime_contribution(self.wtype, 0)
         # TODO: Switch to use desc() and offset to ensure we don't have performances left over
         performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
         if performances.count() >= 20:
@@ -7,18 +7,19 @@ import os
 
 from horde.classes.base.processing_generation import ProcessingGeneration
 from horde.classes.stable.genstats import record_image_statistic
+from horde.exceptions import ImageValidationFailed
 from horde.flask import db
-from horde.image import convert_b64_to_pil, convert_pil_to_b64
+from horde.image import convert_pil_to_b64
 from horde.logger import logger
 from horde.model_reference import model_reference
 from horde.r2 import (
     check_shared_image,
     download_procgen_image,
     generate_procgen_download_url,
-    upload_generated_image,
-    upload_shared_generated_image,
+    upload_generated_image_webp,
     upload_shared_metadata,
 )
+from horde.transcoder import image_transcoder
 
 
 class ImageProcessingGeneration(ProcessingGeneration):
@@ -112,16 +113,13 @@ class ImageProcessingGeneration(ProcessingGeneration):
             logger.warning(
                 f"Worker {self.worker.name} ({self.worker.id}) with bridge agent {self.worker.bridge_agent} returned a b64. Converting...",
             )
-            if self.wp.shared:
-                upload_method = upload_shared_generated_image
-            else:
-                upload_method = upload_generated_image
             filename = f"{self.id}.webp"
-            image = convert_b64_to_pil(generation)
-            if not image:
-                logger.error("Could not convert b64 image from the worker to PIL to upload!")
+            try:
+                transcoded = image_transcoder.transcode(generation, quality=95)
+            except ImageValidationFailed:
+                logger.error("Could not convert b64 image from the worker to webp to upload!")
             else:
-                upload_method(image, filename)
+                upload_generated_image_webp(transcoded.webp, filename, self.wp.shared)
                 # This signifies to send the download URL
                 generation = "R2"
         kudos = super().set_generation(generation, things_per_sec, **kwargs)
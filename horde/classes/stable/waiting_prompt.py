@@ -27,7 +27,7 @@ from horde.model_reference import model_reference
 from horde.r2 import (
     download_source_image,
     download_source_mask,
-    generate_procgen_upload_url,
+    generate_procgen_upload_urls,
 )
 from horde.utils import get_random_seed
 
@@ -220,8 +220,10 @@ class ImageWaitingPrompt(WaitingPrompt):
                 prompt_payload["extra_source_images"] = self.extra_source_images["esi"]
             # We always ask the workers to upload the generation to R2 instead of sending it back as b64
             # If they send it back as b64 anyway, we upload it outselves
-            prompt_payload["r2_upload"] = generate_procgen_upload_url(str(procgen.id), self.shared)
-            prompt_payload["r2_uploads"] = [generate_procgen_upload_url(str(p.id), self.shared) for p in procgen_list]
+            # All the urls are signed in one batch. The first procgen is the same as r2_upload so we reuse it.
+            r2_uploads = generate_procgen_upload_urls([str(p.id) for p in procgen_list], self.shared)
+            prompt_payload["r2_upload"] = r2_uploads[0]
+            prompt_payload["r2_uploads"] = r2_uploads
         else:
             prompt_payload = {}
             self.faulted = True
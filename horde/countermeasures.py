@@ -3,13 +3,11 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import ipaddress
-import os
 from datetime import timedelta
 
-import requests
-
 from horde.argparser import args
 from horde.consts import WHITELISTED_SERVICE_IPS, WHITELISTED_VPN_IPS
+from horde.ip_reputation import IPReputationChecker, get_ip_reputation_backend
 from horde.logger import logger
 from horde.redis_ctrl import (
     get_ipaddr_db,
@@ -30,6 +28,8 @@ if is_redis_up():
 else:
     logger.init_err("IP Caches", status="Failed")
 
+ip_reputation = IPReputationChecker(get_ip_reputation_backend(), redis_db=ip_r)
+
 test_timeout = 0
 
 
@@ -37,55 +37,36 @@ class CounterMeasures:
     @staticmethod
     def set_safe(ipaddr, is_safe):
         """Stores the safety of the IP in redis temporarily"""
-        ip_r.setex(ipaddr, timedelta(hours=6), int(is_safe))
+        ip_reputation.store_verdict(ipaddr, is_safe)
         return is_safe
 
     @staticmethod
     def get_safe(ipaddr):
-        is_safe = ip_r.get(ipaddr)
-        if is_safe is None:
-            return is_safe
-        return bool(int(is_safe))
+        return ip_reputation.get_cached_verdict(ipaddr)
+
+    @staticmethod
+    def needs_ip_check(ipaddr):
+        if args.allow_all_ips or ip_reputation.backend is None:
+            return False
+        return not CounterMeasures.is_whitelisted_vpn(ipaddr)
 
     @staticmethod
     def is_ip_safe(ipaddr):
-        """Returns False if the IP is not false
+        """Returns False if the IP is not safe
+        Returns None if the IP checker failed or is rate limiting us
+        Raises IPReputationPending if we do not know yet, in which case the client should try again later
         Else return true
         This function is a bit obscured with env vars to prevent defeat
         """
-        # return True # FIXME: Until I figure this out
-        if args.allow_all_ips or os.getenv("IP_CHECKER", "") == "":
-            return True
-        # If we don't have the cache up, it's always OK
-        if not ip_r:
+        if not CounterMeasures.needs_ip_check(ipaddr):
             return True
-        safety_threshold = 0.93
-        timeout = 2.00
-        if CounterMeasures.is_whitelisted_vpn(ipaddr):
-            return True
-        is_safe = CounterMeasures.get_safe(ipaddr)
-        if is_safe is None:
-            try:
-                result = requests.get(os.getenv("IP_CHECKER").format(ipaddr=ipaddr), timeout=timeout)
-            except Exception as err:
-                logger.error(f"Exception when requesting info from checker: {err}")
-                return None
-            if not result.ok:
-                if result.status_code == 429:
-                    # If we exceeded the amount of requests we can do to the IP checker, we ask the client to try again later.
-                    return None
-                else:
-                    probability = float(result.content)
-                if probability == int(os.getenv("IP_CHECKER_LC")):
-                    is_safe = CounterMeasures.set_safe(ipaddr, True)
-                else:
-                    is_safe = CounterMeasures.set_safe(ipaddr, True)  # True until I can improve my load
-                    logger.error(f"An error occurred while validating IP. Return Code: {result.text}")
-            else:
-                probability = float(result.content)
-                is_safe = CounterMeasures.set_safe(ipaddr, probability < safety_threshold)
-            logger.debug(f"IP {ipaddr} has a probability of {probability}. Safe = {is_safe}")
-        return is_safe
+        return ip_reputation.get_verdict(ipaddr)
+
+    @staticmethod
+    def prefetch_ip_safety(ipaddr):
+        """Starts checking the IP in the background, so that is_ip_safe() is likely to have a verdict when it's called"""
+        if CounterMeasures.needs_ip_check(ipaddr):
+            ip_reputation.prefetch(ipaddr)
 
     @staticmethod
     def report_suspicion(ipaddr):
@@ -12,6 +12,7 @@ from horde.threads import PrimaryTimedFunction
 quorum = Quorum(1, threads.get_quorum)
 wp_list_cacher = PrimaryTimedFunction(1, threads.store_prioritized_wp_queue, quorum=quorum)
 worker_cacher = PrimaryTimedFunction(30, threads.store_worker_list, quorum=quorum)
+worker_directory_cacher = PrimaryTimedFunction(300, threads.store_worker_directory, quorum=quorum)
 model_cacher = PrimaryTimedFunction(10, threads.store_available_models, quorum=quorum)
 if not args.check_prompts:
     wp_cleaner = PrimaryTimedFunction(60, threads.check_waiting_prompts, quorum=quorum)
@@ -20,6 +21,8 @@ patreon_cacher = PrimaryTimedFunction(3600, threads.store_patreon_members, quoru
 monthly_kudos = PrimaryTimedFunction(3600, threads.assign_monthly_kudos, quorum=quorum)
 totals_store = PrimaryTimedFunction(60, threads.store_totals, quorum=quorum)
 prune_stats = PrimaryTimedFunction(60, threads.prune_stats, quorum=quorum)
+inflight_reconciler = PrimaryTimedFunction(60, threads.reconcile_inflight, quorum=quorum)
+stats_totals_compiler = PrimaryTimedFunction(60, threads.compile_stats_totals, quorum=quorum)
 priority_increaser = PrimaryTimedFunction(10, threads.increment_extra_priority, quorum=quorum)
 compiled_filter_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex, quorum=quorum)
 regex_replacements_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex_replacements, quorum=quorum)
@@ -30,6 +33,8 @@ if args.reload_all_caches:
     threads.store_prioritized_wp_queue()
     logger.info("store_worker_list()")
     threads.store_worker_list()
+    logger.info("store_worker_directory()")
+    threads.store_worker_directory()
     logger.info("store_totals()")
     threads.store_totals()
     logger.info("store_patreon_members()")
@@ -50,6 +55,12 @@ if args.check_prompts:
 
     sys.exit()
 
+if args.recompute_lifetime_totals:
+    threads.check_lifetime_totals()
+    import sys
+
+    sys.exit()
+
 if args.new_patreons:
     threads.store_patreon_members()
     threads.assign_monthly_kudos()
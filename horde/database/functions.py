@@ -9,35 +9,48 @@ import urllib.parse
 import uuid
 from datetime import datetime, timedelta
 
-from sqlalchemy import Boolean, and_, func, not_, or_
+from sqlalchemy import Boolean, and_, func, not_, or_, select, update
 from sqlalchemy.orm import noload
 
 import horde.classes.base.stats as stats
 from horde import vars as hv
+from horde.auth import ApiKeyPrincipal, principal_cache
 from horde.bridge_reference import (
     check_bridge_capability,
     get_supported_samplers,
 )
+from horde.cached_query import CachedQuery, cached_query
 from horde.classes.base.detection import Filter
+from horde.classes.base.lifetime_totals import compute_worker_totals, get_lifetime_totals
 from horde.classes.base.style import Style, StyleCollection, StyleModel, StyleTag
-from horde.classes.base.user import KudosTransferLog, User, UserRecords, UserSharedKey
+from horde.classes.base.team import Team
+from horde.classes.base.user import KudosTransferLog, User, UserRecords, UserRole, UserSharedKey
 from horde.classes.base.waiting_prompt import WPAllowedWorkers, WPModels
-from horde.classes.base.worker import WorkerMessage, WorkerModel, WorkerPerformance
+from horde.classes.base.worker import (
+    WorkerMessage,
+    WorkerModel,
+    WorkerPerformance,
+    WorkerStats,
+    WorkerSuspicions,
+    WorkerTemplate,
+)
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
 from horde.classes.kobold.worker import TextWorker
 from horde.classes.stable.interrogation import Interrogation, InterrogationForms
-from horde.classes.stable.interrogation_worker import InterrogationWorker
+from horde.classes.stable.interrogation_worker import InterrogationWorker, WorkerInterrogationForm
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.stable.worker import ImageWorker
 from horde.database.classes import FakeWPRow
-from horde.enums import State
+from horde.enums import State, UserRoleTypes
 from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
+from horde.inflight import inflight_counters
 from horde.logger import logger
 from horde.model_reference import model_reference
-from horde.utils import hash_api_key, validate_regex
+from horde.utils import get_expiry_date, get_interrogation_form_expiry_date, hash_api_key, validate_regex
+from horde.worker_directory import make_directory_entry, worker_directory
 
 ALLOW_ANONYMOUS = True
 WORKER_CLASS_MAP = {
@@ -99,10 +112,171 @@ def get_active_workers(worker_type=None):
     return active_workers
 
 
+def get_active_worker_snapshots():
+    """Builds the details of all active workers, the same as their get_details() would,
+    but using a few set-based queries instead of loading each worker and its relationships.
+    Returns a tuple with the list of public details and the list of privileged details
+    """
+    now = datetime.utcnow()
+    workers_table = WorkerTemplate.__table__
+    # Same order as get_active_workers()
+    worker_types = {
+        ImageWorker.__mapper_args__["polymorphic_identity"]: ImageWorker.wtype,
+        TextWorker.__mapper_args__["polymorphic_identity"]: TextWorker.wtype,
+        InterrogationWorker.__mapper_args__["polymorphic_identity"]: InterrogationWorker.wtype,
+    }
+    active_filter = and_(
+        workers_table.c.last_check_in > now - timedelta(seconds=300),
+        workers_table.c.worker_type.in_(list(worker_types)),
+    )
+    active_worker_ids = select(workers_table.c.id).where(active_filter)
+    worker_rows = db.session.execute(
+        select(
+            workers_table,
+            User.username.label("owner_username"),
+            User.public_workers.label("owner_public_workers"),
+            User.contact.label("owner_contact"),
+            Team.name.label("team_name"),
+        )
+        .join(User, User.id == workers_table.c.user_id)
+        .outerjoin(Team, Team.id == workers_table.c.team_id)
+        .where(active_filter),
+    ).mappings()
+    type_order = list(worker_types)
+    worker_rows = sorted(worker_rows, key=lambda row: type_order.index(row["worker_type"]))
+    owner_ids = {row["user_id"] for row in worker_rows}
+    owner_roles = {}
+    for user_id, user_role, value in db.session.execute(
+        select(UserRole.user_id, UserRole.user_role, UserRole.value).where(
+            UserRole.user_id.in_(list(owner_ids)),
+            UserRole.user_role.in_([UserRoleTypes.TRUSTED, UserRoleTypes.FLAGGED]),
+        ),
+    ):
+        # Like User.trusted, only the first role entry counts
+        owner_roles.setdefault((user_id, user_role), value)
+    kudos_details = {}
+    for worker_id, action, value in db.session.execute(
+        select(WorkerStats.worker_id, WorkerStats.action, WorkerStats.value).where(WorkerStats.worker_id.in_(active_worker_ids)),
+    ):
+        kudos_details.setdefault(worker_id, {})[action] = value
+    performances = dict(
+        db.session.execute(
+            select(WorkerPerformance.worker_id, func.avg(WorkerPerformance.performance))
+            .where(WorkerPerformance.worker_id.in_(active_worker_ids))
+            .group_by(WorkerPerformance.worker_id),
+        ).all(),
+    )
+    suspicions = dict(
+        db.session.execute(
+            select(WorkerSuspicions.worker_id, func.count(WorkerSuspicions.id))
+            .where(WorkerSuspicions.worker_id.in_(active_worker_ids))
+            .group_by(WorkerSuspicions.worker_id),
+        ).all(),
+    )
+    worker_models = {}
+    for worker_id, model_name in db.session.execute(
+        select(WorkerModel.worker_id, WorkerModel.model).where(WorkerModel.worker_id.in_(active_worker_ids)),
+    ):
+        worker_models.setdefault(worker_id, []).append(model_name)
+    worker_forms = {}
+    for worker_id, form_name in db.session.execute(
+        select(WorkerInterrogationForm.worker_id, WorkerInterrogationForm.form)
+        .where(WorkerInterrogationForm.worker_id.in_(active_worker_ids))
+        .distinct(),
+    ):
+        worker_forms.setdefault(worker_id, []).append(form_name)
+    worker_messages = {}
+    for message in db.session.execute(
+        select(
+            WorkerMessage.worker_id,
+            WorkerMessage.user_id,
+            WorkerMessage.message,
+            WorkerMessage.origin,
+            WorkerMessage.created,
+            WorkerMessage.expiry,
+        ).where(WorkerMessage.worker_id.in_(active_worker_ids), WorkerMessage.expiry > now),
+    ).mappings():
+        worker_messages.setdefault(message["worker_id"], []).append(
+            {
+                "worker_id": str(message["worker_id"]),
+                "user_id": message["user_id"],
+                "message": message["message"],
+                "origin": message["origin"],
+                "created": message["created"],
+                "expiry": message["expiry"],
+            },
+        )
+    serialized_workers = []
+    serialized_workers_privileged = []
+    for row in worker_rows:
+        worker_id = row["id"]
+        wtype = worker_types[row["worker_type"]]
+        performance_avg = performances.get(worker_id)
+        if wtype == "interrogation":
+            performance = f"{round(performance_avg, 1)} seconds per form" if performance_avg is not None else "No requests fulfilled yet"
+        else:
+            speed = performance_avg if performance_avg else 1 * hv.thing_divisors[wtype]
+            performance = f"{round(speed / hv.thing_divisors[wtype], 1)} {hv.thing_names[wtype]} per second"
+        worker_details = {
+            "name": row["name"],
+            "id": str(worker_id),
+            "type": wtype,
+            "requests_fulfilled": row["fulfilments"],
+            "uncompleted_jobs": row["uncompleted_jobs"],
+            "kudos_rewards": row["kudos"],
+            "kudos_details": kudos_details.get(worker_id, {}),
+            "performance": performance,
+            "threads": row["threads"],
+            "uptime": row["uptime"],
+            "maintenance_mode": row["maintenance"],
+            "info": row["info"],
+            "trusted": bool(owner_roles.get((row["user_id"], UserRoleTypes.TRUSTED))),
+            "flagged": bool(owner_roles.get((row["user_id"], UserRoleTypes.FLAGGED))),
+            "online": (now - row["last_check_in"]).total_seconds() <= 300,
+            "team": {"id": str(row["team_id"]), "name": row["team_name"]} if row["team_id"] else "None",
+            "bridge_agent": row["bridge_agent"],
+        }
+        if wtype == "interrogation":
+            worker_details["forms"] = worker_forms.get(worker_id, [])
+        else:
+            worker_details["nsfw"] = row["nsfw"]
+            worker_details["models"] = worker_models.get(worker_id, [])
+        if wtype == "image":
+            worker_details["max_pixels"] = row["max_pixels"]
+            worker_details["megapixelsteps_generated"] = row["contributions"]
+            worker_details["img2img"] = row["allow_img2img"] if check_bridge_capability("img2img", row["bridge_agent"]) else False
+            worker_details["painting"] = row["allow_painting"] if check_bridge_capability("inpainting", row["bridge_agent"]) else False
+            worker_details["post-processing"] = row["allow_post_processing"]
+            worker_details["controlnet"] = row["allow_controlnet"]
+            worker_details["sdxl_controlnet"] = row["allow_sdxl_controlnet"]
+            worker_details["lora"] = row["allow_lora"]
+        if wtype == "text":
+            worker_details["max_length"] = row["max_length"]
+            worker_details["max_context_length"] = row["max_context_length"]
+        owner_details = {
+            "owner": f"{row['owner_username']}#{row['user_id']}",
+            "messages": worker_messages.get(worker_id, []),
+        }
+        public_details = dict(worker_details)
+        if row["owner_public_workers"]:
+            public_details.update(owner_details)
+        serialized_workers.append(public_details)
+        worker_details.update(owner_details)
+        worker_details["paused"] = row["paused"]
+        worker_details["suspicious"] = suspicions.get(worker_id, 0)
+        worker_details["ipaddr"] = row["ipaddr"]
+        worker_details["contact"] = row["owner_contact"]
+        serialized_workers_privileged.append(worker_details)
+    return serialized_workers, serialized_workers_privileged
+
+
 def count_active_workers(worker_class="image"):
-    worker_cache = hr.horde_r_get_json(f"count_active_workers_{worker_class}")
-    if worker_cache:
-        return tuple(worker_cache)
+    return tuple(query_active_workers(worker_class))
+
+
+# We don't cache finding no active workers, so that the first worker to come online is counted right away
+@cached_query("count_active_workers", ttl=300, stale_ttl=300, cache_if=lambda counts: counts != [0, 0])
+def query_active_workers(worker_class):
     WorkerClass = ImageWorker
     if worker_class == "interrogation":
         WorkerClass = InterrogationWorker
@@ -116,13 +290,8 @@ def count_active_workers(worker_class="image"):
     )
     # logger.debug([worker_class,active_workers,active_workers_threads.threads])
     if active_workers and active_workers_threads.threads:
-        hr.horde_r_setex_json(
-            f"count_active_workers_{worker_class}",
-            timedelta(seconds=300),
-            [active_workers, active_workers_threads.threads],
-        )
-        return active_workers, active_workers_threads.threads
-    return 0, 0
+        return [active_workers, active_workers_threads.threads]
+    return [0, 0]
 
 
 def count_workers_on_ip(ip_addr):
@@ -134,30 +303,19 @@ def count_workers_in_ipaddr(ipaddr):
 
 
 def get_total_usage():
-    totals = {
-        hv.thing_names["image"]: 0,
-        hv.thing_names["text"]: 0,
-        "image_fulfilments": 0,
-        "text_fulfilments": 0,
+    """Returns the contributions and fulfilments of all workers since the start of the horde"""
+    lifetime_totals = get_lifetime_totals()
+    if lifetime_totals is None:
+        lifetime_totals = compute_worker_totals()
+    image_raw_things, image_fulfilments = lifetime_totals["image"]
+    text_raw_things, text_fulfilments = lifetime_totals["text"]
+    return {
+        hv.thing_names["image"]: round(image_raw_things / hv.thing_divisors["image"], 2),
+        hv.thing_names["text"]: round(text_raw_things / hv.thing_divisors["text"], 2),
+        "image_fulfilments": image_fulfilments,
+        "text_fulfilments": text_fulfilments,
+        "forms": lifetime_totals["interrogation"][1],
     }
-    result = db.session.query(
-        func.sum(ImageWorker.contributions).label("contributions"),
-        func.sum(ImageWorker.fulfilments).label("fulfilments"),
-    ).first()
-    if result:
-        totals[hv.thing_names["image"]] = result.contributions if result.contributions else 0
-        totals["image_fulfilments"] = result.fulfilments if result.fulfilments else 0
-    result = db.session.query(
-        func.sum(TextWorker.contributions).label("contributions"),
-        func.sum(TextWorker.fulfilments).label("fulfilments"),
-    ).first()
-    if result:
-        totals[hv.thing_names["text"]] = result.contributions if result.contributions else 0
-        totals["text_fulfilments"] = result.fulfilments if result.fulfilments else 0
-    form_result = result = db.session.query(func.sum(InterrogationWorker.fulfilments).label("forms")).first()
-    if form_result:
-        totals["forms"] = result.forms if result.forms else 0
-    return totals
 
 
 def find_user_by_oauth_id(oauth_id):
@@ -185,10 +343,53 @@ def find_user_by_id(user_id):
     return user
 
 
+def get_user_principal(user):
+    """Builds the principal of a user and caches it against their API key"""
+    return principal_cache.store(ApiKeyPrincipal.from_user(user, user.load_role_snapshot()))
+
+
+def find_principal_by_api_key(api_key):
+    """Resolves an API key to its principal, without loading the user from the DB when it's cached.
+    Use this when the request only needs to know who the user is and what roles they have.
+    """
+    if api_key == 0000000000 and not ALLOW_ANONYMOUS:
+        return None
+    hashed_api_key = hash_api_key(api_key)
+    principal = principal_cache.get(hashed_api_key)
+    if principal is not None:
+        return principal
+    user = db.session.query(User).filter_by(api_key=hashed_api_key).first()
+    if not user:
+        return None
+    return get_user_principal(user)
+
+
+def get_principal_user(principal):
+    """Loads the user of a principal, for the requests which need to modify them
+    Returns None if the user has been deleted or has reset their key since the principal was cached
+    """
+    user = db.session.get(User, principal.user_id)
+    if not user or user.api_key != principal.api_key:
+        principal_cache.invalidate(principal.api_key)
+        return None
+    user.set_role_snapshot(principal.roles)
+    return user
+
+
 def find_user_by_api_key(api_key):
+    """Resolves an API key to its user, loaded from the DB
+    Use find_principal_by_api_key() instead when the request doesn't modify the user.
+    """
     if api_key == 0000000000 and not ALLOW_ANONYMOUS:
         return None
-    user = db.session.query(User).filter_by(api_key=hash_api_key(api_key)).first()
+    hashed_api_key = hash_api_key(api_key)
+    principal = principal_cache.get(hashed_api_key)
+    if principal is not None:
+        return get_principal_user(principal)
+    user = db.session.query(User).filter_by(api_key=hashed_api_key).first()
+    if not user:
+        return None
+    get_user_principal(user)
     return user
 
 
@@ -251,19 +452,68 @@ def find_worker_by_id(worker_id):
 
 
 def worker_exists(worker_id):
-    try:
-        worker_uuid = uuid.UUID(worker_id)
-    except ValueError:
-        logger.debug(f"Non-UUID worker_id sent: '{worker_id}'.")
-        return None
-    if SQLITE_MODE:
-        worker_uuid = str(worker_uuid)
-    wc = db.session.query(ImageWorker).filter_by(id=worker_uuid).count()
-    if not wc:
-        wc = db.session.query(TextWorker).filter_by(id=worker_uuid).count()
-    if not wc:
-        wc = db.session.query(InterrogationWorker).filter_by(id=worker_uuid).count()
-    return wc
+    return get_worker_directory_entries([worker_id])[worker_id] is not None
+
+
+def get_worker_type_map():
+    """Returns the type of worker each polymorphic identity of the workers table is for"""
+    return {worker_class.__mapper_args__["polymorphic_identity"]: wtype for wtype, worker_class in WORKER_CLASS_MAP.items()}
+
+
+def get_worker_directory_entries(worker_ids):
+    """Returns the type, owner, last check-in and liveness of each worker id, or None for the ones which don't exist.
+    Uses the worker directory, and a single DB query for any workers which it doesn't know about.
+    """
+    entries = {}
+    worker_uuids = {}
+    for worker_id in worker_ids:
+        try:
+            worker_uuids[worker_id] = str(uuid.UUID(str(worker_id)))
+        except ValueError:
+            logger.debug(f"Non-UUID worker_id sent: '{worker_id}'.")
+            entries[worker_id] = None
+    if not worker_uuids:
+        return entries
+    unique_uuids = list(set(worker_uuids.values()))
+    directory_entries = worker_directory.lookup(unique_uuids) or {}
+    missing_uuids = [worker_uuid for worker_uuid in unique_uuids if worker_uuid not in directory_entries]
+    if missing_uuids:
+        worker_types = get_worker_type_map()
+        query_uuids = missing_uuids if SQLITE_MODE else [uuid.UUID(worker_uuid) for worker_uuid in missing_uuids]
+        worker_rows = db.session.query(
+            WorkerTemplate.id,
+            WorkerTemplate.worker_type,
+            WorkerTemplate.user_id,
+            WorkerTemplate.last_check_in,
+        ).filter(
+            WorkerTemplate.id.in_(query_uuids),
+            WorkerTemplate.worker_type.in_(list(worker_types)),
+        )
+        for worker_row in worker_rows.all():
+            directory_entries[str(worker_row.id)] = make_directory_entry(
+                worker_types[worker_row.worker_type],
+                worker_row.user_id,
+                worker_row.last_check_in,
+            )
+    for worker_id, worker_uuid in worker_uuids.items():
+        entries[worker_id] = directory_entries.get(worker_uuid)
+    return entries
+
+
+def rebuild_worker_directory():
+    worker_types = get_worker_type_map()
+    worker_rows = db.session.query(
+        WorkerTemplate.id,
+        WorkerTemplate.worker_type,
+        WorkerTemplate.user_id,
+        WorkerTemplate.last_check_in,
+    ).filter(WorkerTemplate.worker_type.in_(list(worker_types)))
+    worker_directory.rebuild(
+        {
+            str(worker_row.id): (worker_types[worker_row.worker_type], worker_row.user_id, worker_row.last_check_in)
+            for worker_row in worker_rows.all()
+        },
+    )
 
 
 def get_available_models(filter_model_name: str = None):
@@ -378,18 +628,13 @@ def get_available_models(filter_model_name: str = None):
     return list(models_dict.values())
 
 
+# The primary thread refreshes these every 10 seconds
+available_models_cache = CachedQuery("available_models", get_available_models, ttl=30, stale_ttl=600)
+
+
 def retrieve_available_models(model_type=None, min_count=None, max_count=None, model_state="known"):
-    """Retrieves model details from Redis cache, or from DB if cache is unavailable"""
-    if hr.horde_r is None:
-        return get_available_models()
-    model_cache = hr.horde_r_get("models_cache")
-    try:
-        models_ret = json.loads(model_cache)
-    except TypeError:
-        logger.error(f"Model cache could not be loaded: {model_cache}")
-        return []
-    if models_ret is None:
-        models_ret = get_available_models()
+    """Retrieves model details from the cache, which the primary thread keeps fresh"""
+    models_ret = available_models_cache.get()
     if model_type is not None:
         models_ret = [md for md in models_ret if md.get("type", "image") == model_type]
     if min_count is not None:
@@ -510,6 +755,12 @@ def convert_things_to_kudos(things, **kwargs):
 
 
 def count_waiting_requests(user, models=None, request_type="image"):
+    # Only the anonymous user has per model counters
+    if not user.is_anon():
+        models = None
+    inflight_count = inflight_counters.get_count(request_type, user.id, models)
+    if inflight_count is not None:
+        return inflight_count
     wp_class = ImageWaitingPrompt
     if request_type == "text":
         wp_class = TextWaitingPrompt
@@ -551,6 +802,41 @@ def count_waiting_requests(user, models=None, request_type="image"):
         return unknown_model_query
 
 
+def reconcile_inflight_counters():
+    """Recounts the in-flight jobs of every user from the waiting prompts, to correct any drift of their counters"""
+    counts = {}
+    anon = get_anon()
+    for wp_type, wp_class in WP_CLASS_MAP.items():
+        user_counts = (
+            db.session.query(wp_class.user_id, func.sum(wp_class.n))
+            .filter(
+                wp_class.faulted == False,  # noqa E712
+                wp_class.active == True,  # noqa E712
+                wp_class.n >= 1,
+            )
+            .group_by(wp_class.user_id)
+        )
+        for user_id, count in user_counts.all():
+            counts[inflight_counters.get_key(wp_type, user_id)] = count
+        if anon is None:
+            continue
+        anon_model_counts = (
+            db.session.query(WPModels.model, func.sum(wp_class.n))
+            .select_from(WPModels)
+            .join(wp_class, WPModels.wp_id == wp_class.id)
+            .filter(
+                wp_class.user_id == anon.id,
+                wp_class.faulted == False,  # noqa E712
+                wp_class.active == True,  # noqa E712
+                wp_class.n >= 1,
+            )
+            .group_by(WPModels.model)
+        )
+        for model, count in anon_model_counts.all():
+            counts[inflight_counters.get_key(wp_type, anon.id, model)] = count
+    inflight_counters.reconcile(counts)
+
+
 def count_waiting_interrogations(user):
     found_i_forms = (
         db.session.query(InterrogationForms.state, Interrogation.user_id)
@@ -677,20 +963,16 @@ def count_totals():
     return ret_dict
 
 
+# The primary thread refreshes these every minute.
+# They stay available for long after that, to avoid recomputing them on requests if the thread dies.
+totals_cache = CachedQuery("totals", count_totals, ttl=90, stale_ttl=86400)
+
+
 def retrieve_totals(ignore_cache=False):
-    """Retrieves horde totals from Redis cache"""
-    if ignore_cache or hr.horde_r is None:
+    """Retrieves horde totals from the cache, which the primary thread keeps fresh"""
+    if ignore_cache:
         return count_totals()
-    totals_ret = hr.horde_r_get("totals_cache")
-    if totals_ret is None:
-        return {
-            "queued_requests": 0,
-            "queued_text_requests": 0,
-            f"queued_{hv.thing_names['image']}": 0,
-            f"queued_{hv.thing_names['text']}": 0,
-            "queued_forms": 0,
-        }
-    return json.loads(totals_ret)
+    return totals_cache.get()
 
 
 def get_organized_wps_by_model(wp_class):
@@ -1166,10 +1448,10 @@ def get_sorted_forms_filtered_to_worker(worker, forms_list=None, priority_user_i
                 Interrogation.slow_workers == True,  # noqa E712
             ),
         )
-        .order_by(Interrogation.extra_priority.desc(), Interrogation.created.asc())
+        .order_by(InterrogationForms.extra_priority.desc(), InterrogationForms.created.asc())
     )
     if priority_user_ids is not None:
-        final_interrogation_query.filter(Interrogation.user_id.in_(priority_user_ids))
+        final_interrogation_query = final_interrogation_query.filter(Interrogation.user_id.in_(priority_user_ids))
     # We use this to not retrieve already retrieved with priority_users
     retrieve_limit = 100
     if excluded_forms is not None:
@@ -1179,10 +1461,59 @@ def get_sorted_forms_filtered_to_worker(worker, forms_list=None, priority_user_i
         retrieve_limit -= len(excluded_form_ids)
         if retrieve_limit <= 0:
             retrieve_limit = 1
-        final_interrogation_query.filter(InterrogationForms.id.not_in(excluded_form_ids))
+        if len(excluded_form_ids) > 0:
+            final_interrogation_query = final_interrogation_query.filter(InterrogationForms.id.not_in(excluded_form_ids))
     return final_interrogation_query.limit(retrieve_limit).all()
 
 
+def claim_interrogation_forms(worker, forms, amount):
+    """Atomically moves up to `amount` of the provided forms from WAITING to PROCESSING for this worker.
+    The claim is a single UPDATE, which skips any forms being locked by another worker's claim at the same time.
+    The claimed forms are loaded from the UPDATE itself and returned in the same order they were provided.
+    The caller has to commit once it has read what it needs from them, so that they don't have to be loaded again.
+    """
+    if amount <= 0 or len(forms) == 0:
+        return []
+    form_ids = [f.id for f in forms]
+    claimable_ids = (
+        select(InterrogationForms.id)
+        .where(
+            InterrogationForms.id.in_(form_ids),
+            InterrogationForms.state == State.WAITING,
+        )
+        .order_by(InterrogationForms.extra_priority.desc(), InterrogationForms.created.asc())
+        .limit(amount)
+        .with_for_update(skip_locked=True)
+    )
+    claim_statement = (
+        update(InterrogationForms)
+        .where(InterrogationForms.id.in_(claimable_ids))
+        .values(
+            state=State.PROCESSING,
+            worker_id=worker.id,
+            initiated=datetime.utcnow(),
+            expiry=get_interrogation_form_expiry_date(),
+        )
+        .returning(InterrogationForms)
+    )
+    claimed_forms = (
+        db.session.execute(
+            select(InterrogationForms).from_statement(claim_statement).execution_options(populate_existing=True),
+        )
+        .scalars()
+        .all()
+    )
+    if len(claimed_forms) == 0:
+        return []
+    # The interrogations stay alive as long as their forms are being worked on
+    db.session.query(Interrogation).filter(Interrogation.id.in_({form.i_id for form in claimed_forms})).update(
+        {Interrogation.expiry: get_expiry_date()},
+        synchronize_session=False,
+    )
+    form_order = {str(form_id): index for index, form_id in enumerate(form_ids)}
+    return sorted(claimed_forms, key=lambda form: form_order[str(form.id)])
+
+
 # Returns the queue position of the provided WP based on kudos
 # Also returns the amount of things until the wp is generated
 # Also returns the amount of different gens queued
@@ -1285,48 +1616,20 @@ def get_all_active_wps():
     )
 
 
-# TODO: Convert below three functions into a general "cached db request" (or something) class
-# Which I can reuse to cache the results of other requests
 def retrieve_worker_performances(worker_type=ImageWorker):
     avg_perf = db.session.query(func.avg(WorkerPerformance.performance)).join(worker_type).scalar()
     avg_perf = 0 if avg_perf is None else round(avg_perf, 2)
     return avg_perf  # noqa RET504
 
 
-def refresh_worker_performances_cache(request_type="image"):
-    ret_dict = {
-        "image": retrieve_worker_performances(ImageWorker),
-        "text": retrieve_worker_performances(TextWorker),
-    }
-    try:
-        hr.horde_r_setex("worker_performances_avg_cache", timedelta(seconds=30), ret_dict["image"])
-        hr.horde_r_setex(
-            "text_worker_performances_avg_cache",
-            timedelta(seconds=30),
-            ret_dict["text"],
-        )
-    except Exception as err:
-        logger.debug(f"Error when trying to set worker performances cache: {err}. Retrieving from DB.")
-    return ret_dict[request_type]
-
-
+@cached_query("request_avg", ttl=30, stale_ttl=300, key_func=lambda request_type="image": request_type)
 def get_request_avg(request_type="image"):
-    if hr.horde_r is None:
-        return retrieve_worker_performances(WORKER_CLASS_MAP[request_type])
-    if request_type == "image":
-        perf_cache = hr.horde_r_get("worker_performances_avg_cache")
-    else:
-        perf_cache = hr.horde_r_get("text_worker_performances_avg_cache")
-    if not perf_cache:
-        return refresh_worker_performances_cache(request_type)
-    return float(perf_cache)
+    return retrieve_worker_performances(WORKER_CLASS_MAP[request_type])
 
 
+@cached_query("wp_validity", ttl=60, key_func=lambda wp: wp.id)
 def wp_has_valid_workers(wp):
     # return True # FIXME: Still too heavy on the amount of data retrieved
-    cached_validity = hr.horde_r_get(f"wp_validity_{wp.id}")
-    if cached_validity is not None:
-        return bool(int(cached_validity))
     # tic = time.time()
     if wp.faulted:
         return []
@@ -1339,6 +1642,14 @@ def wp_has_valid_workers(wp):
         worker_class = InterrogationWorker
     models_list = wp.get_model_names()
     worker_ids = wp.get_worker_ids()
+    if len(worker_ids) > 0 and wp.worker_blacklist is False:
+        # Only these workers can pick it up, so if none of them is active, we don't need to look any further
+        worker_entries = get_worker_directory_entries(worker_ids)
+        if not any(
+            worker_entry is not None and worker_entry["active"] and worker_entry["type"] == wp.wp_type
+            for worker_entry in worker_entries.values()
+        ):
+            return False
     final_worker_list = (
         db.session.query(worker_class)
         .options(
@@ -1452,7 +1763,6 @@ def wp_has_valid_workers(wp):
         if worker.can_generate(wp)[0]:
             worker_found = True
     # logger.debug(time.time() - tic)
-    hr.horde_r_setex(f"wp_validity_{wp.id}", timedelta(seconds=60), int(worker_found))
     return worker_found
 
 
@@ -1637,18 +1947,9 @@ def retrieve_available_collections(
     return style_query.order_by(style_order_by).offset(page).limit(25).all()
 
 
-def get_all_active_worker_messages(worker_id):
-    return (
-        db.session.query(WorkerMessage)
-        .filter(
-            or_(
-                WorkerMessage.worker_id == worker_id,
-                WorkerMessage.worker_id.is_(None),
-            ),
-            WorkerMessage.expiry > datetime.utcnow(),
-        )
-        .all()
-    )
+def get_active_worker_messages():
+    """Returns the active messages of all workers, along with the messages for every worker"""
+    return db.session.query(WorkerMessage).filter(WorkerMessage.expiry > datetime.utcnow()).all()
 
 
 def get_worker_messages(user_id=None, worker_id=None, validity="all", page=0):
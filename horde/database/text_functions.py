@@ -2,11 +2,10 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import json
 import uuid
 from datetime import datetime, timedelta
 
-from sqlalchemy import and_, func, or_
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import noload
 
 import horde.classes.base.stats as stats
@@ -14,14 +13,12 @@ from horde.bridge_reference import (
     is_backed_validated,
 )
 from horde.classes.base.waiting_prompt import WPAllowedWorkers, WPModels
-from horde.classes.base.worker import WorkerPerformance
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 
 # FIXME: Renamed for backwards compat. To fix later
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
 from horde.database.functions import query_prioritized_wps
 from horde.flask import SQLITE_MODE, db
-from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.model_reference import model_reference
 
@@ -149,39 +146,6 @@ def get_all_text_wps():
     )
 
 
-def get_cached_worker_performance():
-    if hr.horde_r is None:
-        return [p.performance for p in db.session.query(WorkerPerformance.performance).all()]
-    perf_cache = hr.horde_r.get("worker_performances_cache")
-    if not perf_cache:
-        return refresh_worker_performances_cache()
-    try:
-        models_ret = json.loads(perf_cache)
-    except TypeError:
-        logger.error("performance cache could not be loaded: {perf_cache}")
-        return refresh_worker_performances_cache()
-    if models_ret is None:
-        return refresh_worker_performances_cache()
-    return models_ret
-
-
-# TODO: Convert below three functions into a general "cached db request" (or something) class
-# Which I can reuse to cache the results of other requests
-def retrieve_worker_performances():
-    avg_perf = db.session.query(func.avg(WorkerPerformance.performance)).scalar()
-    avg_perf = 0 if avg_perf is None else round(avg_perf, 2)
-    return avg_perf  # noqa RET504
-
-
-def refresh_worker_performances_cache():
-    avg_perf = retrieve_worker_performances()
-    try:
-        hr.horde_r_setex("worker_performances_avg_cache", timedelta(seconds=30), avg_perf)
-    except Exception as e:
-        logger.debug(f"Error when trying to set worker performances cache: {e}. Retrieving from DB.")
-    return avg_perf
-
-
 def query_prioritized_text_wps():
     return query_prioritized_wps()
 
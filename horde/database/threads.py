@@ -10,22 +10,27 @@ import patreon
 from sqlalchemy import func, or_
 
 from horde.argparser import args
+from horde.classes.base.lifetime_totals import recompute_lifetime_totals, verify_lifetime_totals
 from horde.classes.base.user import User
+from horde.classes.kobold.genstats import compile_textgen_stats_totals, prune_compiled_textgen_stats
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
+from horde.classes.stable.genstats import compile_imagegen_stats_totals, prune_compiled_imagegen_stats
 from horde.classes.stable.interrogation import Interrogation, InterrogationForms
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 
 # FIXME: Renamed for backwards compat. To fix later
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.database.functions import (
+    available_models_cache,
     compile_regex_filter,
-    count_totals,
-    get_active_workers,
-    get_available_models,
+    get_active_worker_snapshots,
     prune_expired_stats,
     query_prioritized_wps,
+    rebuild_worker_directory,
+    reconcile_inflight_counters,
     retrieve_regex_replacements,
+    totals_cache,
 )
 from horde.enums import State
 from horde.flask import HORDE, SQLITE_MODE, db
@@ -104,22 +109,16 @@ def store_prioritized_wp_queue():
 def store_worker_list():
     """Stores the retrieved worker details as json for 300 seconds horde-wide"""
     with HORDE.app_context():
-        serialized_workers = []
-        serialized_workers_privileged = []
-        # This is too slow. Needs heavy caching currently
-        # TODO: Figure out a way to get only the info I need from the DB query and format it into json by hand?
-        for worker in get_active_workers():
-            serialized_workers.append(worker.get_details())
-            serialized_workers_privileged.append(worker.get_details(2))
-        json_workers = json.dumps(serialized_workers)
-        json_workers_privileged = json.dumps(serialized_workers_privileged)
+        serialized_workers, serialized_workers_privileged = get_active_worker_snapshots()
         try:
-            hr.horde_r_setex("worker_cache", timedelta(seconds=300), json_workers)
-            hr.horde_r_setex(
+            hr.horde_r_setex_json("worker_cache", timedelta(seconds=300), serialized_workers)
+            hr.horde_r_setex_json(
                 "worker_cache_privileged",
                 timedelta(seconds=300),
-                json_workers_privileged,
+                serialized_workers_privileged,
             )
+            # Lets the API reuse its encoded responses until the next rebuild
+            hr.horde_r_setex("worker_cache_version", timedelta(seconds=300), datetime.utcnow().isoformat())
         except (TypeError, OverflowError) as err:
             logger.error(f"Failed serializing workers with error: {err}")
 
@@ -267,33 +266,56 @@ def check_interrogations():
 
 @logger.catch(reraise=True)
 def store_available_models():
-    """Stores the retrieved model details as json for 5 seconds horde-wide"""
+    """Refreshes the cached model details horde-wide"""
     with HORDE.app_context():
-        json_models = json.dumps(get_available_models())
-        try:
-            hr.horde_r_setex("models_cache", timedelta(seconds=600), json_models)
-        except (TypeError, OverflowError) as err:
-            logger.error(f"Failed serializing workers with error: {err}")
+        available_models_cache.refresh()
 
 
 @logger.catch(reraise=True)
 def store_totals():
-    """Stores the calculated totals as json.
-    This is never expired to avoid ending up with massive operations in case the thread dies
-    """
+    """Refreshes the cached totals horde-wide"""
     with HORDE.app_context():
-        json_totals = json.dumps(count_totals())
-        try:
-            hr.horde_r_set("totals_cache", json_totals)
-        except (TypeError, OverflowError) as err:
-            logger.error(f"Failed serializing totals with error: {err}")
+        totals_cache.refresh()
+
+
+@logger.catch(reraise=True)
+def compile_stats_totals():
+    """Compiles the generation statistics totals from their incremental rollups"""
+    with HORDE.app_context():
+        compile_imagegen_stats_totals()
+        compile_textgen_stats_totals()
+
+
+@logger.catch(reraise=True)
+def store_worker_directory():
+    """Rebuilds the worker directory from the DB, to correct any drift"""
+    with HORDE.app_context():
+        rebuild_worker_directory()
+
+
+@logger.catch(reraise=True)
+def reconcile_inflight():
+    """Corrects any drift of the in-flight jobs counters"""
+    with HORDE.app_context():
+        reconcile_inflight_counters()
+
+
+@logger.catch(reraise=True)
+def check_lifetime_totals():
+    """Verifies the lifetime contribution totals against the existing workers and corrects any which fell behind"""
+    with HORDE.app_context():
+        verify_lifetime_totals()
+        corrections = recompute_lifetime_totals()
+        logger.info(f"Lifetime totals corrections: {corrections}")
 
 
 @logger.catch(reraise=True)
 def prune_stats():
-    """Prunes performances which are too old"""
+    """Prunes performances and compiled statistics which are too old"""
     with HORDE.app_context():
         prune_expired_stats()
+        prune_compiled_imagegen_stats()
+        prune_compiled_textgen_stats()
 
 
 @logger.catch(reraise=True)
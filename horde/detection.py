@@ -6,9 +6,7 @@ import json
 from datetime import datetime
 
 import dateutil.relativedelta
-import emoji
 import regex as re
-from unidecode import unidecode
 
 from horde.argparser import args
 from horde.database.functions import compile_regex_filter, retrieve_regex_replacements
@@ -16,6 +14,14 @@ from horde.flask import HORDE, SQLITE_MODE  # Local Testing
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.model_reference import model_reference
+from horde.prompt_filter import (
+    CompiledPromptFilter,
+    PromptVerdictCache,
+    find_suspicious_emojis,
+    get_filter_set_version,
+    get_prompt_digest,
+    normalize_prompt,
+)
 
 
 class PromptChecker:
@@ -33,10 +39,15 @@ class PromptChecker:
             "filter_20": None,
         }
         self.replacements = []
+        self.stored_replacements = None
         # Used for scripting outside of this class
         self.known_ids = [10, 11, 20]
         self.filters1 = ["filter_10", "filter_11"]
         self.filters2 = ["filter_20"]
+        self.filter_engine = CompiledPromptFilter(self.regex, [self.filters1, self.filters2])
+        # Results are cached against the version of the filters which produced them
+        self.filter_version = None
+        self.verdict_cache = PromptVerdictCache()
         self.next_refresh = datetime.utcnow()
         self.refresh_regex()
         # These are checked on top of the normal
@@ -69,9 +80,6 @@ class PromptChecker:
                 "replacement": "adult man",
             },
         ]
-        self.weight_remover = re.compile(r"\((.*?):\d+\.\d+\)")
-        self.whitespace_remover = re.compile(r"(\s(\w)){3,}\b")
-        self.whitespace_converter = re.compile(r"([^\w\s]|_)")
         self.csam_triggers = re.compile(r"\b(0?[0-9]|1[0-9]|2[0-2])(?![0-9]) *years? *old")
 
     def refresh_regex(self):
@@ -91,6 +99,7 @@ class PromptChecker:
             except Exception:
                 logger.warning("Errors when loading cached regex replacements in redis! Check threads!")
                 stored_replacements = []
+        filters_changed = False
         for _id in [10, 11, 20]:
             filter_id = f"filter_{_id}"
             if SQLITE_MODE:
@@ -105,7 +114,13 @@ class PromptChecker:
             if self.regex[filter_id] != stored_filter:
                 self.compiled[filter_id] = re.compile(stored_filter, re.IGNORECASE)
                 self.regex[filter_id] = stored_filter
+                filters_changed = True
                 # logger.debug(self.compiled[filter_id])
+        if filters_changed:
+            self.filter_engine = CompiledPromptFilter(self.regex, [self.filters1, self.filters2])
+            if not self.filter_engine.can_prefilter:
+                logger.warning("Could not combine the prompt filters into a prefilter. Checking them separately.")
+        if stored_replacements != self.stored_replacements:
             self.replacements = [
                 {
                     "regex": re.compile(f_entry["regex"], re.IGNORECASE),
@@ -113,119 +128,29 @@ class PromptChecker:
                 }
                 for f_entry in stored_replacements
             ]
+            self.stored_replacements = stored_replacements
+        filter_version = get_filter_set_version(self.regex, self.stored_replacements)
+        if filter_version != self.filter_version:
+            self.filter_version = filter_version
+            self.verdict_cache.clear()
         self.next_refresh = datetime.utcnow() + dateutil.relativedelta.relativedelta(minutes=1)
 
     def __call__(self, prompt, _id=None):
         if args.disable_filters:
             return 0, []
         self.refresh_regex()
-        prompt_suspicion = 0
         if "###" in prompt:
             prompt, negprompt = prompt.split("###", 1)
+        only_filter = f"filter_{_id}" if _id else None
         norm_prompt = self.normalize_prompt(prompt)
-        # logger.debug(prompt)
-        matching_groups = []
-        for filters in [self.filters1, self.filters2]:
-            for filter_id in filters:
-                # This allows to check only a specific filter ID
-                if _id and filter_id != f"filter_{_id}":
-                    continue
-                # We only need 1 of the filters in the group to match to increase suspicion
-                # Suspicion does not increase further for more filters in the same group
-                existing_emojis = emoji.emoji_list(prompt)
-                if filter_id == "filter_10" and len(existing_emojis):
-                    found_sus = False
-                    emj_list = [emj["emoji"] for emj in existing_emojis]
-                    for emj in [
-                        "👧",
-                        "👧🏻",
-                        "👧🏼",
-                        "👧🏽",
-                        "👧🏾",
-                        "👧🏿",
-                        "👦",
-                        "👦🏻",
-                        "👦🏼",
-                        "👦🏽",
-                        "👦🏾",
-                        "👦🏿",
-                        "👶🏻",
-                        "👶",
-                        "👶🏼",
-                        "👶🏽",
-                        "👶🏾",
-                        "👶🏿",
-                        "👪",
-                        "👨‍👩‍👧",
-                        "👨‍👩‍👦‍👦",
-                        "👨‍👩‍👧‍👦",
-                        "👨‍👩‍👧‍👧",
-                        "👨‍👨‍👧‍👧",
-                        "👨‍👨‍👧‍👦",
-                        "👨‍👨‍👦‍👦",
-                        "👩‍👩‍👧",
-                        "👩‍👩‍👦",
-                        "👩‍👩‍👧‍👦",
-                        "👩‍👩‍👧‍👦",
-                        "👨‍👦",
-                        "👨‍👧",
-                        "👨‍👧‍👦",
-                        "👨‍👦‍👦",
-                        "👨‍👧‍👧",
-                        "👩‍👦",
-                        "👩‍👧",
-                        "👩‍👧‍👦",
-                        "👩‍👦‍👦",
-                        "👩‍👧‍👧",
-                        "🤱",
-                        "🤱🏻",
-                        "🤱🏼",
-                        "🤱🏽",
-                        "🤱🏾",
-                        "🤱🏿",
-                        "🧑‍🍼",
-                        "🧑🏻‍🍼",
-                        "🧑🏼‍🍼",
-                        "🧑🏽‍🍼",
-                        "🧑🏾‍🍼",
-                        "🧑🏿‍🍼",
-                        "👨‍🍼",
-                        "👨🏻‍🍼",
-                        "👨🏼‍🍼",
-                        "👨🏽‍🍼",
-                        "👨🏾‍🍼",
-                        "👨🏿‍🍼",
-                        "👩‍🍼",
-                        "👩🏻‍🍼",
-                        "👩🏼‍🍼",
-                        "👩🏽‍🍼",
-                        "👩🏾‍🍼",
-                        "👩🏿‍🍼",
-                        "👼",
-                        "👼🏻",
-                        "👼🏼",
-                        "👼🏽",
-                        "👼🏾",
-                        "👼🏿",
-                        "🐤",
-                        "🐥",
-                        "🚼",
-                        "🍼",
-                        "🚸",
-                    ]:
-                        if emj in emj_list:
-                            matching_groups.append(emj)
-                            found_sus = True
-                    if found_sus:
-                        prompt_suspicion += 1
-                        break
-                if self.compiled[filter_id]:
-                    match_result = self.compiled[filter_id].search(norm_prompt)
-                    if match_result:
-                        prompt_suspicion += 1
-                        matching_groups.append(match_result.group())
-                        break
-        return prompt_suspicion, matching_groups
+        suspicious_emojis = find_suspicious_emojis(prompt)
+        cache_key = (self.filter_version, only_filter, get_prompt_digest(norm_prompt, suspicious_emojis))
+        verdict = self.verdict_cache.get(cache_key)
+        if verdict is None:
+            prompt_suspicion, matching_groups = self.filter_engine.scan(prompt, only_filter, norm_prompt, suspicious_emojis)
+            verdict = (prompt_suspicion, tuple(matching_groups))
+            self.verdict_cache.set(cache_key, verdict)
+        return verdict[0], list(verdict[1])
 
     def check_nsfw_model_block(self, prompt, models):
         if args.disable_filters:
@@ -302,9 +227,15 @@ class PromptChecker:
         # we also force the prompt to be normalized to avoid tricks, so nothing will escape the replacement regex
         # this means prompt weights are lost, but it is fine for textgen image prompts
         prompt = self.normalize_prompt(prompt)
-        # go through each filter rule and replace any matches sequentially
-        for filter_entry in self.replacements:
-            prompt = filter_entry["regex"].sub(filter_entry["replacement"], prompt)
+        cache_key = (self.filter_version, "replacement", get_prompt_digest(prompt))
+        cached_prompt = self.verdict_cache.get(cache_key)
+        if cached_prompt is not None:
+            prompt = cached_prompt
+        else:
+            # go through each filter rule and replace any matches sequentially
+            for filter_entry in self.replacements:
+                prompt = filter_entry["regex"].sub(filter_entry["replacement"], prompt)
+            self.verdict_cache.set(cache_key, prompt)
         # if regex has eaten the entire prompt, we return None, which will use the previous approach of IP block.
         if prompt.strip() == "":
             return None
@@ -319,15 +250,7 @@ class PromptChecker:
 
     def normalize_prompt(self, prompt):
         """Prepares the prompt to be scanned by the regex, by removing tricks one might use to avoid the filters"""
-        prompt = self.weight_remover.sub(r"\1", prompt)
-        prompt = self.whitespace_converter.sub(" ", prompt)
-        for match in re.finditer(self.whitespace_remover, prompt):
-            trim_match = match.group(0).strip()
-            replacement = re.sub(r"\s+", "", trim_match)
-            prompt = prompt.replace(trim_match, replacement)
-        prompt = re.sub(r"\s+", " ", prompt)
-        # Remove all accents
-        return unidecode(prompt)
+        return normalize_prompt(prompt)
 
 
 prompt_checker = PromptChecker()
@@ -0,0 +1,210 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from uuid import uuid4
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+# How many evidence records can wait for upload. Anything beyond that is dropped.
+EVIDENCE_QUEUE_SIZE = int(os.getenv("HORDE_EVIDENCE_QUEUE_SIZE", 1000))
+EVIDENCE_BATCH_SIZE = int(os.getenv("HORDE_EVIDENCE_BATCH_SIZE", 20))
+# How long the uploader waits before retrying after its sink failed
+EVIDENCE_RETRY_DELAY = 10
+
+
+class R2EvidenceSink:
+    """Uploads each evidence record as its own json file in the prompts bucket"""
+
+    def write(self, filename, record):
+        # Imported here so that the local sink can be used without any R2 credentials
+        from horde.r2 import upload_prompt
+
+        return upload_prompt(record, filename)
+
+
+class LocalEvidenceSink:
+    """Writes each evidence record as a json file in a local directory, for running a horde without R2"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def write(self, filename, record):
+        with open(self.directory / filename, "w") as f:
+            json.dump(record, f, indent=4)
+        return True
+
+
+def get_evidence_sink():
+    """Returns the sink selected via the env vars"""
+    if os.getenv("HORDE_EVIDENCE_SINK", "r2") == "local":
+        return LocalEvidenceSink(os.getenv("HORDE_EVIDENCE_LOCAL_DIR", "evidence"))
+    return R2EvidenceSink()
+
+
+class MemoryEvidenceBuffer:
+    """Keeps the evidence waiting for upload in this process"""
+
+    def __init__(self, max_size):
+        self.records = queue.Queue(maxsize=max_size)
+
+    def push(self, entry):
+        try:
+            self.records.put_nowait(entry)
+        except queue.Full:
+            return False
+        return True
+
+    def pop_batch(self, batch_size, timeout):
+        try:
+            batch = [self.records.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < batch_size:
+            try:
+                batch.append(self.records.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __len__(self):
+        return self.records.qsize()
+
+
+class RedisEvidenceBuffer:
+    """Keeps the evidence waiting for upload in a redis list, so that it survives restarts
+    Any node with an uploader running drains it.
+    """
+
+    key = "evidence_queue"
+
+    def __init__(self, redis_db, max_size):
+        self.redis_db = redis_db
+        self.max_size = max_size
+
+    def push(self, entry):
+        try:
+            # The size check is not atomic with the push, so a busy horde can overshoot by a few records
+            if self.redis_db.llen(self.key) >= self.max_size:
+                return False
+            self.redis_db.rpush(self.key, json.dumps(entry))
+        except Exception as err:
+            logger.warning(f"Could not queue evidence in redis: {err}")
+            return False
+        return True
+
+    def pop_batch(self, batch_size, timeout):
+        try:
+            pipe = self.redis_db.pipeline(transaction=True)
+            pipe.lrange(self.key, 0, batch_size - 1)
+            pipe.ltrim(self.key, batch_size, -1)
+            batch = pipe.execute()[0]
+        except Exception as err:
+            logger.warning(f"Could not retrieve evidence from redis: {err}")
+            batch = []
+        if not batch:
+            time.sleep(timeout)
+            return []
+        return [json.loads(entry) for entry in batch]
+
+    def __len__(self):
+        try:
+            return self.redis_db.llen(self.key)
+        except Exception:
+            return 0
+
+
+class EvidenceQueue:
+    """Uploads moderation evidence from a background thread, so that rejecting a request never waits on storage.
+    When the buffer is full, new evidence is dropped and counted, instead of slowing down the request threads.
+    """
+
+    def __init__(self, sink, buffer, batch_size=EVIDENCE_BATCH_SIZE):
+        self.sink = sink
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.uploader = None
+        # Guards the uploader and the stats, which are updated from both the request threads and the uploader
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.uploaded = 0
+        self.failed = 0
+
+    def submit(self, record):
+        """Queues the record for upload. Returns False if it had to be dropped."""
+        self.ensure_uploader()
+        if not self.buffer.push({"filename": f"{uuid4()}.json", "record": record}):
+            with self.lock:
+                self.dropped += 1
+            logger.warning(f"Evidence queue is full. Dropped evidence of type {record.get('type')}")
+            return False
+        with self.lock:
+            self.queued += 1
+        return True
+
+    def ensure_uploader(self):
+        if self.uploader is not None:
+            return
+        with self.lock:
+            if self.uploader is None:
+                self.uploader = threading.Thread(target=self.upload_loop, name="evidence_uploader", daemon=True)
+                self.uploader.start()
+
+    def upload_batch(self, batch):
+        """Uploads the batch and returns the entries which failed"""
+        failed_entries = []
+        for entry in batch:
+            try:
+                uploaded = self.sink.write(entry["filename"], entry["record"])
+            except Exception as err:
+                logger.error(f"Error encountered while uploading evidence {entry['filename']}: {err}")
+                uploaded = False
+            if uploaded is False:
+                failed_entries.append(entry)
+        with self.lock:
+            self.uploaded += len(batch) - len(failed_entries)
+        return failed_entries
+
+    def upload_loop(self):
+        while True:
+            batch = self.buffer.pop_batch(self.batch_size, timeout=1)
+            if not batch:
+                continue
+            failed_entries = self.upload_batch(batch)
+            if not failed_entries:
+                continue
+            # We put them back for later, unless the buffer filled up in the meantime
+            dropped = sum(1 for entry in failed_entries if not self.buffer.push(entry))
+            with self.lock:
+                self.failed += len(failed_entries)
+                self.dropped += dropped
+            time.sleep(EVIDENCE_RETRY_DELAY)
+
+    def get_stats(self):
+        pending = len(self.buffer)
+        with self.lock:
+            return {
+                "pending": pending,
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "uploaded": self.uploaded,
+                "failed": self.failed,
+            }
+
+
+def get_evidence_buffer():
+    if hr.horde_r:
+        return RedisEvidenceBuffer(hr.horde_r, EVIDENCE_QUEUE_SIZE)
+    return MemoryEvidenceBuffer(EVIDENCE_QUEUE_SIZE)
+
+
+evidence_queue = EvidenceQueue(get_evidence_sink(), get_evidence_buffer())
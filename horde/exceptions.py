@@ -2,6 +2,8 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import math
+
 from werkzeug import exceptions as wze
 
 from horde.logger import logger
@@ -78,6 +80,7 @@ KNOWN_RC = [
     "UnsafeIP",
     "TimeoutIP",
     "TooManyNewIPs",
+    "IPCheckPending",
     "KudosUpfront",
     "SharedKeyInvalid",
     "SharedKeyEmpty",
@@ -547,6 +550,13 @@ class RequestExpired(wze.Gone):
         self.rc = rc
 
 
+class IPCheckPending(wze.TooManyRequests):
+    def __init__(self, ipaddr, rc="IPCheckPending"):
+        self.specific = "We are still checking your IP. Please try again in a few seconds."
+        self.log = f"IP {ipaddr} is still being checked. Asked to retry"
+        self.rc = rc
+
+
 class TooManyPrompts(wze.TooManyRequests):
     def __init__(self, username, count, concurrency, msg=None, rc="TooManyPrompts"):
         if msg is None:
@@ -560,6 +570,14 @@ class TooManyPrompts(wze.TooManyRequests):
         self.rc = rc
 
 
+class RateLimitExceeded(wze.TooManyRequests):
+    def __init__(self, retry_after, rc="RateLimitExceeded"):
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.specific = f"Too many requests. Please try again in {self.retry_after} seconds."
+        self.log = None
+        self.rc = rc
+
+
 class NoValidWorkers(wze.BadRequest):
     retry_after = 600
 
@@ -589,3 +607,15 @@ def handle_bad_requests(error):
         },
         error.code,
     )
+
+
+def handle_rate_limit_exceeded(error):
+    """Namespace error handler which also tells the client when to retry"""
+    return (
+        {
+            "message": error.specific,
+            "rc": error.rc,
+        },
+        error.code,
+        {"Retry-After": str(error.retry_after)},
+    )
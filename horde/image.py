@@ -3,14 +3,21 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import base64
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 
 import requests
 from PIL import Image, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
 
 from horde.exceptions import ImageValidationFailed
 from horde.logger import logger
-from horde.r2 import upload_source_image
+from horde.r2 import upload_source_image_webp
+from horde.transcoder import SOURCE_IMAGE_MAX_PIXELS, image_transcoder
+
+SOURCE_IMAGE_MAX_BYTES = 5 * 1024 * 1024
 
 
 def convert_b64_to_pil(source_image_b64):
@@ -33,52 +40,17 @@ def convert_pil_to_b64(source_image, quality=95):
     return base64.b64encode(img_bytes).decode("utf-8")
 
 
-# TODO: Merge with convert_b64_to_pil()
-def convert_source_image_to_pil(source_image_b64):
-    base64_bytes = source_image_b64.encode("utf-8")
-    img_bytes = base64.b64decode(base64_bytes)
-    image = Image.open(BytesIO(img_bytes))
-    width, height = image.size
-    resolution = width * height
-    resolution_threshold = 3072 * 3072
-    if resolution > resolution_threshold:
-        except_msg = "Image size cannot exceed 3072*3072 pixels"
-        # Not sure e exists here?
-        raise ImageValidationFailed(except_msg, rc="SourceImageResolutionExceeded")
-    quality = 100
-    # We adjust the amount of compression based on the starting image to avoid running out of bandwidth
-    if resolution > resolution_threshold * 0.9:
-        quality = 50
-    elif resolution > resolution_threshold * 0.8:
-        quality = 60
-    elif resolution > resolution_threshold * 0.6:
-        logger.debug([resolution, resolution_threshold * 0.6])
-        quality = 70
-    elif resolution > resolution_threshold * 0.4:
-        logger.debug([resolution, resolution_threshold * 0.4])
-        quality = 80
-    elif resolution > resolution_threshold * 0.3:
-        logger.debug([resolution, resolution_threshold * 0.4])
-        quality = 90
-    elif resolution > resolution_threshold * 0.15:
-        quality = 95
-
-    return image, quality, width, height
-
-
 def convert_source_image_to_webp(source_image_b64):
     """Convert img2img sources to 90% compressed webp, to avoid wasting bandwidth, while still supporting all types"""
     try:
         if source_image_b64 is None:
             return source_image_b64
-        image, quality, width, height = convert_source_image_to_pil(source_image_b64)
-        buffer = BytesIO()
-        image.save(buffer, format="WebP", quality=quality, exact=True)
-        final_image_b64 = base64.b64encode(buffer.getvalue()).decode("utf8")
+        transcoded = image_transcoder.transcode(source_image_b64, max_pixels=SOURCE_IMAGE_MAX_PIXELS)
+        final_image_b64 = base64.b64encode(transcoded.webp).decode("utf8")
         logger.debug(
-            f"Received img2img source of {width}*{height}. "
+            f"Received img2img source of {transcoded.width}*{transcoded.height}. "
             f"Started {round(len(source_image_b64) / 1000)} base64 kilochars. "
-            f"Ended with quality {quality} = {round(len(final_image_b64) / 1000)} base64 kilochars",
+            f"Ended with quality {transcoded.quality} = {round(len(final_image_b64) / 1000)} base64 kilochars",
         )
         return final_image_b64
     except ImageValidationFailed as err:
@@ -87,58 +59,189 @@ def convert_source_image_to_webp(source_image_b64):
         raise ImageValidationFailed
 
 
-def upload_source_image_to_r2(source_image_b64, uuid_string):
+def upload_source_image_to_r2(source_image_b64, uuid_string, hash_pixels=False):
     """Convert source images to webp and uploads it to r2,
     to avoid wasting bandwidth, while still supporting all types
     """
     try:
         if source_image_b64 is None:
             return (None, None)
-        image, quality, width, height = convert_source_image_to_pil(source_image_b64)
+        transcoded = image_transcoder.transcode(
+            source_image_b64,
+            max_pixels=SOURCE_IMAGE_MAX_PIXELS,
+            quality=50,
+            hash_pixels=hash_pixels,
+        )
         filename = f"{uuid_string}.webp"
-        download_url = upload_source_image(image, filename)
-        return (download_url, image)
+        download_url = upload_source_image_webp(transcoded.webp, filename)
+        return (download_url, transcoded)
     except ImageValidationFailed as err:
         raise err
     except Exception:
         raise ImageValidationFailed
 
 
-def ensure_source_image_uploaded(source_image_string, uuid_string, force_r2=False):
+class FetchedImage:
+    """A source image downloaded from a URL.
+    We only read its headers, so the full decode happens in the transcoder, if at all.
+    """
+
+    __slots__ = ("data", "width", "height", "bands", "transcoded", "pixel_hash")
+
+    def __init__(self, data, width, height, bands):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.bands = bands
+        self.transcoded = {}
+        self.pixel_hash = None
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def getbands(self):
+        return self.bands
+
+    def get_pixel_hash(self):
+        """Returns the sha256 of the decoded pixels. Returns None if the image could not be decoded in time."""
+        if self.pixel_hash is None:
+            try:
+                self.pixel_hash = image_transcoder.hash_pixels(self.data)
+            except ImageValidationFailed as err:
+                logger.warning(f"Could not hash source image pixels: {err.specific}")
+        return self.pixel_hash
+
+    def transcode(self, quality):
+        if quality not in self.transcoded:
+            self.transcoded[quality] = image_transcoder.transcode(
+                self.data,
+                is_b64=False,
+                max_pixels=SOURCE_IMAGE_MAX_PIXELS,
+                quality=quality,
+            )
+        return self.transcoded[quality]
+
+
+def probe_image(img_data):
+    """Returns the (width, height, bands) of an image by reading only its headers
+    Returns None if PIL cannot identify the image from the data we have
+    """
+    try:
+        with Image.open(BytesIO(img_data)) as img:
+            return (img.size[0], img.size[1], img.getbands())
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return None
+
+
+def ensure_image_probe_resolution(image_probe):
+    # Source images from URLs have the same resolution limit as those sent as base64
+    if image_probe and image_probe[0] * image_probe[1] > SOURCE_IMAGE_MAX_PIXELS:
+        raise ImageValidationFailed("Image size cannot exceed 3072*3072 pixels", rc="SourceImageResolutionExceeded")
+
+
+class SourceImageFetcher:
+    """Downloads source images through a shared connection pool and caches them by URL for a short while,
+    so that the same URL sent multiple times (e.g. as extra_source_images) is only fetched once.
+    """
+
+    probe_bytes = 64 * 1024
+
+    def __init__(self, max_bytes=SOURCE_IMAGE_MAX_BYTES, timeout=2, cache_seconds=120, cache_max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache_seconds = cache_seconds
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_cached(self, url):
+        with self.lock:
+            cached = self.cache.get(url)
+            if cached is None:
+                return None
+            expiry, fetched_image = cached
+            if time.monotonic() > expiry:
+                del self.cache[url]
+                self.cache_bytes -= len(fetched_image.data)
+                return None
+            self.cache.move_to_end(url)
+            return fetched_image
+
+    def store_cached(self, url, fetched_image):
+        if len(fetched_image.data) > self.cache_max_bytes:
+            return
+        with self.lock:
+            if url in self.cache:
+                return
+            self.cache[url] = (time.monotonic() + self.cache_seconds, fetched_image)
+            self.cache_bytes += len(fetched_image.data)
+            while self.cache_bytes > self.cache_max_bytes:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted.data)
+
+    def download(self, url):
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            size = int(r.headers.get("Content-Length", 0))
+            if size > self.max_bytes:
+                raise ImageValidationFailed("Provided image cannot be larger than 5Mb", rc="SourceImageSizeExceeded")
+            # Preallocate when we know the size, so that we don't keep copying the data as it arrives
+            img_data = bytearray(size)
+            received = 0
+            probed = False
+            for chunk in r.iter_content(chunk_size=self.probe_bytes):
+                if not chunk:
+                    continue
+                chunk_end = received + len(chunk)
+                if chunk_end > self.max_bytes:
+                    raise ImageValidationFailed("Provided image cannot be larger than 5Mb", rc="SourceImageSizeExceeded")
+                img_data[received:chunk_end] = chunk
+                received = chunk_end
+                if not probed and received >= self.probe_bytes:
+                    probed = True
+                    # Most formats have their dimensions in the first few bytes
+                    # which allows us to stop downloading oversized images early
+                    ensure_image_probe_resolution(probe_image(bytes(img_data[:received])))
+            del img_data[received:]
+            return img_data
+
+    def fetch(self, url):
+        fetched_image = self.get_cached(url)
+        if fetched_image is not None:
+            return fetched_image
+        img_data = self.download(url)
+        image_probe = probe_image(img_data)
+        if image_probe is None:
+            raise ImageValidationFailed("Url does not contain a valid image.", rc="SourceImageUrlInvalid")
+        ensure_image_probe_resolution(image_probe)
+        fetched_image = FetchedImage(img_data, *image_probe)
+        self.store_cached(url, fetched_image)
+        return fetched_image
+
+
+source_image_fetcher = SourceImageFetcher()
+
+
+def ensure_source_image_uploaded(source_image_string, uuid_string, force_r2=False, hash_pixels=False):
     if source_image_string.startswith("http"):
         try:
-            with requests.get(source_image_string, stream=True, timeout=2) as r:
-                size = r.headers.get("Content-Length", 0)
-                # if not size:
-                #     raise ImageValidationFailed("Source image URL must provide a Content-Length header")
-                if int(size) / 1024 > 5000:
-                    raise ImageValidationFailed("Provided image cannot be larger than 5Mb", rc="SourceImageSizeExceeded")
-                mbs = 0
-                for chunk in r.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        if mbs == 0:
-                            img_data = chunk
-                        else:
-                            img_data += chunk
-                        mbs += 1
-                        if mbs > 5:
-                            raise ImageValidationFailed("Provided image cannot be larger than 5Mb", rc="SourceImageSizeExceeded")
-                try:
-                    img = Image.open(BytesIO(img_data))
-                except UnidentifiedImageError:
-                    raise ImageValidationFailed("Url does not contain a valid image.", rc="SourceImageUrlInvalid")
-                except Exception:
-                    raise ImageValidationFailed("Something went wrong when opening image.", rc="SourceImageUnreadable")
-                if force_r2:
-                    logger.debug(f"uploading {img} {uuid_string}")
-                    download_url = upload_source_image(img, uuid_string)
-                    return (download_url, img, True)
+            img = source_image_fetcher.fetch(source_image_string)
+            if force_r2:
+                transcoded = img.transcode(quality=50)
+                logger.debug(f"uploading {img.width}*{img.height} {uuid_string}")
+                download_url = upload_source_image_webp(transcoded.webp, uuid_string)
+                return (download_url, img, True)
         except Exception as err:
             if type(err) == ImageValidationFailed:
                 raise err
             raise ImageValidationFailed("Something went wrong when retrieving image url.")
         return (source_image_string, img, False)
-    download_url, img = upload_source_image_to_r2(source_image_string, uuid_string)
+    download_url, img = upload_source_image_to_r2(source_image_string, uuid_string, hash_pixels)
     return (download_url, img, True)
 
 
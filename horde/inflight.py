@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from datetime import timedelta
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+# The counters are only trusted while the reconciler keeps running
+INFLIGHT_RECONCILED_TTL = timedelta(minutes=5)
+
+# Applies the corrections of the reconciler as increments, so that it doesn't overwrite the changes
+# committed while it was counting. KEYS[1] is the set of counter keys, followed by the counters to correct.
+# Counters which end up at 0 are removed.
+INFLIGHT_CORRECTION_SCRIPT = """
+for i = 2, #KEYS do
+    local value = redis.call('INCRBY', KEYS[i], ARGV[i - 1])
+    if value == 0 then
+        redis.call('DEL', KEYS[i])
+        redis.call('SREM', KEYS[1], KEYS[i])
+    else
+        redis.call('SADD', KEYS[1], KEYS[i])
+    end
+end
+return 1
+"""
+
+
+class InFlightCounters:
+    """Counts the jobs each user has waiting in active requests, and for the anonymous user also per model.
+    The waiting prompts queue their changes in the DB session. Their counter keys are resolved when the session flushes,
+    and the changes are only applied once it commits.
+    Anything which changes the waiting prompts outside the ORM is corrected by the reconciler.
+    """
+
+    keys_set = "inflight_keys"
+    reconciled_key = "inflight_reconciled"
+
+    def __init__(self):
+        self.correction_script = None
+
+    def get_key(self, wp_type, user_id, model=None):
+        if model is None:
+            return f"inflight_{wp_type}_{user_id}"
+        return f"inflight_{wp_type}_{user_id}_{model}"
+
+    def queue_delta(self, session, source, delta):
+        """Queues a change to the counters of source, whose keys are resolved by resolve_deltas()"""
+        session.info.setdefault("inflight_pending", []).append((source, delta))
+
+    def resolve_deltas(self, session, get_keys):
+        """Turns the queued changes into changes per counter key, using get_keys(source)"""
+        pending = session.info.pop("inflight_pending", None)
+        if not pending:
+            return
+        inflight_deltas = session.info.setdefault("inflight_deltas", {})
+        for source, delta in pending:
+            for key in get_keys(source):
+                inflight_deltas[key] = inflight_deltas.get(key, 0) + delta
+
+    def discard_deltas(self, session):
+        session.info.pop("inflight_pending", None)
+        session.info.pop("inflight_deltas", None)
+
+    def apply_deltas(self, session):
+        # Anything still pending was never flushed, so it didn't change the DB
+        session.info.pop("inflight_pending", None)
+        inflight_deltas = session.info.pop("inflight_deltas", None)
+        if not inflight_deltas or not hr.horde_r:
+            return
+        inflight_deltas = {key: delta for key, delta in inflight_deltas.items() if delta != 0}
+        if not inflight_deltas:
+            return
+        try:
+            pipe = hr.horde_r.pipeline(transaction=False)
+            for key, delta in inflight_deltas.items():
+                pipe.incrby(key, delta)
+            pipe.sadd(self.keys_set, *inflight_deltas)
+            pipe.execute()
+        except Exception as err:
+            logger.warning(f"Could not update the in-flight counters: {err}")
+
+    def get_count(self, wp_type, user_id, models=None):
+        """Returns the jobs this user has waiting, summed over the models if provided
+        Returns None if the counters can't be trusted, in which case they have to be counted in the DB
+        """
+        if not hr.horde_r:
+            return None
+        keys = [self.get_key(wp_type, user_id, model) for model in models] if models else [self.get_key(wp_type, user_id)]
+        try:
+            values = hr.horde_r.mget([self.reconciled_key, *keys])
+        except Exception as err:
+            logger.warning(f"Could not read the in-flight counters: {err}")
+            return None
+        if values[0] is None:
+            return None
+        return sum(max(int(value), 0) for value in values[1:] if value is not None)
+
+    def reconcile(self, counts):
+        """Corrects the counters to the counts of the waiting prompts in the DB
+        counts is a dict of counter key to its actual count. This has to be called right after counting them,
+        as the counters are compared to the values they have now, and only the difference is applied to them.
+        That way, the changes committed after the counters are read are still applied on top of the correction.
+        """
+        if not hr.horde_r:
+            return
+        try:
+            known_keys = {key.decode() if isinstance(key, bytes) else key for key in hr.horde_r.smembers(self.keys_set)}
+            keys = list(known_keys | set(counts))
+            observed = dict(zip(keys, hr.horde_r.mget(keys))) if keys else {}
+            corrections = {key: int(counts.get(key, 0)) - int(observed[key] or 0) for key in keys}
+            # We still send the counters which are already correct, so that the script removes them if they're 0
+            if corrections:
+                if self.correction_script is None:
+                    self.correction_script = hr.horde_r.register_script(INFLIGHT_CORRECTION_SCRIPT)
+                self.correction_script(keys=[self.keys_set, *corrections], args=list(corrections.values()))
+            hr.horde_r.setex(self.reconciled_key, INFLIGHT_RECONCILED_TTL, 1)
+        except Exception as err:
+            logger.warning(f"Could not reconcile the in-flight counters: {err}")
+
+
+inflight_counters = InFlightCounters()
@@ -0,0 +1,205 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from datetime import timedelta
+
+import requests
+
+from horde.logger import logger
+
+IP_REPUTATION_WORKERS = int(os.getenv("HORDE_IP_REPUTATION_WORKERS", 4))
+# How long a request thread waits for a lookup before telling the client to try again later
+IP_REPUTATION_WAIT = float(os.getenv("HORDE_IP_REPUTATION_WAIT", 0.5))
+IP_REPUTATION_LOCAL_TTL = int(os.getenv("HORDE_IP_REPUTATION_LOCAL_TTL", 300))
+IP_REPUTATION_CACHE_SIZE = int(os.getenv("HORDE_IP_REPUTATION_CACHE_SIZE", 50000))
+
+
+class IPReputationPending(Exception):
+    """The lookup of this IP is still running, so the client has to try again later"""
+
+
+class HttpIPReputationBackend:
+    """Asks the external IP checker for the probability that an IP is a proxy or VPN"""
+
+    def __init__(self, url_template, safety_threshold=0.93, timeout=2.0):
+        self.url_template = url_template
+        self.safety_threshold = safety_threshold
+        self.timeout = timeout
+
+    def lookup(self, ipaddr):
+        """Returns True if the IP is safe, False if it's not,
+        or None if the checker could not give us an answer right now
+        """
+        try:
+            result = requests.get(self.url_template.format(ipaddr=ipaddr), timeout=self.timeout)
+        except Exception as err:
+            logger.error(f"Exception when requesting info from checker: {err}")
+            return None
+        if result.status_code == 429:
+            # If we exceeded the amount of requests we can do to the IP checker, we ask the client to try again later.
+            return None
+        try:
+            probability = float(result.content)
+        except ValueError:
+            probability = None
+        if not result.ok:
+            is_safe = True  # True until I can improve my load
+            if probability is None or probability != int(os.getenv("IP_CHECKER_LC", -1)):
+                logger.error(f"An error occurred while validating IP. Return Code: {result.text}")
+        elif probability is None:
+            logger.error(f"IP checker returned an unexpected reply: {result.text}")
+            return None
+        else:
+            is_safe = probability < self.safety_threshold
+        logger.debug(f"IP {ipaddr} has a probability of {probability}. Safe = {is_safe}")
+        return is_safe
+
+
+class StaticIPReputationBackend:
+    """Replies from a fixed list of unsafe IPs, without any network calls. Used for testing."""
+
+    def __init__(self, unsafe_ips=()):
+        self.unsafe_ips = set(unsafe_ips)
+
+    def lookup(self, ipaddr):
+        return ipaddr not in self.unsafe_ips
+
+
+def get_ip_reputation_backend():
+    """Returns the backend selected via the env vars, or None if IP checking is disabled"""
+    backend_type = os.getenv("HORDE_IP_REPUTATION_BACKEND", "http")
+    if backend_type == "static":
+        unsafe_ips = [ipaddr.strip() for ipaddr in os.getenv("HORDE_IP_REPUTATION_UNSAFE_IPS", "").split(",") if ipaddr.strip()]
+        return StaticIPReputationBackend(unsafe_ips)
+    if os.getenv("IP_CHECKER", "") == "":
+        return None
+    return HttpIPReputationBackend(os.getenv("IP_CHECKER"))
+
+
+class IPReputationChecker:
+    """Looks up IP reputations off the request threads.
+    Verdicts are kept in a bounded local cache in front of the redis IP cache.
+    Concurrent requests from the same IP share a single lookup.
+    """
+
+    def __init__(
+        self,
+        backend,
+        redis_db=None,
+        redis_ttl=timedelta(hours=6),
+        workers=IP_REPUTATION_WORKERS,
+        wait=IP_REPUTATION_WAIT,
+        local_ttl=IP_REPUTATION_LOCAL_TTL,
+        max_entries=IP_REPUTATION_CACHE_SIZE,
+    ):
+        self.backend = backend
+        self.redis_db = redis_db
+        self.redis_ttl = redis_ttl
+        self.workers = workers
+        self.wait = wait
+        self.local_ttl = local_ttl
+        self.max_entries = max_entries
+        self.verdicts = {}
+        self.inflight = {}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ip_reputation")
+        return self.executor
+
+    def get_cached_verdict(self, ipaddr):
+        entry = self.verdicts.get(ipaddr)
+        if entry is not None:
+            is_safe, valid_until = entry
+            if time.monotonic() < valid_until:
+                return is_safe
+        if not self.redis_db:
+            return None
+        try:
+            is_safe = self.redis_db.get(ipaddr)
+        except Exception as err:
+            logger.warning(f"Could not read IP reputation from redis: {err}")
+            return None
+        if is_safe is None:
+            return None
+        is_safe = bool(int(is_safe))
+        self.store_local_verdict(ipaddr, is_safe)
+        return is_safe
+
+    def store_local_verdict(self, ipaddr, is_safe):
+        with self.lock:
+            if len(self.verdicts) >= self.max_entries:
+                now = time.monotonic()
+                self.verdicts = {k: v for k, v in self.verdicts.items() if v[1] > now}
+                if len(self.verdicts) >= self.max_entries:
+                    self.verdicts = dict(list(self.verdicts.items())[self.max_entries // 2 :])
+            self.verdicts[ipaddr] = (is_safe, time.monotonic() + self.local_ttl)
+
+    def store_verdict(self, ipaddr, is_safe):
+        if self.redis_db:
+            try:
+                self.redis_db.setex(ipaddr, self.redis_ttl, int(is_safe))
+            except Exception as err:
+                logger.warning(f"Could not store IP reputation in redis: {err}")
+        self.store_local_verdict(ipaddr, is_safe)
+
+    def lookup(self, ipaddr):
+        """Runs in the lookup threads"""
+        try:
+            is_safe = self.backend.lookup(ipaddr)
+            # We don't cache failed lookups, so that they get retried on the next request
+            if is_safe is not None:
+                self.store_verdict(ipaddr, is_safe)
+            return is_safe
+        except Exception as err:
+            logger.error(f"Exception when looking up the reputation of IP {ipaddr}: {err}")
+            return None
+        finally:
+            with self.lock:
+                self.inflight.pop(ipaddr, None)
+
+    def prefetch(self, ipaddr):
+        """Starts looking up the IP in the background, unless we already know its verdict or are already looking it up
+        Returns the future of the lookup, or None if we already have a verdict
+        """
+        if self.backend is None or self.get_cached_verdict(ipaddr) is not None:
+            return None
+        with self.lock:
+            future = self.inflight.get(ipaddr)
+            if future is None:
+                future = self.get_executor().submit(self.lookup, ipaddr)
+                self.inflight[ipaddr] = future
+        return future
+
+    def get_verdict(self, ipaddr, wait=None):
+        """Returns True if the IP is safe, False if it's not,
+        or None if the checker could not give us an answer
+        Raises IPReputationPending if the lookup did not finish in time, in which case the client should try again later
+        """
+        if self.backend is None:
+            return True
+        is_safe = self.get_cached_verdict(ipaddr)
+        if is_safe is not None:
+            return is_safe
+        future = self.prefetch(ipaddr)
+        # The lookup might have finished between checking the cache and the prefetch
+        if future is None:
+            return self.get_cached_verdict(ipaddr)
+        try:
+            return future.result(timeout=self.wait if wait is None else wait)
+        except FuturesTimeoutError as err:
+            raise IPReputationPending(ipaddr) from err
+
+    def get_stats(self):
+        return {
+            "cached_verdicts": len(self.verdicts),
+            "inflight_lookups": len(self.inflight),
+        }
@@ -0,0 +1,176 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import threading
+import time
+
+from markdown import markdown
+
+from horde import vars as hv
+from horde.argparser import maintenance
+from horde.classes.base.news import News
+from horde.database import functions as database
+from horde.logger import logger
+from horde.utils import ConvertAmount
+from horde.vars import google_verification_string, horde_title, img_url
+
+# How often the statistics shown on the landing page are refreshed
+LANDING_PAGE_REFRESH_INTERVAL = int(os.getenv("HORDE_LANDING_PAGE_REFRESH_INTERVAL", 60))
+# How many news pieces the landing page shows
+LANDING_PAGE_NEWS_COUNT = 3
+
+LANDING_PAGE_POLICIES = """
+## Policies
+
+[Privacy Policy](/privacy)
+
+[Terms of Service](/terms)"""
+
+LANDING_PAGE_STYLE = """<style>
+        body {
+            max-width: 120ex;
+            margin: 0 auto;
+            color: #333333;
+            line-height: 1.4;
+            font-family: sans-serif;
+            padding: 1em;
+        }
+        </style>
+    """
+
+
+class LandingPage:
+    """Serves the landing page from memory.
+    The template and the news are read once per process, and the page is rendered again only when
+    its statistics are refreshed, which a single request thread does at most every refresh_interval seconds.
+    The other requests keep getting the previous page in the meantime.
+    """
+
+    def __init__(self, template_path, refresh_interval=LANDING_PAGE_REFRESH_INTERVAL):
+        self.template_path = template_path
+        self.refresh_interval = refresh_interval
+        self.template = None
+        self.news = None
+        self.head = f"""<head>
+    <title>{horde_title}</title>
+    <meta name="google-site-verification" content="{google_verification_string}" />
+    <meta name="viewport" content="width=device-width, initial-scale=1" />
+    {LANDING_PAGE_STYLE}
+    </head>
+    """
+        self.html = None
+        self.rendered_at = 0
+        self.rendered_maintenance = None
+        self.lock = threading.Lock()
+
+    def load_template(self):
+        with open(self.template_path) as index_file:
+            self.template = index_file.read()
+        news = ""
+        for piece in News().sorted_news()[:LANDING_PAGE_NEWS_COUNT]:
+            news += f"* {piece['newspiece']}\n"
+        self.news = news
+
+    def get_statistics(self):
+        """Returns the values of the template placeholders which change over time"""
+        totals = database.get_total_usage()
+        processing_totals = database.retrieve_totals()
+        (
+            interrogation_worker_count,
+            interrogation_worker_thread_count,
+        ) = database.count_active_workers("interrogation")
+        image_worker_count, image_worker_thread_count = database.count_active_workers("image")
+        text_worker_count, text_worker_thread_count = database.count_active_workers("text")
+        avg_performance = ConvertAmount(database.get_request_avg() * image_worker_thread_count)
+        avg_text_performance = ConvertAmount(database.get_request_avg("text") * image_worker_thread_count)
+        # We multiple with the divisor again, to get the raw amount, which we can convert to prefix accurately
+        total_image_things = ConvertAmount(totals[hv.thing_names["image"]] * hv.thing_divisors["image"])
+        total_text_things = ConvertAmount(totals[hv.thing_names["text"]] * hv.thing_divisors["text"])
+        queued_image_things = ConvertAmount(
+            processing_totals[f"queued_{hv.thing_names['image']}"] * hv.thing_divisors["image"],
+        )
+        queued_text_things = ConvertAmount(
+            processing_totals[f"queued_{hv.thing_names['text']}"] * hv.thing_divisors["text"],
+        )
+        total_image_fulfillments = ConvertAmount(totals["image_fulfilments"])
+        total_text_fulfillments = ConvertAmount(totals["text_fulfilments"])
+        total_forms = ConvertAmount(totals["forms"])
+        return {
+            "avg_performance": avg_performance.amount,
+            "avg_thing_name": avg_performance.prefix + hv.raw_thing_names["image"],
+            "avg_text_performance": avg_text_performance.amount,
+            "avg_text_thing_name": avg_text_performance.prefix + hv.raw_thing_names["text"],
+            "total_image_things": total_image_things.amount,
+            "total_total_image_things_name": total_image_things.prefix + hv.raw_thing_names["image"],
+            "total_text_things": total_text_things.amount,
+            "total_text_things_name": total_text_things.prefix + hv.raw_thing_names["text"],
+            "total_image_fulfillments": total_image_fulfillments.amount,
+            "total_image_fulfillments_char": total_image_fulfillments.char,
+            "total_text_fulfillments": total_text_fulfillments.amount,
+            "total_text_fulfillments_char": total_text_fulfillments.char,
+            "total_forms": total_forms.amount,
+            "total_forms_char": total_forms.char,
+            "image_workers": image_worker_count,
+            "image_worker_threads": image_worker_thread_count,
+            "text_workers": text_worker_count,
+            "text_worker_threads": text_worker_thread_count,
+            "interrogation_workers": interrogation_worker_count,
+            "interrogation_worker_threads": interrogation_worker_thread_count,
+            "total_image_queue": processing_totals["queued_requests"],
+            "total_text_queue": processing_totals["queued_text_requests"],
+            "total_forms_queue": processing_totals.get("queued_forms", 0),
+            "queued_image_things": queued_image_things.amount,
+            "queued_image_things_name": queued_image_things.prefix + hv.raw_thing_names["image"],
+            "queued_text_things": queued_text_things.amount,
+            "queued_text_things_name": queued_text_things.prefix + hv.raw_thing_names["text"],
+        }
+
+    def render(self):
+        if self.template is None:
+            self.load_template()
+        maintenance_mode = maintenance.active
+        findex = self.template.format(
+            page_title=horde_title,
+            horde_img_url=img_url,
+            horde_image=0,
+            maintenance_mode=maintenance_mode,
+            news=self.news,
+            **self.get_statistics(),
+        )
+        self.html = self.head + markdown(findex + LANDING_PAGE_POLICIES)
+        self.rendered_at = time.monotonic()
+        self.rendered_maintenance = maintenance_mode
+
+    def is_fresh(self):
+        return (
+            self.html is not None
+            and time.monotonic() - self.rendered_at < self.refresh_interval
+            and self.rendered_maintenance == maintenance.active
+        )
+
+    def get_html(self):
+        if self.is_fresh():
+            return self.html
+        if self.html is not None:
+            # Someone else is already rendering it, so we serve the previous page
+            if not self.lock.acquire(blocking=False):
+                return self.html
+            try:
+                if not self.is_fresh():
+                    self.render()
+            except Exception as err:
+                logger.error(f"Could not refresh the landing page statistics: {err}")
+                # We retry on the next interval, instead of on every request
+                self.rendered_at = time.monotonic()
+            finally:
+                self.lock.release()
+            return self.html
+        with self.lock:
+            if self.html is None:
+                self.render()
+        return self.html
+
+
+landing_page = LandingPage(os.getenv("HORDE_MARKDOWN_INDEX", "index_stable.md"))
@@ -2,12 +2,17 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import threading
+import time
+from functools import wraps
+
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
+from horde import exceptions as e
 from horde.flask import HORDE
 from horde.logger import logger
-from horde.redis_ctrl import ger_limiter_url, is_redis_up
+from horde.redis_ctrl import ger_limiter_url, get_limiter_db, is_redis_up
 
 limiter = None
 # Very basic DOS prevention
@@ -25,8 +30,8 @@ if is_redis_up():
             headers_enabled=True,
         )
         logger.init_ok("Limiter Cache", status="Connected")
-    except Exception as e:
-        logger.error(f"Failed to connect to Limiter Cache: {e}")
+    except Exception as err:
+        logger.error(f"Failed to connect to Limiter Cache: {err}")
 
 # Allow local workstation run
 if limiter is None:
@@ -37,3 +42,117 @@ if limiter is None:
         headers_enabled=True,
     )
     logger.init_warn("Limiter Cache", status="Memory Only")
+
+
+# GCRA token buckets. For every key, we store the theoretical arrival time (TAT) of the next request in microseconds.
+# ARGV holds the emission interval and the capacity of each key's bucket.
+# A request is only admitted if all its buckets admit it, in which case all of them are charged.
+# We use the redis clock, so that all horde nodes agree on the time.
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000000 + tonumber(now_parts[2])
+local new_tats = {}
+local retry_after = 0
+for i = 1, #KEYS do
+    local interval = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local tat = tonumber(redis.call('GET', KEYS[i])) or now
+    if tat < now then
+        tat = now
+    end
+    local new_tat = tat + interval
+    local allowed_at = new_tat - capacity * interval
+    if allowed_at - now > retry_after then
+        retry_after = allowed_at - now
+    end
+    new_tats[i] = new_tat
+end
+if retry_after > 0 then
+    return {0, retry_after}
+end
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], string.format('%d', new_tats[i]), 'PX', math.ceil((new_tats[i] - now) / 1000) + 1)
+end
+return {1, 0}
+"""
+
+
+class TokenBucketLimiter:
+    """Admits requests through token buckets kept in redis.
+    Each request costs a single atomic script call, no matter how many limits it has to pass.
+    Falls back to in-process buckets when redis is not available.
+    """
+
+    def __init__(self, redis_db=None):
+        self.redis_db = redis_db
+        self.script = None
+        if redis_db is not None:
+            self.script = redis_db.register_script(TOKEN_BUCKET_SCRIPT)
+        self.local_tats = {}
+        self.lock = threading.Lock()
+
+    def hit_local(self, buckets):
+        now = int(time.time() * 1000000)
+        with self.lock:
+            new_tats = []
+            retry_after = 0
+            for key, interval, capacity in buckets:
+                tat = max(self.local_tats.get(key, now), now)
+                new_tat = tat + interval
+                retry_after = max(retry_after, new_tat - capacity * interval - now)
+                new_tats.append(new_tat)
+            if retry_after > 0:
+                return retry_after
+            for (key, _, _), new_tat in zip(buckets, new_tats):
+                self.local_tats[key] = new_tat
+            if len(self.local_tats) > 100000:
+                self.local_tats = {k: v for k, v in self.local_tats.items() if v > now}
+        return 0
+
+    def hit(self, buckets):
+        """Charges one token from each bucket, if all of them have one available.
+        buckets is a list of (key, interval, capacity), with the interval in microseconds per token
+        Returns 0 if the request is admitted, or the microseconds until it would be
+        """
+        if self.script is None:
+            return self.hit_local(buckets)
+        args = []
+        for _, interval, capacity in buckets:
+            args.extend((interval, capacity))
+        try:
+            admitted, retry_after = self.script(keys=[key for key, _, _ in buckets], args=args)
+        except Exception as err:
+            # We'd rather let requests through than fail them all while redis is unavailable
+            logger.warning(f"Token bucket limiter failed. Admitting request: {err}")
+            return 0
+        if admitted:
+            return 0
+        return int(retry_after)
+
+    def limit(self, *rate_limits):
+        """Decorator which admits the request only if it passes all the given limiter_api.RateLimit"""
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                retry_after = self.hit([rate_limit.get_bucket() for rate_limit in rate_limits])
+                if retry_after > 0:
+                    raise e.RateLimitExceeded(retry_after / 1000000)
+                return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+token_limiter = None
+logger.init("Token Bucket Limiter", status="Connecting")
+if is_redis_up():
+    try:
+        token_limiter = TokenBucketLimiter(get_limiter_db())
+        logger.init_ok("Token Bucket Limiter", status="Connected")
+    except Exception as err:
+        logger.error(f"Failed to connect to Token Bucket Limiter: {err}")
+if token_limiter is None:
+    token_limiter = TokenBucketLimiter()
+    logger.init_warn("Token Bucket Limiter", status="Memory Only")
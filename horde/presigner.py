@@ -0,0 +1,166 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import hashlib
+import hmac
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote, urlsplit
+
+from horde.logger import logger
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+class SigV4Presigner:
+    """Generates AWS SigV4 query-string presigned S3 URLs locally.
+
+    boto3 goes through its whole request/event machinery for every presigned URL.
+    All we need for R2 is the query-string signature, so we compute it directly
+    and cache the derived signing key per (access key, date, region, service).
+
+    If credentials is provided, it's a botocore credentials object, which we read again for every batch,
+    so that refreshable credentials are picked up after they rotate.
+    Otherwise the static access_key, secret_key and session_token are used.
+    """
+
+    service = "s3"
+    algorithm = "AWS4-HMAC-SHA256"
+
+    def __init__(self, endpoint_url, access_key=None, secret_key=None, region="auto", session_token=None, credentials=None):
+        split_url = urlsplit(endpoint_url)
+        self.scheme = split_url.scheme or "https"
+        self.host = split_url.netloc
+        self.base_path = split_url.path.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session_token = session_token
+        self.credentials = credentials
+        self.signing_keys = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_boto3_client(cls, client):
+        """Builds a presigner using the same endpoint, region and credentials as an existing boto3 client
+        Returns None if the client has no credentials we can use.
+        """
+        try:
+            credentials = client._request_signer._credentials
+            if credentials is None:
+                return None
+            frozen = credentials.get_frozen_credentials()
+            if not frozen.access_key or not frozen.secret_key:
+                return None
+            return cls(
+                endpoint_url=client.meta.endpoint_url,
+                region=client.meta.region_name or "us-east-1",
+                credentials=credentials,
+            )
+        except Exception as err:
+            logger.warning(f"Could not prepare local presigner. Will fall back to boto3: {err}")
+            return None
+
+    def get_credentials(self):
+        """Returns the access key, secret key and session token to sign the next batch with"""
+        if self.credentials is None:
+            return self.access_key, self.secret_key, self.session_token
+        # This only goes to the credential provider when refreshable credentials are about to expire
+        frozen = self.credentials.get_frozen_credentials()
+        return frozen.access_key, frozen.secret_key, frozen.token
+
+    def get_signing_key(self, access_key, secret_key, datestamp):
+        cache_key = (access_key, datestamp, self.region, self.service)
+        signing_key = self.signing_keys.get(cache_key)
+        if signing_key is not None:
+            return signing_key
+        with self.lock:
+            k_date = _sign(f"AWS4{secret_key}".encode(), datestamp)
+            k_region = _sign(k_date, self.region)
+            k_service = _sign(k_region, self.service)
+            signing_key = _sign(k_service, "aws4_request")
+            # We only ever need today's key for the current credentials (and maybe yesterday's around midnight)
+            self.signing_keys = {cache_key: signing_key}
+        return signing_key
+
+    def presign_batch(self, method, bucket, keys, expires_in=1800, now=None):
+        """Returns a list of presigned URLs, one per key, all sharing the same timestamp and signing key"""
+        if now is None:
+            now = time.time()
+        timestamp = datetime.utcfromtimestamp(now)
+        amz_date = timestamp.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = timestamp.strftime("%Y%m%d")
+        credential_scope = f"{datestamp}/{self.region}/{self.service}/aws4_request"
+        access_key, secret_key, session_token = self.get_credentials()
+        signing_key = self.get_signing_key(access_key, secret_key, datestamp)
+        query_params = {
+            "X-Amz-Algorithm": self.algorithm,
+            "X-Amz-Credential": f"{access_key}/{credential_scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(int(expires_in)),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if session_token:
+            query_params["X-Amz-Security-Token"] = session_token
+        canonical_query = "&".join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query_params.items()))
+        canonical_headers = f"host:{self.host}\n"
+        urls = []
+        for key in keys:
+            canonical_uri = f"{self.base_path}/{quote(bucket, safe='-_.~')}/{quote(key, safe='/-_.~')}"
+            canonical_request = "\n".join(
+                [
+                    method,
+                    canonical_uri,
+                    canonical_query,
+                    canonical_headers,
+                    "host",
+                    "UNSIGNED-PAYLOAD",
+                ],
+            )
+            string_to_sign = "\n".join(
+                [
+                    self.algorithm,
+                    amz_date,
+                    credential_scope,
+                    hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+                ],
+            )
+            signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+            urls.append(f"{self.scheme}://{self.host}{canonical_uri}?{canonical_query}&X-Amz-Signature={signature}")
+        return urls
+
+    def presign(self, method, bucket, key, expires_in=1800):
+        return self.presign_batch(method, bucket, [key], expires_in)[0]
+
+
+class PresignedURLCache:
+    """Memoizes presigned URLs for most of their validity, so that repeated status checks don't re-sign them"""
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.urls = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.urls.get(key)
+        if entry is None:
+            return None
+        url, valid_until = entry
+        if time.monotonic() > valid_until:
+            self.urls.pop(key, None)
+            return None
+        return url
+
+    def set(self, key, url, reuse_for):
+        with self.lock:
+            if len(self.urls) >= self.max_entries:
+                now = time.monotonic()
+                self.urls = {k: v for k, v in self.urls.items() if v[1] > now}
+                # If everything is still valid, we just drop the oldest half
+                if len(self.urls) >= self.max_entries:
+                    self.urls = dict(list(self.urls.items())[self.max_entries // 2 :])
+            self.urls[key] = (url, time.monotonic() + reuse_for)
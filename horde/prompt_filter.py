@@ -0,0 +1,444 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""The compiled prompt filter engine used by horde.detection.PromptChecker
+and the worker blacklist matchers
+
+This module intentionally does not import anything else from the horde,
+so that it can be benchmarked in isolation (see benchmarks/prompt_filter.py)
+"""
+
+import hashlib
+import json
+import os
+import re as literal_re
+import threading
+from collections import OrderedDict
+
+import emoji
+import regex as re
+from unidecode import unidecode
+
+SUSPICIOUS_EMOJIS = frozenset(
+    [
+        "👧",
+        "👧🏻",
+        "👧🏼",
+        "👧🏽",
+        "👧🏾",
+        "👧🏿",
+        "👦",
+        "👦🏻",
+        "👦🏼",
+        "👦🏽",
+        "👦🏾",
+        "👦🏿",
+        "👶🏻",
+        "👶",
+        "👶🏼",
+        "👶🏽",
+        "👶🏾",
+        "👶🏿",
+        "👪",
+        "👨‍👩‍👧",
+        "👨‍👩‍👦‍👦",
+        "👨‍👩‍👧‍👦",
+        "👨‍👩‍👧‍👧",
+        "👨‍👨‍👧‍👧",
+        "👨‍👨‍👧‍👦",
+        "👨‍👨‍👦‍👦",
+        "👩‍👩‍👧",
+        "👩‍👩‍👦",
+        "👩‍👩‍👧‍👦",
+        "👨‍👦",
+        "👨‍👧",
+        "👨‍👧‍👦",
+        "👨‍👦‍👦",
+        "👨‍👧‍👧",
+        "👩‍👦",
+        "👩‍👧",
+        "👩‍👧‍👦",
+        "👩‍👦‍👦",
+        "👩‍👧‍👧",
+        "🤱",
+        "🤱🏻",
+        "🤱🏼",
+        "🤱🏽",
+        "🤱🏾",
+        "🤱🏿",
+        "🧑‍🍼",
+        "🧑🏻‍🍼",
+        "🧑🏼‍🍼",
+        "🧑🏽‍🍼",
+        "🧑🏾‍🍼",
+        "🧑🏿‍🍼",
+        "👨‍🍼",
+        "👨🏻‍🍼",
+        "👨🏼‍🍼",
+        "👨🏽‍🍼",
+        "👨🏾‍🍼",
+        "👨🏿‍🍼",
+        "👩‍🍼",
+        "👩🏻‍🍼",
+        "👩🏼‍🍼",
+        "👩🏽‍🍼",
+        "👩🏾‍🍼",
+        "👩🏿‍🍼",
+        "👼",
+        "👼🏻",
+        "👼🏼",
+        "👼🏽",
+        "👼🏾",
+        "👼🏿",
+        "🐤",
+        "🐥",
+        "🚼",
+        "🍼",
+        "🚸",
+    ],
+)
+# Only filter_10 also checks for emojis
+EMOJI_FILTER_ID = "filter_10"
+PROMPT_VERDICT_CACHE_SIZE = int(os.getenv("HORDE_PROMPT_VERDICT_CACHE_SIZE", 20000))
+BLACKLIST_MATCHER_CACHE_SIZE = int(os.getenv("HORDE_BLACKLIST_MATCHER_CACHE_SIZE", 10000))
+
+WEIGHT_REMOVER = re.compile(r"\((.*?):\d+\.\d+\)")
+WHITESPACE_REMOVER = re.compile(r"(\s(\w)){3,}\b")
+WHITESPACE_CONVERTER = re.compile(r"([^\w\s]|_)")
+WHITESPACE_COLLAPSER = re.compile(r"\s+")
+
+
+def _join_spaced_letters(match):
+    """Turns 'l o l i' back into 'loli' while keeping the whitespace leading to it"""
+    matched = match.group(0)
+    trimmed = matched.lstrip()
+    return matched[: len(matched) - len(trimmed)] + WHITESPACE_COLLAPSER.sub("", trimmed)
+
+
+def normalize_prompt(prompt):
+    """Prepares the prompt to be scanned by the regex, by removing tricks one might use to avoid the filters"""
+    prompt = WEIGHT_REMOVER.sub(r"\1", prompt)
+    prompt = WHITESPACE_CONVERTER.sub(" ", prompt)
+    prompt = WHITESPACE_REMOVER.sub(_join_spaced_letters, prompt)
+    prompt = WHITESPACE_COLLAPSER.sub(" ", prompt)
+    # Remove all accents
+    if prompt.isascii():
+        return prompt
+    return unidecode(prompt)
+
+
+def find_suspicious_emojis(prompt):
+    # Emojis are never ascii, so the vast majority of prompts skip the emoji parsing completely
+    if prompt.isascii():
+        return []
+    return [emj["emoji"] for emj in emoji.emoji_list(prompt) if emj["emoji"] in SUSPICIOUS_EMOJIS]
+
+
+REGEX_METACHARACTERS = frozenset(".[](){}|*+?^$")
+OPTIONAL_QUANTIFIERS = frozenset("*?{")
+# Shorter prefixes would match too many prompts to be worth it
+MIN_LITERAL_PREFIX = 3
+
+
+def split_top_level_alternatives(regex_string):
+    """Splits a regex on the | which are not inside a group or a character class"""
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    i = 0
+    while i < len(regex_string):
+        char = regex_string[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            # A ] right at the start of a class is a literal
+            if regex_string[i + 1 : i + 2] == "^":
+                i += 1
+            if regex_string[i + 1 : i + 2] == "]":
+                i += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            alternatives.append(regex_string[start:i])
+            start = i + 1
+        i += 1
+    alternatives.append(regex_string[start:])
+    return alternatives
+
+
+def get_literal_prefix(alternative):
+    """Returns the literal text any match of this regex alternative has to start with.
+    Returns an empty string if we can't be sure of it.
+    """
+    i = 0
+    # Zero-width anchors don't consume anything
+    while True:
+        if alternative.startswith(("\\b", "\\B"), i):
+            i += 2
+        elif alternative.startswith("^", i):
+            i += 1
+        else:
+            break
+    prefix = []
+    while i < len(alternative):
+        char = alternative[i]
+        if char == "\\":
+            escaped = alternative[i + 1 : i + 2]
+            # Escaped letters and digits are character classes, anchors or backreferences
+            if escaped == "" or escaped.isalnum():
+                break
+            literal = escaped
+            i += 2
+        elif char in REGEX_METACHARACTERS:
+            break
+        else:
+            literal = char
+            i += 1
+        # A literal followed by an optional quantifier might not be there at all
+        if alternative[i : i + 1] in OPTIONAL_QUANTIFIERS:
+            break
+        prefix.append(literal)
+        if alternative[i : i + 1] == "+":
+            break
+    return "".join(prefix).lower()
+
+
+def compile_literal_trie(literals):
+    """Compiles a list of literal strings into a single regex of nested alternations,
+    which the stdlib engine can scan much faster than a flat alternation
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build_node(node):
+        if "" in node:
+            # Any string which matches a longer literal also matches this one
+            return ""
+        branches = [literal_re.escape(char) + build_node(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return literal_re.compile(build_node(trie))
+
+
+class CompiledPromptFilter:
+    """All the filter regex, compiled once along with a prefilter which checks all of them together.
+
+    filter_groups is a list of lists of filter ids. A prompt gains 1 suspicion per group
+    in which any of the filters match, checked in order.
+    As the vast majority of prompts don't match any filter, we compile all the filters together
+    into a prefilter which can prove that in a single pass over the prompt.
+    Only when something might match do we go on to figure out which filter classes it was.
+    """
+
+    def __init__(self, filter_regex, filter_groups):
+        self.filter_groups = filter_groups
+        self.compiled = {}
+        for filter_id, regex_string in filter_regex.items():
+            if regex_string:
+                self.compiled[filter_id] = re.compile(regex_string, re.IGNORECASE)
+        self.combined = None
+        self.literal_prefilter = None
+        if not self.compiled:
+            return
+        # Most filter alternatives start with some literal text. We pull those prefixes into a trie
+        # which can quickly tell us a prompt cannot match any of them.
+        # The alternatives without a usable prefix are checked as a combined regex.
+        literal_prefixes = []
+        unprefixed_alternatives = []
+        for filter_id in self.compiled:
+            for alternative in split_top_level_alternatives(filter_regex[filter_id]):
+                literal_prefix = get_literal_prefix(alternative)
+                # Case-insensitive matching can fold some non-ascii letters into ascii ones,
+                # which lowercasing does not, so we only trust ascii prefixes
+                if len(literal_prefix) >= MIN_LITERAL_PREFIX and literal_prefix.isascii():
+                    literal_prefixes.append(literal_prefix)
+                else:
+                    unprefixed_alternatives.append(alternative)
+        try:
+            if literal_prefixes:
+                self.literal_prefilter = compile_literal_trie(literal_prefixes)
+            self.combined = re.compile(
+                "|".join(f"(?:{alternative})" for alternative in unprefixed_alternatives),
+                re.IGNORECASE,
+            )
+            if not unprefixed_alternatives:
+                self.combined = None
+        except Exception:
+            # Some regex (e.g. with inline global flags) cannot be combined.
+            # We just fall back to checking each filter separately
+            self.literal_prefilter = None
+            self.combined = None
+            self.can_prefilter = False
+        else:
+            self.can_prefilter = True
+
+    def might_match(self, norm_prompt):
+        """Returns False only when we are sure that no filter regex can match this normalized prompt"""
+        if not self.can_prefilter:
+            return True
+        if self.literal_prefilter is not None and self.literal_prefilter.search(norm_prompt.lower()):
+            return True
+        return self.combined is not None and self.combined.search(norm_prompt) is not None
+
+    def scan(self, prompt, only_filter=None, norm_prompt=None, suspicious_emojis=None):
+        """Returns the suspicion of a prompt and the strings which matched
+        prompt is the positive prompt, without normalization
+        If only_filter is set, only that filter id will be checked
+        norm_prompt and suspicious_emojis can be passed if the caller has already worked them out
+        """
+        if norm_prompt is None:
+            norm_prompt = normalize_prompt(prompt)
+        any_regex_match = True
+        if only_filter is None:
+            any_regex_match = self.might_match(norm_prompt)
+        prompt_suspicion = 0
+        matching_groups = []
+        for filters in self.filter_groups:
+            for filter_id in filters:
+                # This allows to check only a specific filter ID
+                if only_filter and filter_id != only_filter:
+                    continue
+                # We only need 1 of the filters in the group to match to increase suspicion
+                # Suspicion does not increase further for more filters in the same group
+                if filter_id == EMOJI_FILTER_ID:
+                    if suspicious_emojis is None:
+                        suspicious_emojis = find_suspicious_emojis(prompt)
+                    if suspicious_emojis:
+                        matching_groups.extend(suspicious_emojis)
+                        prompt_suspicion += 1
+                        break
+                if not any_regex_match or filter_id not in self.compiled:
+                    continue
+                match_result = self.compiled[filter_id].search(norm_prompt)
+                if match_result:
+                    prompt_suspicion += 1
+                    matching_groups.append(match_result.group())
+                    break
+        return prompt_suspicion, matching_groups
+
+
+def get_filter_set_version(filter_regex, replacements):
+    """Returns a short fingerprint of the filters and replacements in use.
+    As it depends only on their contents, all horde nodes arrive to the same version for the same filters.
+    """
+    filter_set = json.dumps([filter_regex, replacements], sort_keys=True)
+    return hashlib.sha256(filter_set.encode("utf-8")).hexdigest()[:16]
+
+
+def get_prompt_digest(norm_prompt, suspicious_emojis=()):
+    """Identifies a prompt by what the filters actually look at.
+    The emojis are lost during normalization, so they're added separately.
+    """
+    prompt_hash = hashlib.sha256(norm_prompt.encode("utf-8"))
+    for emj in suspicious_emojis:
+        prompt_hash.update(b"\0" + emj.encode("utf-8"))
+    return prompt_hash.digest()
+
+
+class PromptVerdictCache:
+    """A bounded LRU of prompt filtering results.
+    Keys should include the filter set version, so that results from older filters are never served.
+    """
+
+    def __init__(self, max_entries=PROMPT_VERDICT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value, or None if it's not cached"""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+
+class BlacklistMatcher:
+    """Checks in a single pass whether a prompt contains any of the words in a worker's blacklist.
+    Matches the same as a case-insensitive substring check for each word.
+    """
+
+    __slots__ = ("words", "regex")
+
+    def __init__(self, words):
+        self.words = frozenset(word.lower() for word in words)
+        self.regex = compile_literal_trie(self.words) if self.words else None
+
+    def search(self, prompt):
+        if self.regex is None:
+            return False
+        return self.regex.search(prompt.lower()) is not None
+
+
+def get_blacklist_hash(words):
+    return hashlib.sha256("\0".join(sorted(words)).encode("utf-8")).hexdigest()
+
+
+class BlacklistMatcherCache:
+    """Keeps the compiled blacklist matcher of each worker, until its blacklist changes"""
+
+    def __init__(self, max_entries=BLACKLIST_MATCHER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.matchers = {}
+        self.lock = threading.Lock()
+
+    def get(self, worker_id, words):
+        blacklist_hash = get_blacklist_hash(words)
+        cached = self.matchers.get(worker_id)
+        if cached is not None and cached[0] == blacklist_hash:
+            return cached[1]
+        matcher = BlacklistMatcher(words)
+        with self.lock:
+            self.matchers.pop(worker_id, None)
+            while len(self.matchers) >= self.max_entries:
+                # Dicts keep insertion order, so this drops the matcher compiled longest ago
+                self.matchers.pop(next(iter(self.matchers)))
+            self.matchers[worker_id] = (blacklist_hash, matcher)
+        return matcher
+
+
+blacklist_matchers = BlacklistMatcherCache()
@@ -12,6 +12,7 @@ from botocore.exceptions import ClientError
 from PIL import Image
 
 from horde.logger import logger
+from horde.presigner import PresignedURLCache, SigV4Presigner
 
 r2_transient_account = os.getenv(
     "R2_TRANSIENT_ACCOUNT",
@@ -39,6 +40,16 @@ old_r2 = boto3.client(
     aws_secret_access_key=os.getenv("OLD_AWS_SECRET_ACCESS_KEY"),
 )
 
+presigners = {
+    False: SigV4Presigner.from_boto3_client(s3_client),
+    True: SigV4Presigner.from_boto3_client(s3_client_shared),
+}
+# Download URLs are valid for 30 minutes. We hand out the same URL for 25 of those
+# so that clients polling the status always get at least 5 minutes to download.
+procgen_download_url_cache = PresignedURLCache()
+PROCGEN_URL_EXPIRY = 1800
+PROCGEN_URL_REUSE = 1500
+
 # Lists shared bucket contents
 # for key in s3_client_shared.list_objects(Bucket=r2_transient_bucket)['Contents']:
 #     logger.debug(key['Key'])
@@ -66,30 +77,49 @@ def generate_presigned_url(client, client_method, method_parameters, expires_in=
     return url
 
 
-def generate_procgen_upload_url(procgen_id, shared=False):
+def generate_procgen_urls(client_method, procgen_ids, shared=False):
+    """Presigns the procgen urls for all the ids in one go.
+    Uses the local presigner when we have credentials for it, otherwise falls back to boto3
+    """
+    presigner = presigners[shared]
+    keys = [f"{procgen_id}.webp" for procgen_id in procgen_ids]
+    if presigner is not None:
+        http_method = "PUT" if client_method == "put_object" else "GET"
+        try:
+            return presigner.presign_batch(http_method, r2_transient_bucket, keys, PROCGEN_URL_EXPIRY)
+        except Exception as err:
+            logger.warning(f"Local presigning failed. Falling back to boto3: {err}")
     client = s3_client
     if shared:
         client = s3_client_shared
-    return generate_presigned_url(
-        client=client,
-        client_method="put_object",
-        method_parameters={"Bucket": r2_transient_bucket, "Key": f"{procgen_id}.webp"},
-        expires_in=1800,
-    )
+    return [
+        generate_presigned_url(
+            client=client,
+            client_method=client_method,
+            method_parameters={"Bucket": r2_transient_bucket, "Key": key},
+            expires_in=PROCGEN_URL_EXPIRY,
+        )
+        for key in keys
+    ]
+
+
+def generate_procgen_upload_urls(procgen_ids, shared=False):
+    return generate_procgen_urls("put_object", procgen_ids, shared)
+
+
+def generate_procgen_upload_url(procgen_id, shared=False):
+    return generate_procgen_upload_urls([procgen_id], shared)[0]
 
 
 def generate_procgen_download_url(procgen_id, shared=False):
-    client = s3_client
-    if shared:
-        client = s3_client_shared
     # if not file_exists(client,  f"{procgen_id}.webp"):
     #     client = old_r2
-    return generate_presigned_url(
-        client=client,
-        client_method="get_object",
-        method_parameters={"Bucket": r2_transient_bucket, "Key": f"{procgen_id}.webp"},
-        expires_in=1800,
-    )
+    cache_key = (str(procgen_id), shared)
+    url = procgen_download_url_cache.get(cache_key)
+    if url is None:
+        url = generate_procgen_urls("get_object", [procgen_id], shared)[0]
+        procgen_download_url_cache.set(cache_key, url, PROCGEN_URL_REUSE)
+    return url
 
 
 def delete_procgen_image(procgen_id):
@@ -104,6 +134,10 @@ def upload_image(client, bucket, image, filename, quality=100):
     image_io = BytesIO()
     image.save(image_io, format="WebP", quality=quality, exact=True)
     image_io.seek(0)
+    return upload_image_io(client, bucket, image_io, filename)
+
+
+def upload_image_io(client, bucket, image_io, filename):
     try:
         client.upload_fileobj(image_io, bucket, filename)
     except ClientError as err:
@@ -112,6 +146,13 @@ def upload_image(client, bucket, image, filename, quality=100):
     return generate_img_download_url(filename, r2_source_image_bucket)
 
 
+def upload_webp_bytes(client, bucket, webp_bytes, filename):
+    """Uploads already encoded webp bytes.
+    BytesIO shares the bytes buffer until written to, so this doesn't copy the image again.
+    """
+    return upload_image_io(client, bucket, BytesIO(webp_bytes), filename)
+
+
 def download_image(client, bucket, key):
     # if not file_exists(client, f"{procgen_id}.webp"):
     #     client = old_r2
@@ -142,6 +183,16 @@ def upload_source_image(image, filename):
     return upload_image(s3_client, r2_source_image_bucket, image, filename, quality=50)
 
 
+def upload_source_image_webp(webp_bytes, filename):
+    return upload_webp_bytes(s3_client, r2_source_image_bucket, webp_bytes, filename)
+
+
+def upload_generated_image_webp(webp_bytes, filename, shared=False):
+    if shared:
+        return upload_webp_bytes(s3_client_shared, r2_permanent_bucket, webp_bytes, filename)
+    return upload_webp_bytes(s3_client, r2_transient_bucket, webp_bytes, filename)
+
+
 def upload_generated_image(image, filename):
     return upload_image(
         s3_client,
@@ -170,19 +221,16 @@ def upload_shared_metadata(filename):
         return False
 
 
-def upload_prompt(prompt_dict):
-    filename = f"{uuid4()}.json"
-    json_object = json.dumps(prompt_dict, indent=4)
-    # Writing to sample.json
-    with open(filename, "w") as f:
-        f.write(json_object)
+def upload_prompt(prompt_dict, filename=None):
+    """Uploads the prompt as a json file to the prompts bucket. This blocks, so requests should go through the evidence queue."""
+    if filename is None:
+        filename = f"{uuid4()}.json"
     try:
-        s3_client.upload_file(filename, "prompts", filename)
-        os.remove(filename)
+        s3_client.put_object(Bucket="prompts", Key=filename, Body=json.dumps(prompt_dict, indent=4).encode())
     except Exception as err:
         logger.error(f"Error encountered while uploading prompt {filename}: {err}")
-        os.remove(filename)
         return False
+    return True
 
 
 def generate_img_download_url(filename, bucket=r2_transient_bucket):
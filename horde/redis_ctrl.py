@@ -56,6 +56,10 @@ def get_local_horde_db():
     return redis.Redis(host="127.0.0.1", port=6379, db=6, decode_responses=True)
 
 
+def get_limiter_db():
+    return redis.Redis(host=redis_hostname, port=redis_port, db=limiter_db)
+
+
 def get_ipaddr_db():
     return redis.Redis(host=redis_hostname, port=redis_port, db=ipaddr_db)
 
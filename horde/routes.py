@@ -3,7 +3,6 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import os
-import random
 import secrets
 from uuid import uuid4
 
@@ -13,28 +12,23 @@ from flask import redirect, render_template, request, send_from_directory, url_f
 from flask_dance.contrib.discord import discord
 from flask_dance.contrib.github import github
 from flask_dance.contrib.google import google
-from markdown import markdown
 
-from horde import vars as hv
-from horde.argparser import maintenance
 from horde.classes.base import settings
-from horde.classes.base.news import News
 from horde.classes.base.user import User
 from horde.consts import HORDE_API_VERSION, HORDE_VERSION
 from horde.countermeasures import CounterMeasures
 from horde.database import functions as database
 from horde.flask import HORDE, cache, db
+from horde.landing_page import landing_page
 from horde.logger import logger
 from horde.patreon import patrons
-from horde.utils import ConvertAmount, hash_api_key, is_profane, sanitize_string
+from horde.utils import hash_api_key, is_profane, sanitize_string
 from horde.vars import (
-    google_verification_string,
     horde_contact_email,
     horde_logo,
     horde_repository,
     horde_title,
     horde_url,
-    img_url,
 )
 
 dance_return_to = "/"
@@ -42,103 +36,8 @@ dance_return_to = "/"
 
 @logger.catch(reraise=True)
 @HORDE.route("/")
-# @cache.cached(timeout=300)
 def index():
-    with open(os.getenv("HORDE_MARKDOWN_INDEX", "index_stable.md")) as index_file:
-        index = index_file.read()
-    align_image = 0
-    big_image = align_image
-    while big_image == align_image:
-        big_image = random.randint(1, 5)
-    policies = """
-## Policies
-
-[Privacy Policy](/privacy)
-
-[Terms of Service](/terms)"""
-    news = ""
-    sorted_news = News().sorted_news()
-    for riter in range(len(sorted_news)):
-        news += f"* {sorted_news[riter]['newspiece']}\n"
-        if riter > 1:
-            break
-    totals = database.get_total_usage()
-    processing_totals = database.retrieve_totals()
-    (
-        interrogation_worker_count,
-        interrogation_worker_thread_count,
-    ) = database.count_active_workers("interrogation")
-    image_worker_count, image_worker_thread_count = database.count_active_workers("image")
-    text_worker_count, text_worker_thread_count = database.count_active_workers("text")
-    avg_performance = ConvertAmount(database.get_request_avg() * image_worker_thread_count)
-    avg_text_performance = ConvertAmount(database.get_request_avg("text") * image_worker_thread_count)
-    # We multiple with the divisor again, to get the raw amount, which we can convert to prefix accurately
-    total_image_things = ConvertAmount(totals[hv.thing_names["image"]] * hv.thing_divisors["image"])
-    total_text_things = ConvertAmount(totals[hv.thing_names["text"]] * hv.thing_divisors["text"])
-    queued_image_things = ConvertAmount(
-        processing_totals[f"queued_{hv.thing_names['image']}"] * hv.thing_divisors["image"],
-    )
-    queued_text_things = ConvertAmount(
-        processing_totals[f"queued_{hv.thing_names['text']}"] * hv.thing_divisors["text"],
-    )
-    total_image_fulfillments = ConvertAmount(totals["image_fulfilments"])
-    total_text_fulfillments = ConvertAmount(totals["text_fulfilments"])
-    total_forms = ConvertAmount(totals["forms"])
-    findex = index.format(
-        page_title=horde_title,
-        horde_img_url=img_url,
-        horde_image=align_image,
-        avg_performance=avg_performance.amount,
-        avg_thing_name=avg_performance.prefix + hv.raw_thing_names["image"],
-        avg_text_performance=avg_text_performance.amount,
-        avg_text_thing_name=avg_text_performance.prefix + hv.raw_thing_names["text"],
-        total_image_things=total_image_things.amount,
-        total_total_image_things_name=total_image_things.prefix + hv.raw_thing_names["image"],
-        total_text_things=total_text_things.amount,
-        total_text_things_name=total_text_things.prefix + hv.raw_thing_names["text"],
-        total_image_fulfillments=total_image_fulfillments.amount,
-        total_image_fulfillments_char=total_image_fulfillments.char,
-        total_text_fulfillments=total_text_fulfillments.amount,
-        total_text_fulfillments_char=total_text_fulfillments.char,
-        total_forms=total_forms.amount,
-        total_forms_char=total_forms.char,
-        image_workers=image_worker_count,
-        image_worker_threads=image_worker_thread_count,
-        text_workers=text_worker_count,
-        text_worker_threads=text_worker_thread_count,
-        interrogation_workers=interrogation_worker_count,
-        interrogation_worker_threads=interrogation_worker_thread_count,
-        total_image_queue=processing_totals["queued_requests"],
-        total_text_queue=processing_totals["queued_text_requests"],
-        total_forms_queue=processing_totals.get("queued_forms", 0),
-        queued_image_things=queued_image_things.amount,
-        queued_image_things_name=queued_image_things.prefix + hv.raw_thing_names["image"],
-        queued_text_things=queued_text_things.amount,
-        queued_text_things_name=queued_text_things.prefix + hv.raw_thing_names["text"],
-        maintenance_mode=maintenance.active,
-        news=news,
-    )
-
-    style = """<style>
-        body {
-            max-width: 120ex;
-            margin: 0 auto;
-            color: #333333;
-            line-height: 1.4;
-            font-family: sans-serif;
-            padding: 1em;
-        }
-        </style>
-    """
-
-    head = f"""<head>
-    <title>{horde_title}</title>
-    <meta name="google-site-verification" content="{google_verification_string}" />
-    <meta name="viewport" content="width=device-width, initial-scale=1" />
-    {style}
-    </head>
-    """
-    return head + markdown(findex + policies)
+    return landing_page.get_html()
 
 
 @HORDE.route("/sponsors")
@@ -252,6 +151,7 @@ def register():
             if is_profane(username):
                 return render_template("bad_username.html", page_title="Bad Username")
             user.username = username
+            user.invalidate_principal()
             user.api_key = hashed_api_key
             db.session.commit()
         else:
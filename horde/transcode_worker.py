@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Decodes and re-encodes images to WebP.
+The horde runs this file as a standalone script in each transcoding process,
+so it must only import the standard library and PIL, and must not log or touch the DB.
+"""
+
+import base64
+import binascii
+import hashlib
+import math
+import os
+import resource
+import signal
+import sys
+from io import BytesIO
+from multiprocessing.connection import Connection
+
+from PIL import Image, UnidentifiedImageError
+
+SOURCE_IMAGE_MAX_PIXELS = 3072 * 3072
+# Hard ceiling on what we'll ever decode, regardless of what the caller asks for
+TRANSCODE_MAX_PIXELS = int(os.getenv("HORDE_TRANSCODE_MAX_PIXELS", 8192 * 8192))
+
+
+def get_source_image_quality(resolution, resolution_threshold=SOURCE_IMAGE_MAX_PIXELS):
+    """We adjust the amount of compression based on the starting image to avoid running out of bandwidth"""
+    if resolution > resolution_threshold * 0.9:
+        return 50
+    if resolution > resolution_threshold * 0.8:
+        return 60
+    if resolution > resolution_threshold * 0.6:
+        return 70
+    if resolution > resolution_threshold * 0.4:
+        return 80
+    if resolution > resolution_threshold * 0.3:
+        return 90
+    if resolution > resolution_threshold * 0.15:
+        return 95
+    return 100
+
+
+def transcode(image_data, is_b64, max_pixels, quality, hash_pixels=False, encode=True):
+    """Decodes and re-encodes an image to WebP.
+    If hash_pixels is True, it also calculates a sha256 of the decoded pixels,
+    so that the same picture can be recognised regardless of how it was encoded.
+    If encode is False, the WebP is not generated.
+    Returns a tuple of (error_message, error_rc, image_properties, webp_buffer). error_rc is None on success.
+    """
+    if is_b64:
+        try:
+            image_data = base64.b64decode(image_data)
+        except (binascii.Error, ValueError):
+            return ("Source image is not valid base64.", "ImageValidationFailed", None, None)
+    source_length = len(image_data)
+    try:
+        image = Image.open(BytesIO(image_data))
+    except UnidentifiedImageError:
+        if is_b64:
+            return (None, "ImageValidationFailed", None, None)
+        return ("Url does not contain a valid image.", "SourceImageUrlInvalid", None, None)
+    # Image.open() only reads the headers, so we can reject oversized images before allocating anything
+    width, height = image.size
+    resolution = width * height
+    if resolution > min(max_pixels, TRANSCODE_MAX_PIXELS):
+        side = math.isqrt(max_pixels)
+        limit_txt = f"{side}*{side}" if side * side == max_pixels else str(max_pixels)
+        return (f"Image size cannot exceed {limit_txt} pixels", "SourceImageResolutionExceeded", None, None)
+    if quality is None:
+        quality = get_source_image_quality(resolution, max_pixels)
+    bands = image.getbands()
+    buffer = BytesIO() if encode else None
+    pixel_hash = None
+    try:
+        if hash_pixels:
+            image.load()
+            pixel_hasher = hashlib.sha256(f"{image.mode}:{width}x{height}:".encode())
+            pixel_hasher.update(image.tobytes())
+            pixel_hash = pixel_hasher.hexdigest()
+        if encode:
+            image.save(buffer, format="WebP", quality=quality, exact=True)
+    except MemoryError:
+        return ("Image too large to process.", "SourceImageResolutionExceeded", None, None)
+    except Exception:
+        return ("Something went wrong when opening image.", "SourceImageUnreadable", None, None)
+    image.close()
+    image_properties = {
+        "width": width,
+        "height": height,
+        "bands": bands,
+        "quality": quality,
+        "source_length": source_length,
+        "pixel_hash": pixel_hash,
+    }
+    return (None, None, image_properties, buffer)
+
+
+def limit_memory(memory_mb):
+    """Allows this process to grow only by memory_mb above what it needed to start"""
+    try:
+        with open("/proc/self/statm") as statm:
+            current_vm = int(statm.read().split()[0]) * resource.getpagesize()
+        memory_limit = current_vm + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except (OSError, ValueError):
+        pass
+
+
+def serve(connection):
+    """Transcodes the images sent through the connection, one at a time, until the horde closes it.
+    Each request is a tuple of the transcode() options, followed by the image bytes.
+    Each response is the (error_message, error_rc, image_properties) tuple, followed by the WebP bytes when they were encoded.
+    The image bytes are sent apart from the pickled tuples, so that they're written straight from their buffers.
+    """
+    while True:
+        try:
+            is_b64, max_pixels, quality, hash_pixels, encode = connection.recv()
+            image_data = connection.recv_bytes()
+        except EOFError:
+            return
+        error, rc, image_properties, buffer = transcode(image_data, is_b64, max_pixels, quality, hash_pixels, encode)
+        del image_data
+        connection.send((error, rc, image_properties))
+        if buffer is not None and rc is None:
+            with buffer.getbuffer() as webp:
+                connection.send_bytes(webp)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    limit_memory(int(sys.argv[2]))
+    serve(Connection(int(sys.argv[1])))
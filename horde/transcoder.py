@@ -0,0 +1,180 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+from multiprocessing.connection import Connection
+
+from horde.exceptions import ImageValidationFailed
+from horde.logger import logger
+from horde.transcode_worker import (  # noqa F401
+    SOURCE_IMAGE_MAX_PIXELS,
+    TRANSCODE_MAX_PIXELS,
+    transcode,
+)
+
+TRANSCODE_PROCESSES = int(os.getenv("HORDE_TRANSCODE_PROCESSES", 2))
+TRANSCODE_TIMEOUT = int(os.getenv("HORDE_TRANSCODE_TIMEOUT", 15))
+TRANSCODE_MEMORY_MB = int(os.getenv("HORDE_TRANSCODE_MEMORY_MB", 1024))
+TRANSCODE_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcode_worker.py")
+
+
+class TranscodedImage:
+    """The result of transcoding an image to WebP.
+    It carries the encoded bytes along with the few image properties the API needs,
+    so that the decoded image never has to leave the transcoding process.
+    """
+
+    __slots__ = ("webp", "width", "height", "bands", "quality", "source_length", "pixel_hash")
+
+    def __init__(self, webp, width, height, bands, quality, source_length, pixel_hash=None):
+        self.webp = webp
+        self.width = width
+        self.height = height
+        self.bands = bands
+        self.quality = quality
+        self.source_length = source_length
+        self.pixel_hash = pixel_hash
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def getbands(self):
+        return self.bands
+
+    def get_pixel_hash(self):
+        return self.pixel_hash
+
+
+class TranscoderProcess:
+    """A transcoding process, which handles one image at a time.
+    It runs transcode_worker.py in a fresh interpreter, so nothing is forked from the multithreaded horde
+    and the process doesn't have to import the rest of the horde.
+    """
+
+    def __init__(self, memory_mb):
+        horde_socket, worker_socket = socket.socketpair()
+        with worker_socket:
+            self.process = subprocess.Popen(
+                # Isolated mode, so that the modules of the horde directory can't shadow the standard library
+                [sys.executable, "-I", TRANSCODE_WORKER_PATH, str(worker_socket.fileno()), str(memory_mb)],
+                pass_fds=(worker_socket.fileno(),),
+                stdin=subprocess.DEVNULL,
+            )
+        self.connection = Connection(horde_socket.detach())
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, image_data, is_b64, max_pixels, quality, hash_pixels, encode, timeout):
+        """Sends an image to this process and waits for its result.
+        Raises TimeoutError if it takes longer than timeout seconds, after which this process must be killed.
+        Raises EOFError or OSError if the process died.
+        """
+        if is_b64:
+            image_data = image_data.encode("utf-8")
+        self.connection.send((is_b64, max_pixels, quality, hash_pixels, encode))
+        self.connection.send_bytes(image_data)
+        if not self.connection.poll(timeout):
+            raise TimeoutError
+        error, rc, image_properties = self.connection.recv()
+        webp = None
+        if encode and rc is None:
+            webp = self.connection.recv_bytes()
+        return error, rc, image_properties, webp
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.connection.close()
+
+
+class ImageTranscoder:
+    """Moves image decoding and WebP encoding off the request threads into a set of worker processes.
+    Each process handles one image at a time, so when an image takes too long, only its own process is killed,
+    and it is replaced on the next request.
+    """
+
+    def __init__(self, processes=TRANSCODE_PROCESSES, timeout=TRANSCODE_TIMEOUT, memory_mb=TRANSCODE_MEMORY_MB):
+        self.processes = processes
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.slots = threading.BoundedSemaphore(max(processes, 1))
+        self.idle_processes = []
+        self.lock = threading.Lock()
+        self.started = False
+
+    def get_process(self):
+        """Returns an idle transcoding process, or starts a new one. The caller has to hold a slot."""
+        with self.lock:
+            while self.idle_processes:
+                process = self.idle_processes.pop()
+                if process.is_alive():
+                    return process
+                process.kill()
+        process = TranscoderProcess(self.memory_mb)
+        if not self.started:
+            self.started = True
+            logger.init_ok(f"Image Transcoder with {self.processes} processes", status="Started")
+        return process
+
+    def release_process(self, process):
+        with self.lock:
+            self.idle_processes.append(process)
+
+    def transcode(self, image_data, is_b64=True, max_pixels=TRANSCODE_MAX_PIXELS, quality=None, hash_pixels=False, encode=True):
+        """Converts an image (base64 string or raw bytes) into WebP.
+        If quality is None, it is selected based on the image resolution.
+        Raises ImageValidationFailed if the image cannot be transcoded within our limits.
+        """
+        if self.processes <= 0:
+            error, rc, image_properties, buffer = transcode(image_data, is_b64, max_pixels, quality, hash_pixels, encode)
+            webp = buffer.getvalue() if buffer is not None and rc is None else None
+        else:
+            if not self.slots.acquire(timeout=self.timeout):
+                logger.warning(f"No image transcoding process became available within {self.timeout} seconds.")
+                raise ImageValidationFailed("Image took too long to process.", rc="SourceImageUnreadable")
+            try:
+                try:
+                    process = self.get_process()
+                except OSError as err:
+                    logger.error(f"Could not start an image transcoding process: {err}")
+                    raise ImageValidationFailed("Something went wrong when opening image.", rc="SourceImageUnreadable")
+                try:
+                    error, rc, image_properties, webp = process.run(
+                        image_data,
+                        is_b64,
+                        max_pixels,
+                        quality,
+                        hash_pixels,
+                        encode,
+                        self.timeout,
+                    )
+                except TimeoutError:
+                    process.kill()
+                    logger.warning(f"Image transcoding took longer than {self.timeout} seconds. Aborting.")
+                    raise ImageValidationFailed("Image took too long to process.", rc="SourceImageUnreadable")
+                except (EOFError, OSError):
+                    process.kill()
+                    logger.warning("Image transcoding process died. It will be replaced.")
+                    raise ImageValidationFailed("Something went wrong when opening image.", rc="SourceImageUnreadable")
+                self.release_process(process)
+            finally:
+                self.slots.release()
+        if rc is not None:
+            if error is None:
+                raise ImageValidationFailed(rc=rc)
+            raise ImageValidationFailed(error, rc=rc)
+        return TranscodedImage(webp=webp, **image_properties)
+
+    def hash_pixels(self, image_data, is_b64=False):
+        """Returns a sha256 of the decoded pixels of the image, without encoding it to WebP"""
+        return self.transcode(image_data, is_b64=is_b64, hash_pixels=True, encode=False).pixel_hash
+
+
+image_transcoder = ImageTranscoder()
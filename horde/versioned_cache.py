@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+
+class VersionedCache(ABC):
+    """Keeps a snapshot of something stored in the DB in the memory of this node.
+    Whoever changes it has to call notify_change() after committing, which stores a new version stamp in redis.
+    Each node checks that stamp at most every check_interval seconds and reloads its snapshot when it changed.
+    It also reloads it after max_staleness seconds, in case a change notification was missed, such as when redis is down.
+    Subclasses implement load_snapshot(), which reads the DB and returns the new snapshot.
+    """
+
+    def __init__(self, version_key, check_interval, max_staleness):
+        self.version_key = version_key
+        self.check_interval = check_interval
+        self.max_staleness = max_staleness
+        self.snapshot = None
+        self.version = None
+        self.loaded_at = 0
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def load_snapshot(self):
+        """Reads the DB and returns the new snapshot"""
+
+    def get_version(self):
+        """Returns the version stamp of the latest change, or None if we can't know it"""
+        if not hr.horde_r:
+            return None
+        try:
+            # We skip the local redis cache, as it would delay the change notification
+            version = hr.horde_r.get(self.version_key)
+        except Exception as err:
+            logger.warning(f"Could not read {self.version_key} from redis: {err}")
+            return None
+        if version is None:
+            return None
+        return version.decode() if isinstance(version, bytes) else version
+
+    def load(self, version):
+        """Reloads the snapshot from the DB. Has to be called while holding the lock."""
+        snapshot = self.load_snapshot()
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.snapshot = snapshot
+        return snapshot
+
+    def get_snapshot(self):
+        snapshot = self.snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self.checked_at < self.check_interval:
+            return snapshot
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is not None and now - self.checked_at < self.check_interval:
+                return snapshot
+            version = self.get_version()
+            if snapshot is None or version != self.version or now - self.loaded_at >= self.max_staleness:
+                snapshot = self.load(version)
+            self.checked_at = now
+        return snapshot
+
+    def notify_change(self):
+        version = uuid.uuid4().hex
+        if hr.horde_r:
+            hr.horde_r_set(self.version_key, version)
+        with self.lock:
+            self.load(version)
+            self.checked_at = time.monotonic()
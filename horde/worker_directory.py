@@ -0,0 +1,116 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+from datetime import datetime, timedelta
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+# The directory is only trusted while the primary keeps rebuilding it
+WORKER_DIRECTORY_BUILT_TTL = timedelta(minutes=15)
+# Workers which haven't checked in for this long are not active. Same as Worker.is_stale()
+WORKER_ACTIVE_SECONDS = 300
+# How many workers are written to redis per command while rebuilding
+WORKER_DIRECTORY_CHUNK_SIZE = 1000
+
+
+def make_directory_entry(wtype, user_id, last_check_in):
+    return {
+        "type": wtype,
+        "owner": user_id,
+        "last_check_in": last_check_in,
+        "active": last_check_in is not None and (datetime.utcnow() - last_check_in).total_seconds() <= WORKER_ACTIVE_SECONDS,
+    }
+
+
+class WorkerDirectory:
+    """Maps the id of each worker to its type, owner and last check-in, in a redis hash.
+    This answers whether a list of workers exists, and which of them are active, with a single lookup.
+    Workers update their entry when they're created, when they check in and when they're deleted,
+    and the primary rebuilds it from the DB periodically, to correct any drift.
+    """
+
+    key = "worker_directory"
+    built_key = "worker_directory_built"
+
+    def encode_entry(self, wtype, user_id, last_check_in):
+        return json.dumps(
+            {
+                "type": wtype,
+                "owner": user_id,
+                "last_check_in": last_check_in.isoformat() if last_check_in is not None else None,
+            },
+        )
+
+    def decode_entry(self, value):
+        entry = json.loads(value)
+        last_check_in = datetime.fromisoformat(entry["last_check_in"]) if entry["last_check_in"] is not None else None
+        return make_directory_entry(entry["type"], entry["owner"], last_check_in)
+
+    def set_worker(self, worker):
+        if not hr.horde_r:
+            return
+        try:
+            hr.horde_r.hset(self.key, str(worker.id), self.encode_entry(worker.wtype, worker.user_id, worker.last_check_in))
+        except Exception as err:
+            logger.warning(f"Could not update worker {worker.id} in the worker directory: {err}")
+
+    def remove_worker(self, worker_id):
+        if not hr.horde_r:
+            return
+        try:
+            hr.horde_r.hdel(self.key, str(worker_id))
+        except Exception as err:
+            logger.warning(f"Could not remove worker {worker_id} from the worker directory: {err}")
+
+    def rebuild(self, workers):
+        """Replaces the directory with the provided workers
+        workers is a dict of worker id to a tuple of (type, owner, last check-in)
+        """
+        if not hr.horde_r:
+            return
+        rebuild_key = f"{self.key}_rebuild"
+        worker_ids = list(workers)
+        try:
+            pipe = hr.horde_r.pipeline(transaction=False)
+            pipe.delete(rebuild_key)
+            for chunk_start in range(0, len(worker_ids), WORKER_DIRECTORY_CHUNK_SIZE):
+                chunk = worker_ids[chunk_start : chunk_start + WORKER_DIRECTORY_CHUNK_SIZE]
+                pipe.hset(
+                    rebuild_key,
+                    mapping={worker_id: self.encode_entry(*workers[worker_id]) for worker_id in chunk},
+                )
+            pipe.execute()
+            pipe = hr.horde_r.pipeline(transaction=True)
+            if worker_ids:
+                pipe.rename(rebuild_key, self.key)
+            else:
+                pipe.delete(self.key)
+            pipe.setex(self.built_key, WORKER_DIRECTORY_BUILT_TTL, 1)
+            pipe.execute()
+        except Exception as err:
+            logger.warning(f"Could not rebuild the worker directory: {err}")
+
+    def lookup(self, worker_ids):
+        """Returns the entry of each worker id found in the directory.
+        Workers which aren't in it are left out, as they might have been created during the last rebuild.
+        Returns None if the directory can't be trusted, in which case the workers have to be looked up in the DB
+        """
+        if not hr.horde_r:
+            return None
+        try:
+            pipe = hr.horde_r.pipeline(transaction=False)
+            pipe.get(self.built_key)
+            pipe.hmget(self.key, worker_ids)
+            built, values = pipe.execute()
+        except Exception as err:
+            logger.warning(f"Could not read the worker directory: {err}")
+            return None
+        if built is None:
+            return None
+        return {worker_id: self.decode_entry(value) for worker_id, value in zip(worker_ids, values) if value is not None}
+
+
+worker_directory = WorkerDirectory()
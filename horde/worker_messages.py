@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+from datetime import datetime, timedelta
+
+from horde.database import functions as database
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+from horde.versioned_cache import VersionedCache
+
+# How often each horde node asks redis if the worker messages changed
+WORKER_MESSAGES_CHECK_INTERVAL = float(os.getenv("HORDE_WORKER_MESSAGES_CHECK_INTERVAL", 2))
+# How long each horde node can trust its worker messages without reloading them from the DB
+# Only matters when a change notification was missed, such as when redis is down.
+WORKER_MESSAGES_MAX_STALENESS = float(os.getenv("HORDE_WORKER_MESSAGES_MAX_STALENESS", 60))
+WORKER_MESSAGES_VERSION_KEY = "worker_messages_version"
+# How long the deliveries of a message are remembered after it expires
+WORKER_MESSAGES_TRACKING_RETENTION = timedelta(days=1)
+
+
+class WorkerMessagesSnapshot:
+    """The active worker messages, as they were when loaded from the DB, indexed by the worker they're for"""
+
+    def __init__(self, messages):
+        self.global_messages = []
+        self.worker_messages = {}
+        self.expiries = {}
+        for message in messages:
+            self.expiries[message["id"]] = message["expiry"]
+            if message["worker_id"] is None:
+                self.global_messages.append(message)
+            else:
+                self.worker_messages.setdefault(message["worker_id"], []).append(message)
+
+    def get_messages(self, worker_id):
+        now = datetime.utcnow()
+        return [message for message in self.worker_messages.get(str(worker_id), []) + self.global_messages if message["expiry"] > now]
+
+
+class WorkerMessagesIndex(VersionedCache):
+    """Keeps the active worker messages of this node in memory, so that worker pops can attach them without a DB query.
+    Whoever creates or deletes a worker message has to call notify_change() after committing it.
+    Expired messages are filtered out on read.
+    It also records when each message was first delivered to each worker, and when each worker acknowledged it.
+    """
+
+    def __init__(self, check_interval=WORKER_MESSAGES_CHECK_INTERVAL, max_staleness=WORKER_MESSAGES_MAX_STALENESS):
+        super().__init__(WORKER_MESSAGES_VERSION_KEY, check_interval, max_staleness)
+        # The deliveries this node already recorded since the last reload, so that we don't record them on every pop
+        self.recorded_deliveries = set()
+        # Only used when redis is not available
+        self.local_tracking = {}
+        self.reloads = 0
+        self.deliveries = 0
+        self.acknowledgements = 0
+
+    def load_snapshot(self):
+        messages = [
+            {
+                "id": str(message.id),
+                "worker_id": str(message.worker_id) if message.worker_id is not None else None,
+                "user_id": message.user_id,
+                "message": message.message,
+                "origin": message.origin,
+                "created": message.created,
+                "expiry": message.expiry,
+            }
+            for message in database.get_active_worker_messages()
+        ]
+        self.recorded_deliveries = set()
+        self.reloads += 1
+        return WorkerMessagesSnapshot(messages)
+
+    def get_messages(self, worker_id):
+        """Returns the active messages for this worker, and records that they have been delivered to it"""
+        messages = self.get_snapshot().get_messages(worker_id)
+        if messages:
+            self.record_deliveries(messages, str(worker_id))
+        return messages
+
+    def get_tracking_key(self, action, message_id):
+        return f"worker_message_{action}_{message_id}"
+
+    def track(self, action, message_expiries, worker_id):
+        """Stores when each message had this action done for this worker, unless it was already stored"""
+        now = datetime.utcnow()
+        timestamp = now.isoformat()
+        if not hr.horde_r:
+            for message_id in message_expiries:
+                self.local_tracking.setdefault(self.get_tracking_key(action, message_id), {}).setdefault(worker_id, timestamp)
+            return
+        try:
+            pipe = hr.horde_r.pipeline(transaction=False)
+            for message_id, expiry in message_expiries.items():
+                tracking_key = self.get_tracking_key(action, message_id)
+                pipe.hsetnx(tracking_key, worker_id, timestamp)
+                pipe.expire(tracking_key, expiry - now + WORKER_MESSAGES_TRACKING_RETENTION)
+            pipe.execute()
+        except Exception as err:
+            logger.warning(f"Could not record the worker message {action}: {err}")
+
+    def record_deliveries(self, messages, worker_id):
+        new_deliveries = {
+            message["id"]: message["expiry"] for message in messages if (message["id"], worker_id) not in self.recorded_deliveries
+        }
+        if not new_deliveries:
+            return
+        self.recorded_deliveries.update((message_id, worker_id) for message_id in new_deliveries)
+        self.deliveries += len(new_deliveries)
+        self.track("deliveries", new_deliveries, worker_id)
+
+    def acknowledge(self, message_id, worker_id):
+        """Records that the worker has seen this message.
+        Returns False if the message is not active for this worker.
+        """
+        for message in self.get_snapshot().get_messages(worker_id):
+            if message["id"] == str(message_id):
+                self.acknowledgements += 1
+                self.track("acknowledgements", {message["id"]: message["expiry"]}, str(worker_id))
+                return True
+        return False
+
+    def get_tracking(self, message_id):
+        """Returns how many workers this message has been delivered to and how many acknowledged it"""
+        tracking = {}
+        for action in ("deliveries", "acknowledgements"):
+            tracking_key = self.get_tracking_key(action, message_id)
+            if not hr.horde_r:
+                tracking[action] = len(self.local_tracking.get(tracking_key, {}))
+                continue
+            try:
+                tracking[action] = hr.horde_r.hlen(tracking_key)
+            except Exception as err:
+                logger.warning(f"Could not read the worker message {action}: {err}")
+                tracking[action] = None
+        return tracking
+
+    def get_stats(self):
+        snapshot = self.snapshot
+        return {
+            "active_messages": len(snapshot.expiries) if snapshot is not None else None,
+            "reloads": self.reloads,
+            "deliveries": self.deliveries,
+            "acknowledgements": self.acknowledgements,
+        }
+
+
+worker_messages = WorkerMessagesIndex()
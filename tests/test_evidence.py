@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import importlib.util
+import json
+import sys
+import types
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from loguru import logger
+
+EVIDENCE_PATH = Path(__file__).parent.parent / "horde" / "evidence.py"
+
+
+@pytest.fixture(scope="session")
+def increase_kudos() -> None:
+    """These tests use their own local sink instead of a running horde"""
+
+
+@pytest.fixture
+def evidence():
+    """Loads the evidence queue with redis down, without starting the rest of the horde"""
+    horde_redis = types.ModuleType("horde.horde_redis")
+    horde_redis.horde_redis = types.SimpleNamespace(horde_r=None)
+    horde_logger = types.ModuleType("horde.logger")
+    horde_logger.logger = logger
+    with mock.patch.dict(sys.modules, {"horde.horde_redis": horde_redis, "horde.logger": horde_logger}):
+        spec = importlib.util.spec_from_file_location("evidence", EVIDENCE_PATH)
+        evidence = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(evidence)
+    # We upload from the test itself instead of the background uploader
+    with mock.patch.object(evidence.EvidenceQueue, "ensure_uploader"):
+        yield evidence
+
+
+def flush(evidence_queue):
+    """Uploads everything in the buffer and returns the entries which failed"""
+    failed_entries = []
+    while batch := evidence_queue.buffer.pop_batch(evidence_queue.batch_size, timeout=0):
+        failed_entries.extend(evidence_queue.upload_batch(batch))
+    return failed_entries
+
+
+def test_local_sink_receives_evidence_and_overflow_is_dropped(evidence, tmp_path) -> None:
+    evidence_queue = evidence.EvidenceQueue(evidence.LocalEvidenceSink(tmp_path), evidence.MemoryEvidenceBuffer(3), batch_size=2)
+    records = [{"type": "csam", "prompt": f"prompt {index}"} for index in range(5)]
+    submitted = [evidence_queue.submit(record) for record in records]
+    assert submitted == [True, True, True, False, False]
+    assert evidence_queue.get_stats() == {"pending": 3, "queued": 3, "dropped": 2, "uploaded": 0, "failed": 0}
+    assert flush(evidence_queue) == []
+    received = []
+    for evidence_file in tmp_path.iterdir():
+        with open(evidence_file) as f:
+            received.append(json.load(f))
+    assert sorted(received, key=lambda record: record["prompt"]) == records[:3]
+    assert evidence_queue.get_stats() == {"pending": 0, "queued": 3, "dropped": 2, "uploaded": 3, "failed": 0}
+
+
+def test_failed_uploads_are_returned(evidence) -> None:
+    sink = mock.Mock()
+    sink.write.side_effect = [True, False, Exception("R2 is down")]
+    evidence_queue = evidence.EvidenceQueue(sink, evidence.MemoryEvidenceBuffer(10))
+    for index in range(3):
+        evidence_queue.submit({"type": "csam", "prompt": f"prompt {index}"})
+    failed_entries = flush(evidence_queue)
+    assert [entry["record"]["prompt"] for entry in failed_entries] == ["prompt 1", "prompt 2"]
+    assert evidence_queue.get_stats()["uploaded"] == 1
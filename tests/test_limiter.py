@@ -0,0 +1,100 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import importlib.util
+import sys
+import types
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+LIMITER_PATH = Path(__file__).parent.parent / "horde" / "limiter.py"
+SECOND = 1000000
+
+
+@pytest.fixture(scope="session")
+def increase_kudos() -> None:
+    """These tests use their own in-process buckets instead of a running horde"""
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+@pytest.fixture
+def limiter():
+    """Loads the limiter with redis down, without starting the rest of the horde"""
+    horde_exceptions = types.ModuleType("horde.exceptions")
+    horde_exceptions.RateLimitExceeded = RateLimitExceeded
+    horde_flask = types.ModuleType("horde.flask")
+    horde_flask.HORDE = Flask(__name__)
+    horde_logger = types.ModuleType("horde.logger")
+    horde_logger.logger = mock.MagicMock()
+    horde_redis_ctrl = types.ModuleType("horde.redis_ctrl")
+    horde_redis_ctrl.is_redis_up = lambda: False
+    horde_redis_ctrl.ger_limiter_url = None
+    horde_redis_ctrl.get_limiter_db = None
+    horde = types.ModuleType("horde")
+    horde.exceptions = horde_exceptions
+    modules = {
+        "horde": horde,
+        "horde.exceptions": horde_exceptions,
+        "horde.flask": horde_flask,
+        "horde.logger": horde_logger,
+        "horde.redis_ctrl": horde_redis_ctrl,
+    }
+    with mock.patch.dict(sys.modules, modules):
+        spec = importlib.util.spec_from_file_location("limiter", LIMITER_PATH)
+        limiter = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(limiter)
+    return limiter
+
+
+def hit_at(limiter, now, buckets):
+    """Hits the buckets with the clock at `now` microseconds"""
+    with mock.patch.object(limiter, "time", types.SimpleNamespace(time=lambda: now / SECOND)):
+        return limiter.token_limiter.hit(buckets)
+
+
+def test_local_bucket_allows_burst_then_refills(limiter) -> None:
+    assert limiter.token_limiter.script is None
+    bucket = [("pop:worker", SECOND, 3)]
+    now = 1000 * SECOND
+    for _ in range(3):
+        assert hit_at(limiter, now, bucket) == 0
+    assert hit_at(limiter, now, bucket) == SECOND
+    # Half an interval later, the next token is still half an interval away
+    assert hit_at(limiter, now + SECOND // 2, bucket) == SECOND // 2
+    assert hit_at(limiter, now + SECOND, bucket) == 0
+    assert hit_at(limiter, now + SECOND, bucket) > 0
+    # After the whole bucket has refilled, we get the full burst again
+    now += 4 * SECOND
+    for _ in range(3):
+        assert hit_at(limiter, now, bucket) == 0
+    assert hit_at(limiter, now, bucket) > 0
+
+
+def test_local_buckets_only_charge_when_all_admit(limiter) -> None:
+    now = 1000 * SECOND
+    assert hit_at(limiter, now, [("user", SECOND, 1), ("ip", SECOND, 2)]) == 0
+    # The user bucket is empty, so the ip bucket must not be charged
+    assert hit_at(limiter, now, [("user", SECOND, 1), ("ip", SECOND, 2)]) == SECOND
+    assert hit_at(limiter, now, [("ip", SECOND, 2)]) == 0
+    assert hit_at(limiter, now, [("ip", SECOND, 2)]) > 0
+
+
+def test_limit_decorator_raises_rate_limit_exceeded(limiter) -> None:
+    rate_limit = types.SimpleNamespace(get_bucket=lambda: ("submit:worker", 2 * SECOND, 1))
+
+    @limiter.token_limiter.limit(rate_limit)
+    def submit():
+        return "submitted"
+
+    assert submit() == "submitted"
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        submit()
+    assert 0 < exc_info.value.retry_after <= 2
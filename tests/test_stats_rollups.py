@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2024 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import importlib.util
+import random
+import sys
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from loguru import logger
+
+STATS_ROLLUPS_PATH = Path(__file__).parent.parent / "horde" / "classes" / "base" / "stats_rollups.py"
+START = datetime(2024, 6, 1, 12, 30, 17)
+
+
+@pytest.fixture(scope="session")
+def increase_kudos() -> None:
+    """These tests use their own SQLite database instead of a running horde"""
+
+
+@pytest.fixture
+def rollups():
+    """Loads the rollups against an in-memory SQLite database, without starting the rest of the horde"""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db = SQLAlchemy(app)
+    horde_flask = types.ModuleType("horde.flask")
+    horde_flask.db = db
+    horde_logger = types.ModuleType("horde.logger")
+    horde_logger.logger = logger
+    with mock.patch.dict(sys.modules, {"horde.flask": horde_flask, "horde.logger": horde_logger}):
+        spec = importlib.util.spec_from_file_location("stats_rollups", STATS_ROLLUPS_PATH)
+        stats_rollups = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(stats_rollups)
+
+    class Statistic(db.Model):
+        __tablename__ = "statistics"
+        id = db.Column(db.Integer, primary_key=True)
+        finished = db.Column(db.DateTime(timezone=False), nullable=True)
+        amount = db.Column(db.Integer, nullable=False)
+
+    with app.app_context():
+        db.create_all()
+        yield stats_rollups, db, Statistic
+
+
+def compile_at(stats_rollups, Statistic, now):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    with mock.patch.object(stats_rollups, "datetime", FrozenDatetime):
+        return stats_rollups.compile_stats_rollups("image", Statistic, Statistic.amount)
+
+
+def sum_statistics(stats_rollups, db, Statistic, now):
+    """Sums every period from the statistics themselves"""
+    period_end = stats_rollups.floor_minute(now)
+    statistics = db.session.query(Statistic.finished, Statistic.amount).all()
+    totals = {"total": [len(statistics), sum(amount for _, amount in statistics)]}
+    for period, period_length in stats_rollups.ROLLUP_PERIODS.items():
+        in_period = [
+            amount for finished, amount in statistics if finished is not None and period_end - period_length <= finished < period_end
+        ]
+        totals[period] = [len(in_period), sum(in_period)]
+    return totals
+
+
+def assert_totals(totals, expected_totals):
+    # The month period is only accurate to the hour
+    for period in ("minute", "hour", "day", "total"):
+        assert totals[period] == expected_totals[period], period
+
+
+def test_rollups_match_statistics(rollups) -> None:
+    stats_rollups, db, Statistic = rollups
+    randomizer = random.Random(42)
+    for _ in range(3000):
+        finished = START - timedelta(seconds=randomizer.randint(0, 60 * 86400))
+        db.session.add(Statistic(finished=finished, amount=randomizer.randint(1, 100)))
+    db.session.add(Statistic(finished=None, amount=5))
+    db.session.commit()
+    now = START
+    compiled_runs = 0
+    for _ in range(30):
+        totals = compile_at(stats_rollups, Statistic, now)
+        if totals is not None:
+            assert_totals(totals, sum_statistics(stats_rollups, db, Statistic, now))
+            compiled_runs += 1
+        for _ in range(randomizer.randint(0, 40)):
+            db.session.add(Statistic(finished=now - timedelta(seconds=randomizer.randint(0, 50)), amount=randomizer.randint(1, 100)))
+        db.session.commit()
+        now += timedelta(minutes=randomizer.choice([1, 1, 3, 7, 60, 600]))
+    assert compiled_runs == 30
+    assert db.session.query(stats_rollups.GenerationStatsRollup).filter_by(granularity="total").count() == 1
+
+
+def test_late_commits_are_not_skipped(rollups) -> None:
+    stats_rollups, db, Statistic = rollups
+    for statistic_id in (1, 2, 4):
+        db.session.add(Statistic(id=statistic_id, finished=START, amount=10))
+    db.session.commit()
+    now = START + timedelta(minutes=1)
+    assert compile_at(stats_rollups, Statistic, now)["total"] == [3, 30]
+    # The statistic with id 3 was still being committed when id 4 became visible
+    db.session.add(Statistic(id=3, finished=START, amount=10))
+    db.session.commit()
+    for _ in range(15):
+        now += timedelta(minutes=1)
+        totals = compile_at(stats_rollups, Statistic, now)
+        assert_totals(totals, sum_statistics(stats_rollups, db, Statistic, now))
+    progress = db.session.query(stats_rollups.GenerationStatsRollupProgress).filter_by(stat_type="image").one()
+    assert progress.last_id == 4
+    rollup_count = db.session.query(db.func.sum(stats_rollups.GenerationStatsRollup.count)).scalar()
+    assert rollup_count == 4
+
+
+def test_backlog_is_folded_over_several_runs(rollups) -> None:
+    stats_rollups, db, Statistic = rollups
+    for statistic_id in range(1, 101):
+        db.session.add(Statistic(id=statistic_id, finished=START - timedelta(days=statistic_id), amount=1))
+    db.session.commit()
+    now = START
+    with mock.patch.object(stats_rollups, "ROLLUP_BATCH_SIZE", 10), mock.patch.object(stats_rollups, "ROLLUP_MAX_BATCHES", 2):
+        runs = 0
+        while (totals := compile_at(stats_rollups, Statistic, now)) is None:
+            runs += 1
+            assert runs < 20
+            now += timedelta(minutes=1)
+    assert runs > 1
+    assert_totals(totals, sum_statistics(stats_rollups, db, Statistic, now))